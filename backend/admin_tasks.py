@@ -0,0 +1,37 @@
+"""
+Ejecución en paralelo acotado de tareas por colección para las operaciones de administración.
+
+Las operaciones (backup, reset, estadísticas) lanzan una corrutina por colección con
+asyncio.gather, limitadas por un semáforo, de modo que el tiempo total depende de la
+colección más lenta y no de la suma de todas.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+ADMIN_CONCURRENCY = int(os.environ.get('ADMIN_CONCURRENCY', '4'))
+
+
+async def ejecutar_por_coleccion(
+    colecciones: List[str],
+    tarea: Callable[[str], Awaitable[Any]],
+    limite: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Ejecuta `tarea(coleccion)` para cada colección con a lo sumo `limite` en paralelo.
+    Devuelve, en el mismo orden, {"coleccion", "resultado", "segundos"} por colección.
+    """
+    semaforo = asyncio.Semaphore(limite or ADMIN_CONCURRENCY)
+
+    async def ejecutar(coleccion: str) -> Dict[str, Any]:
+        async with semaforo:
+            inicio = time.monotonic()
+            resultado = await tarea(coleccion)
+            return {
+                "coleccion": coleccion,
+                "resultado": resultado,
+                "segundos": round(time.monotonic() - inicio, 3),
+            }
+
+    return list(await asyncio.gather(*(ejecutar(c) for c in colecciones)))
@@ -0,0 +1,226 @@
+"""
+Registro de plantillas de prompts para los endpoints de IA.
+
+Cada plantilla tiene un prefijo estático (mensaje de sistema + instrucciones y formato
+de respuesta) que es idéntico byte a byte entre llamadas, para que el proveedor pueda
+cachearlo, y el contenido variable (texto dictado) siempre va al final.
+"""
+import hashlib
+import json
+import re
+from typing import Any, Dict, Optional, Tuple
+
+
+class PromptTemplate:
+    """Plantilla de prompt versionada con prefijo estático y contenido variable al final"""
+
+    def __init__(self, name: str, version: int, system_message: str, instrucciones: str,
+                 variable_template: Optional[str] = None):
+        self.name = name
+        self.version = version
+        self.system_message = system_message.strip()
+        self.instrucciones = instrucciones.strip()
+        self.variable_template = variable_template
+        self.prefix_hash = hashlib.sha256(
+            f"{self.system_message}\n{self.instrucciones}".encode('utf-8')
+        ).hexdigest()[:16]
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}@v{self.version}"
+
+    def render(self, **variables) -> str:
+        """Construye el mensaje de usuario: instrucciones estáticas primero, variables al final"""
+        if not self.variable_template:
+            return self.instrucciones
+        return f"{self.instrucciones}\n\n{self.variable_template.format(**variables)}"
+
+
+_registry: Dict[Tuple[str, int], PromptTemplate] = {}
+_latest: Dict[str, int] = {}
+
+
+def register_prompt(template: PromptTemplate) -> PromptTemplate:
+    _registry[(template.name, template.version)] = template
+    _latest[template.name] = max(_latest.get(template.name, 0), template.version)
+    return template
+
+
+def get_prompt(name: str, version: Optional[int] = None) -> PromptTemplate:
+    """Obtiene una plantilla por nombre (última versión si no se indica)"""
+    version = version or _latest.get(name)
+    template = _registry.get((name, version))
+    if template is None:
+        raise KeyError(f"Plantilla de prompt no registrada: {name} v{version}")
+    return template
+
+
+def list_prompts():
+    return [
+        {"name": t.name, "version": t.version, "prefix_hash": t.prefix_hash, "latest": _latest[t.name] == t.version}
+        for t in _registry.values()
+    ]
+
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+
+
+def parse_ai_json(response: str) -> Any:
+    """
+    Extrae el JSON de una respuesta del LLM.
+    Tolera bloques ```json```, texto antes/después del JSON y respuestas con fence sin cerrar.
+    Lanza json.JSONDecodeError si no hay JSON válido.
+    """
+    texto = (response or "").strip()
+
+    match = _FENCE_RE.search(texto)
+    if match:
+        texto = match.group(1).strip()
+    elif texto.startswith('```'):
+        # Fence sin cerrar (respuesta truncada)
+        texto = texto.lstrip('`').removeprefix('json').removeprefix('JSON').strip()
+
+    try:
+        return json.loads(texto)
+    except json.JSONDecodeError:
+        # Último recurso: tomar desde la primera llave hasta la última
+        inicio, fin = texto.find('{'), texto.rfind('}')
+        if inicio == -1 or fin <= inicio:
+            raise
+        return json.loads(texto[inicio:fin + 1])
+
+
+register_prompt(PromptTemplate(
+    name="extraer_datos",
+    version=1,
+    system_message="""Eres un asistente especializado en talleres mecánicos. Tu trabajo es extraer información específica de vehículos a partir de texto dictado o imágenes de matrículas.
+
+Cuando recibas información, extrae y estructura los siguientes datos en formato JSON:
+- matricula: número de matrícula/placa del vehículo
+- marca: marca del vehículo (Toyota, Honda, etc.)
+- modelo: modelo específico del vehículo
+- año: año del vehículo
+- color: color del vehículo
+- kilometraje: kilometraje actual si se menciona
+- cliente_nombre: nombre del cliente
+- cliente_telefono: teléfono del cliente si se menciona
+- cliente_empresa: nombre de la empresa si es una flota
+- observaciones: cualquier observación adicional sobre el estado del vehículo
+
+Si algún dato no está disponible, usa null. Responde SOLO con el JSON, sin texto adicional.""",
+    instrucciones="Extrae la información del vehículo del siguiente texto dictado.",
+    variable_template="{texto}",
+))
+
+register_prompt(PromptTemplate(
+    name="extraer_datos_imagen",
+    version=1,
+    system_message=get_prompt("extraer_datos").system_message,
+    instrucciones="Extrae la información de la matrícula/placa de este vehículo y cualquier otra información visible del vehículo (marca, modelo, color, etc.). Responde en formato JSON.",
+))
+
+register_prompt(PromptTemplate(
+    name="dictado_orden",
+    version=1,
+    system_message="""Eres un asistente de IA especializado en extraer información de órdenes de trabajo para un taller mecánico venezolano.
+
+INSTRUCCIONES:
+- Extrae TODA la información disponible del texto dictado sobre fallas, diagnósticos y acciones realizadas
+- Organiza la información en formato JSON
+- Usa MAYÚSCULAS para descripciones técnicas importantes
+- Identifica claramente fallas detectadas, diagnósticos del mecánico y acciones tomadas
+- Solo extrae información que esté claramente mencionada
+- Responde SOLO con el JSON, sin explicaciones adicionales""",
+    instrucciones="""FORMATO DE RESPUESTA REQUERIDO:
+{
+  "fallas_detectadas": "DESCRIPCIÓN DETALLADA DE LAS FALLAS ENCONTRADAS",
+  "diagnostico_mecanico": "DIAGNÓSTICO PROFESIONAL DEL MECÁNICO",
+  "reparaciones_realizadas": "TRABAJOS Y REPARACIONES EJECUTADAS",
+  "repuestos_utilizados": "LISTA DE REPUESTOS UTILIZADOS CON CANTIDADES",
+  "observaciones": "NOTAS ADICIONALES Y RECOMENDACIONES"
+}
+
+Analiza el dictado y extrae la información relevante para cada campo.""",
+    variable_template='TEXTO DICTADO: "{texto}"',
+))
+
+register_prompt(PromptTemplate(
+    name="dictado_vehiculo",
+    version=1,
+    system_message="""Eres un asistente de IA especializado en extraer información estructurada para el registro de vehículos y clientes en un taller mecánico venezolano.
+
+INSTRUCCIONES:
+- Extrae TODA la información disponible del texto dictado
+- Organiza la información en formato JSON
+- Usa MAYÚSCULAS para nombres, empresas, direcciones, matrículas, marcas, modelos, colores
+- Usa minúsculas para emails
+- Formatea teléfonos como 0000-000.00.00
+- Solo extrae información que esté claramente mencionada
+- Si mencionan cédula con V- o E-, es tipo_documento: "CI", prefijo_documento: "V" o "E"
+- Si mencionan RIF con J- o G-, es tipo_documento: "RIF", prefijo_documento: "J" o "G"
+- Responde SOLO con el JSON, sin explicaciones adicionales""",
+    instrucciones="""FORMATO DE RESPUESTA REQUERIDO:
+{
+  "cliente": {
+    "nombre": "NOMBRE COMPLETO",
+    "telefono": "0000-000.00.00",
+    "empresa": "NOMBRE EMPRESA",
+    "email": "email@ejemplo.com",
+    "direccion_fiscal": "DIRECCIÓN COMPLETA",
+    "tipo_documento": "CI" o "RIF",
+    "prefijo_documento": "V", "E", "J", o "G",
+    "numero_documento": "12345678"
+  },
+  "vehiculo": {
+    "matricula": "ABC123",
+    "marca": "TOYOTA",
+    "modelo": "COROLLA",
+    "año": 2020,
+    "color": "BLANCO",
+    "kilometraje": 50000,
+    "tipo_combustible": "GASOLINA"
+  }
+}""",
+    variable_template='TEXTO DICTADO: "{texto}"',
+))
+
+register_prompt(PromptTemplate(
+    name="imagen",
+    version=1,
+    system_message="""Eres un experto en OCR y análisis de documentos vehiculares venezolanos. Tu especialidad es extraer información de:
+
+1. MATRÍCULAS DE VEHÍCULOS: Identificar caracteres alfanuméricos en placas
+2. TÍTULOS DE PROPIEDAD: Datos del vehículo y propietario
+3. DOCUMENTOS VEHICULARES: Registro, inspección, etc.
+
+INSTRUCCIONES:
+- Analiza cuidadosamente la imagen
+- Extrae TODA la información visible y legible
+- Usa MAYÚSCULAS para nombres, direcciones, matrículas, marcas, modelos
+- Formatea números de documento correctamente
+- Si ves una matrícula, examínala carácter por carácter
+- Si es un título de propiedad, busca datos del vehículo Y propietario
+- Responde SOLO con JSON, sin explicaciones""",
+    instrucciones="""Analiza esta imagen y extrae toda la información visible sobre vehículos y propietarios.
+
+FORMATO DE RESPUESTA JSON:
+{
+  "vehiculo": {
+    "matricula": "ABC123",
+    "marca": "TOYOTA",
+    "modelo": "COROLLA",
+    "año": 2020,
+    "color": "BLANCO",
+    "serial_niv": "1HGBH41JXMN109186"
+  },
+  "cliente": {
+    "nombre": "JUAN CARLOS RODRIGUEZ",
+    "tipo_documento": "CI" o "RIF",
+    "prefijo_documento": "V", "E", "J", "G",
+    "numero_documento": "12345678"
+  },
+  "tipo_documento": "matricula", "titulo_propiedad", "registro", "otro"
+}
+
+Analiza cuidadosamente y extrae solo información que puedas leer claramente.""",
+))
@@ -0,0 +1,257 @@
+"""
+Proveedores de IA intercambiables para el taller.
+
+Todas las llamadas al LLM pasan por `AIChat`, que delega en un proveedor
+(`EmergentProvider` en producción, `FakeProvider` para pruebas de carga sin red).
+El proveedor se elige con la variable de entorno AI_PROVIDER ("emergent" o "fake")
+y el modelo lo decide `ai_router` según el tipo de tarea, salvo que se fije con with_model().
+"""
+import asyncio
+import json
+import os
+import random
+import uuid
+from typing import Dict, List, Optional
+
+from ai_router import ai_router
+
+DEFAULT_AI_MODEL = os.environ.get('AI_MODEL', 'openai/gpt-4o')
+
+
+class AIProviderError(Exception):
+    """Error devuelto por un proveedor de IA (real o simulado)"""
+
+
+def split_model(model: str):
+    """Separa 'openai/gpt-4o' en ('openai', 'gpt-4o')"""
+    if '/' in model:
+        proveedor, nombre = model.split('/', 1)
+        return proveedor, nombre
+    return "openai", model
+
+
+class AIProvider:
+    """Interfaz común de los proveedores de IA"""
+    name = "base"
+
+    async def send_message(
+        self,
+        system_message: str,
+        text: str,
+        model: str = DEFAULT_AI_MODEL,
+        images: Optional[List[str]] = None,
+        task: str = "general",
+        session_id: Optional[str] = None,
+    ) -> str:
+        raise NotImplementedError
+
+
+class EmergentProvider(AIProvider):
+    """Proveedor real basado en emergentintegrations.LlmChat"""
+    name = "emergent"
+
+    def __init__(self, api_key: Optional[str] = None):
+        self.api_key = api_key or os.environ.get('EMERGENT_LLM_KEY')
+
+    async def send_message(self, system_message, text, model=DEFAULT_AI_MODEL,
+                           images=None, task="general", session_id=None):
+        # Import diferido: el servidor puede arrancar sin la librería si se usa el proveedor simulado
+        from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
+
+        proveedor, nombre_modelo = split_model(model)
+        chat = LlmChat(
+            api_key=self.api_key,
+            session_id=session_id or f"{task}-{uuid.uuid4()}",
+            system_message=system_message
+        ).with_model(proveedor, nombre_modelo)
+
+        file_contents = [ImageContent(imagen) for imagen in images] if images else None
+        if file_contents:
+            user_message = UserMessage(text=text, file_contents=file_contents)
+        else:
+            user_message = UserMessage(text=text)
+        return await chat.send_message(user_message)
+
+
+# Respuestas enlatadas por tipo de tarea para el proveedor simulado
+FAKE_RESPONSES: Dict[str, Dict] = {
+    "extraer_datos": {
+        "matricula": "ABC123", "marca": "TOYOTA", "modelo": "COROLLA", "año": 2020,
+        "color": "BLANCO", "kilometraje": 50000, "cliente_nombre": "CARLOS MENDOZA",
+        "cliente_telefono": "0414-555.12.34", "cliente_empresa": None, "observaciones": None
+    },
+    "dictado_vehiculo": {
+        "cliente": {
+            "nombre": "CARLOS MENDOZA", "telefono": "0414-555.12.34", "empresa": None,
+            "email": "carlos.mendoza@ejemplo.com", "direccion_fiscal": "AV. PRINCIPAL CARACAS",
+            "tipo_documento": "CI", "prefijo_documento": "V", "numero_documento": "12345678"
+        },
+        "vehiculo": {
+            "matricula": "ABC123", "marca": "TOYOTA", "modelo": "COROLLA", "año": 2020,
+            "color": "BLANCO", "kilometraje": 50000, "tipo_combustible": "GASOLINA"
+        }
+    },
+    "dictado_orden": {
+        "fallas_detectadas": "RUIDO EN FRENOS DELANTEROS",
+        "diagnostico_mecanico": "PASTILLAS DE FRENO DESGASTADAS",
+        "reparaciones_realizadas": "CAMBIO DE PASTILLAS DELANTERAS",
+        "repuestos_utilizados": "PASTILLAS DE FRENO DELANTERAS x1",
+        "observaciones": "REVISAR DISCOS EN PRÓXIMO SERVICIO"
+    },
+    "imagen": {
+        "vehiculo": {
+            "matricula": "ABC123", "marca": "TOYOTA", "modelo": "COROLLA", "año": 2020,
+            "color": "BLANCO", "serial_niv": "1NXBR32E25Z123456"
+        },
+        "cliente": {
+            "nombre": "CARLOS MENDOZA", "tipo_documento": "CI",
+            "prefijo_documento": "V", "numero_documento": "12345678"
+        },
+        "tipo_documento": "matricula"
+    },
+}
+
+
+def parse_latency_spec(spec: str):
+    """
+    Convierte una especificación de latencia en una función que devuelve segundos.
+    Formatos: "fixed:0.5", "uniform:0.2,1.5", "normal:0.8,0.2", "lognormal:-0.2,0.5", "exp:0.7"
+    """
+    nombre, _, parametros = spec.partition(':')
+    valores = [float(v) for v in parametros.split(',') if v.strip()] if parametros else []
+    nombre = nombre.strip().lower()
+
+    if nombre == "fixed":
+        return lambda rng: valores[0] if valores else 0.0
+    if nombre == "uniform":
+        return lambda rng: rng.uniform(valores[0], valores[1])
+    if nombre == "normal":
+        return lambda rng: max(0.0, rng.gauss(valores[0], valores[1]))
+    if nombre == "lognormal":
+        return lambda rng: rng.lognormvariate(valores[0], valores[1])
+    if nombre == "exp":
+        # valores[0] es la latencia media
+        return lambda rng: rng.expovariate(1.0 / valores[0])
+    raise ValueError(f"Distribución de latencia desconocida: {spec}")
+
+
+class FakeProvider(AIProvider):
+    """
+    Proveedor simulado para pruebas de carga y latencia sin red.
+    Latencia, tasa de fallos y respuestas se configuran por constructor o por entorno:
+    AI_FAKE_LATENCY, AI_FAKE_FAILURE_RATE, AI_FAKE_TIMEOUT_RATE, AI_FAKE_RESPONSES (archivo JSON), AI_FAKE_SEED.
+    AI_FAKE_MODELS (JSON) permite simular modelos lentos o caídos:
+    {"openai/gpt-4o-mini": {"latency": "fixed:30", "failure_rate": 1.0}}
+    """
+    name = "fake"
+
+    def __init__(
+        self,
+        latency: Optional[str] = None,
+        failure_rate: Optional[float] = None,
+        timeout_rate: Optional[float] = None,
+        responses: Optional[Dict[str, Dict]] = None,
+        seed: Optional[int] = None,
+        models: Optional[Dict[str, Dict]] = None,
+    ):
+        latency = latency or os.environ.get('AI_FAKE_LATENCY', 'lognormal:-0.7,0.5')
+        self.latency_sampler = parse_latency_spec(latency)
+        self.failure_rate = failure_rate if failure_rate is not None else float(os.environ.get('AI_FAKE_FAILURE_RATE', '0'))
+        # Fracción de llamadas que "se cuelgan" mucho más que la latencia normal (colas largas)
+        self.timeout_rate = timeout_rate if timeout_rate is not None else float(os.environ.get('AI_FAKE_TIMEOUT_RATE', '0'))
+        seed = seed if seed is not None else os.environ.get('AI_FAKE_SEED')
+        self.rng = random.Random(int(seed) if seed is not None else None)
+
+        self.responses = dict(FAKE_RESPONSES)
+        archivo_respuestas = os.environ.get('AI_FAKE_RESPONSES')
+        if archivo_respuestas:
+            with open(archivo_respuestas, encoding='utf-8') as f:
+                self.responses.update(json.load(f))
+        if responses:
+            self.responses.update(responses)
+
+        # Comportamiento por modelo: {"modelo": {"latency": spec, "failure_rate": x}}
+        if models is None:
+            models = json.loads(os.environ.get('AI_FAKE_MODELS', '{}'))
+        self.models = {
+            modelo: {
+                "latency": parse_latency_spec(config["latency"]) if "latency" in config else None,
+                "failure_rate": config.get("failure_rate"),
+            }
+            for modelo, config in models.items()
+        }
+
+        self.calls = 0
+        self.failures = 0
+
+    async def send_message(self, system_message, text, model=DEFAULT_AI_MODEL,
+                           images=None, task="general", session_id=None):
+        self.calls += 1
+        config_modelo = self.models.get(model, {})
+        sampler = config_modelo.get("latency") or self.latency_sampler
+        failure_rate = config_modelo.get("failure_rate")
+        if failure_rate is None:
+            failure_rate = self.failure_rate
+
+        demora = sampler(self.rng)
+        if self.timeout_rate and self.rng.random() < self.timeout_rate:
+            demora *= 20
+        await asyncio.sleep(demora)
+
+        if failure_rate and self.rng.random() < failure_rate:
+            self.failures += 1
+            raise AIProviderError(f"Fallo simulado del proveedor ({model})")
+
+        respuesta = self.responses.get(task, {"respuesta": "OK"})
+        texto = respuesta if isinstance(respuesta, str) else json.dumps(respuesta, ensure_ascii=False)
+        # Los modelos reales a veces envuelven el JSON en bloques de código
+        return f"```json\n{texto}\n```" if self.rng.random() < 0.3 else texto
+
+
+_providers: Dict[str, AIProvider] = {}
+
+
+def get_ai_provider(name: Optional[str] = None) -> AIProvider:
+    """Devuelve (y memoriza) el proveedor configurado en AI_PROVIDER"""
+    name = (name or os.environ.get('AI_PROVIDER', 'emergent')).lower()
+    if name not in _providers:
+        if name == "fake":
+            _providers[name] = FakeProvider()
+        elif name == "emergent":
+            _providers[name] = EmergentProvider()
+        else:
+            raise ValueError(f"Proveedor de IA desconocido: {name}")
+    return _providers[name]
+
+
+def set_ai_provider(name: str, provider: AIProvider):
+    """Registra un proveedor (útil para inyectar uno simulado en pruebas)"""
+    _providers[name.lower()] = provider
+
+
+class AIChat:
+    """Sesión de chat con la misma forma que LlmChat, independiente del proveedor"""
+
+    def __init__(self, system_message: str, task: str = "general",
+                 provider: Optional[AIProvider] = None, session_id: Optional[str] = None):
+        self.system_message = system_message
+        self.task = task
+        self.provider = provider or get_ai_provider()
+        self.session_id = session_id
+        # None = el enrutador elige el modelo según la tarea
+        self.model: Optional[str] = None
+
+    def with_model(self, provider_name: str, model: str):
+        self.model = f"{provider_name}/{model}"
+        return self
+
+    async def send_message(self, text: str, images: Optional[List[str]] = None,
+                           deadline: Optional[float] = None, hedge: Optional[bool] = None) -> str:
+        """deadline es un instante de time.monotonic(); hedge=None usa AI_HEDGING"""
+        tier = "vision" if images else "texto"
+        return await ai_router.send(
+            self.provider, self.system_message, text, tier,
+            images=images, task=self.task, session_id=self.session_id,
+            models=[self.model] if self.model else None,
+            deadline=deadline, hedge=hedge
+        )
@@ -0,0 +1,217 @@
+"""
+Enrutador de modelos de IA por tipo de tarea.
+
+Cada nivel ("texto", "vision") tiene una lista ordenada de modelos candidatos.
+Se lleva una ventana móvil de latencias y errores por modelo; los modelos degradados
+pasan al final de la lista y, si una llamada falla, se reintenta con el siguiente.
+
+Cada llamada respeta un instante límite (deadline, en reloj monotónico). Con cobertura
+(hedging) activa, si el primer modelo tarda más que su p95 observado se lanza una segunda
+petición al siguiente candidato y gana la primera respuesta válida.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Nivel de modelo por defecto para cada tarea
+DEFAULT_TIERS: Dict[str, List[str]] = {
+    "texto": ["openai/gpt-4o-mini", "gemini/gemini-2.0-flash", "openai/gpt-4o"],
+    "vision": ["openai/gpt-4o", "gemini/gemini-2.0-flash"],
+}
+
+STATS_WINDOW_SECONDS = float(os.environ.get('AI_STATS_WINDOW_SECONDS', '300'))
+STATS_MAX_SAMPLES = 200
+MIN_SAMPLES = 5
+DEGRADED_ERROR_RATE = float(os.environ.get('AI_DEGRADED_ERROR_RATE', '0.5'))
+DEGRADED_P95_SECONDS = float(os.environ.get('AI_DEGRADED_P95_SECONDS', '20'))
+HEDGING_ENABLED = os.environ.get('AI_HEDGING', 'false').lower() == 'true'
+# Espera antes de cubrir cuando aún no hay suficientes muestras para un p95
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get('AI_HEDGE_DEFAULT_DELAY_SECONDS', '8'))
+
+
+class AIDeadlineExceeded(Exception):
+    """Se agotó el presupuesto de tiempo de la petición de IA"""
+
+
+def _tiers_from_env() -> Dict[str, List[str]]:
+    """AI_ROUTES_TEXTO / AI_ROUTES_VISION permiten sobreescribir los candidatos (separados por coma)"""
+    tiers = {nivel: list(modelos) for nivel, modelos in DEFAULT_TIERS.items()}
+    for nivel in tiers:
+        valor = os.environ.get(f'AI_ROUTES_{nivel.upper()}')
+        if valor:
+            tiers[nivel] = [m.strip() for m in valor.split(',') if m.strip()]
+    return tiers
+
+
+def percentile(valores: List[float], p: float) -> Optional[float]:
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100.0 * (len(ordenados) - 1)))))
+    return ordenados[indice]
+
+
+class ModelStats:
+    """Ventana móvil de (instante, latencia, éxito) para un modelo"""
+
+    def __init__(self):
+        self.samples: Deque[Tuple[float, float, bool]] = deque(maxlen=STATS_MAX_SAMPLES)
+
+    def record(self, latency: float, ok: bool):
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def _recent(self):
+        limite = time.monotonic() - STATS_WINDOW_SECONDS
+        while self.samples and self.samples[0][0] < limite:
+            self.samples.popleft()
+        return self.samples
+
+    def latencies(self) -> List[float]:
+        return [lat for _, lat, ok in self._recent() if ok]
+
+    def p50(self) -> Optional[float]:
+        return percentile(self.latencies(), 50)
+
+    def p95(self) -> Optional[float]:
+        return percentile(self.latencies(), 95)
+
+    def error_rate(self) -> float:
+        recientes = self._recent()
+        if not recientes:
+            return 0.0
+        return sum(1 for _, _, ok in recientes if not ok) / len(recientes)
+
+    def degraded(self) -> bool:
+        if len(self._recent()) < MIN_SAMPLES:
+            return False
+        p95 = self.p95()
+        return self.error_rate() >= DEGRADED_ERROR_RATE or (p95 is not None and p95 > DEGRADED_P95_SECONDS)
+
+    def snapshot(self) -> Dict:
+        return {
+            "samples": len(self._recent()),
+            "p50_s": self.p50(),
+            "p95_s": self.p95(),
+            "error_rate": round(self.error_rate(), 3),
+            "degraded": self.degraded(),
+        }
+
+
+class AIRouter:
+    """Elige el modelo por nivel de tarea y hace fallback automático entre candidatos"""
+
+    def __init__(self, tiers: Optional[Dict[str, List[str]]] = None):
+        self.tiers = tiers or _tiers_from_env()
+        self.stats: Dict[str, ModelStats] = {}
+
+    def stats_for(self, model: str) -> ModelStats:
+        if model not in self.stats:
+            self.stats[model] = ModelStats()
+        return self.stats[model]
+
+    def candidates(self, tier: str) -> List[str]:
+        """Candidatos del nivel, con los modelos degradados al final (nunca se quedan sin opción)"""
+        modelos = self.tiers.get(tier) or self.tiers["texto"]
+        sanos = [m for m in modelos if not self.stats_for(m).degraded()]
+        degradados = [m for m in modelos if self.stats_for(m).degraded()]
+        return sanos + degradados
+
+    def hedge_delay(self, model: str) -> float:
+        stats = self.stats_for(model)
+        p95 = stats.p95()
+        if p95 is None or len(stats.latencies()) < MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        return p95
+
+    async def _attempt(self, provider, model: str, deadline: Optional[float], **kwargs) -> str:
+        """Una llamada a un modelo, acotada por el tiempo restante; registra latencia y resultado"""
+        restante = None if deadline is None else deadline - time.monotonic()
+        if restante is not None and restante <= 0:
+            raise AIDeadlineExceeded(f"Sin tiempo restante para {model}")
+        inicio = time.monotonic()
+        try:
+            respuesta = await asyncio.wait_for(provider.send_message(model=model, **kwargs), timeout=restante)
+        except asyncio.TimeoutError:
+            self.stats_for(model).record(time.monotonic() - inicio, False)
+            raise AIDeadlineExceeded(f"{model} no respondió antes del tiempo límite")
+        except asyncio.CancelledError:
+            # Perdedor de una cobertura o cliente desconectado: no cuenta como error del modelo
+            raise
+        except Exception:
+            self.stats_for(model).record(time.monotonic() - inicio, False)
+            raise
+        self.stats_for(model).record(time.monotonic() - inicio, True)
+        return respuesta
+
+    async def _hedged(self, provider, primario: str, alterno: str, deadline: Optional[float], **kwargs) -> str:
+        """Lanza el primario y, si supera su p95, también el alterno; gana la primera respuesta válida"""
+        tarea_primaria = asyncio.create_task(self._attempt(provider, primario, deadline, **kwargs))
+        pendientes = {tarea_primaria}
+        try:
+            espera = self.hedge_delay(primario)
+            if deadline is not None:
+                espera = min(espera, max(0.0, deadline - time.monotonic()))
+            hechas, pendientes = await asyncio.wait(pendientes, timeout=espera)
+            if tarea_primaria in hechas:
+                if tarea_primaria.exception() is None:
+                    return tarea_primaria.result()
+                # El primario falló rápido: el alterno pasa a ser un intento normal
+                logger.warning(f"Modelo {primario} falló para {kwargs.get('task')}: {tarea_primaria.exception()}")
+                return await self._attempt(provider, alterno, deadline, **kwargs)
+
+            logger.info(f"Cobertura: {primario} superó {espera:.2f}s, lanzando {alterno}")
+            pendientes.add(asyncio.create_task(self._attempt(provider, alterno, deadline, **kwargs)))
+            ultimo_error = None
+            while pendientes:
+                hechas, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+                for tarea in hechas:
+                    if tarea.exception() is None:
+                        return tarea.result()
+                    ultimo_error = tarea.exception()
+            raise ultimo_error
+        finally:
+            # Cancelar al perdedor (o a ambos si nos cancelan por desconexión del cliente)
+            for tarea in pendientes:
+                tarea.cancel()
+
+    async def send(self, provider, system_message: str, text: str, tier: str,
+                   images=None, task: str = "general", session_id=None, models: Optional[List[str]] = None,
+                   deadline: Optional[float] = None, hedge: Optional[bool] = None) -> str:
+        candidatos = models or self.candidates(tier)
+        hedge = HEDGING_ENABLED if hedge is None else hedge
+        kwargs = dict(system_message=system_message, text=text, images=images, task=task, session_id=session_id)
+
+        ultimo_error = None
+        i = 0
+        while i < len(candidatos):
+            if deadline is not None and deadline <= time.monotonic():
+                raise AIDeadlineExceeded(f"Tiempo límite agotado para {task}")
+            primario = candidatos[i]
+            alterno = candidatos[i + 1] if hedge and i + 1 < len(candidatos) else None
+            try:
+                if alterno:
+                    return await self._hedged(provider, primario, alterno, deadline, **kwargs)
+                return await self._attempt(provider, primario, deadline, **kwargs)
+            except AIDeadlineExceeded as e:
+                ultimo_error = e
+                if deadline is not None and deadline <= time.monotonic():
+                    raise
+            except Exception as e:
+                logger.warning(f"Modelo {primario} falló para {task}, probando el siguiente: {e}")
+                ultimo_error = e
+            i += 2 if alterno else 1
+        raise ultimo_error or RuntimeError(f"No hay modelos configurados para el nivel {tier}")
+
+    def report(self) -> Dict:
+        return {
+            "tiers": {nivel: self.candidates(nivel) for nivel in self.tiers},
+            "models": {modelo: stats.snapshot() for modelo, stats in self.stats.items()},
+        }
+
+
+ai_router = AIRouter()
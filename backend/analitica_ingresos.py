@@ -0,0 +1,236 @@
+"""
+Ingresos cobrados por día, semana o mes, desglosados por moneda (`pagos.tipo`) y método.
+
+Los montos salen de `facturas.pagos` con $unwind + $group sobre $dateTrunc en la zona
+horaria del taller. Un período cerrado no cambia, así que su resultado se guarda en
+`ingresos_periodos` (un documento por granularidad y período) y solo se agregan los
+períodos que faltan; el período en curso se calcula siempre en vivo y no se guarda.
+
+Un pago con fecha pasada cae en un período ya cerrado: `invalidar_fecha` borra los
+resúmenes que lo contienen para que se recalculen en la próxima consulta. Restaurar,
+resetear o generar datos invalida todo.
+"""
+import logging
+import os
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from pymongo import ReplaceOne
+
+logger = logging.getLogger(__name__)
+
+COLECCION = "ingresos_periodos"
+ZONA_HORARIA = os.environ.get('ANALITICA_ZONA_HORARIA', 'America/Caracas')
+GRANULARIDADES = {"dia": "day", "semana": "week", "mes": "month"}
+MAX_PERIODOS = 1500  # Unos 4 años por día
+
+
+def inicio_periodo(dia: date, granularidad: str) -> date:
+    if granularidad == "semana":
+        return dia - timedelta(days=dia.weekday())  # Semanas de lunes a domingo, igual que $dateTrunc
+    if granularidad == "mes":
+        return dia.replace(day=1)
+    return dia
+
+
+def siguiente_periodo(inicio: date, granularidad: str) -> date:
+    if granularidad == "semana":
+        return inicio + timedelta(days=7)
+    if granularidad == "mes":
+        return (inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return inicio + timedelta(days=1)
+
+
+def periodos_entre(desde: date, hasta: date, granularidad: str) -> List[date]:
+    """Inicios de los períodos que tocan el rango [desde, hasta]"""
+    periodos = []
+    actual = inicio_periodo(desde, granularidad)
+    while actual <= hasta:
+        periodos.append(actual)
+        actual = siguiente_periodo(actual, granularidad)
+    return periodos
+
+
+def dia_actual() -> date:
+    """Día en curso en la zona horaria del taller (no el día UTC)"""
+    return datetime.now(ZoneInfo(ZONA_HORARIA)).date()
+
+
+def limite_utc(dia: date) -> str:
+    """Medianoche local del día como ISO UTC, comparable con las fechas guardadas"""
+    local = datetime(dia.year, dia.month, dia.day, tzinfo=ZoneInfo(ZONA_HORARIA))
+    return local.astimezone(timezone.utc).isoformat()
+
+
+def pipeline_ingresos(desde: date, hasta_exclusivo: date, granularidad: str) -> List[Dict]:
+    rango = {"$gte": limite_utc(desde), "$lt": limite_utc(hasta_exclusivo)}
+    return [
+        {"$match": {"pagos.fecha_pago": rango}},
+        {"$project": {"_id": 0, "pagos": 1}},
+        {"$unwind": "$pagos"},
+        {"$match": {"pagos.fecha_pago": rango}},
+        {"$group": {
+            "_id": {
+                "periodo": {"$dateToString": {
+                    "format": "%Y-%m-%d",
+                    "timezone": ZONA_HORARIA,
+                    "date": {"$dateTrunc": {
+                        # Las fechas se guardan en UTC con microsegundos: basta con los primeros 19 caracteres
+                        "date": {"$dateFromString": {
+                            "dateString": {"$substrBytes": ["$pagos.fecha_pago", 0, 19]},
+                            "format": "%Y-%m-%dT%H:%M:%S",
+                            "timezone": "UTC",
+                        }},
+                        "unit": GRANULARIDADES[granularidad],
+                        "timezone": ZONA_HORARIA,
+                        "startOfWeek": "monday",
+                    }},
+                }},
+                "tipo": "$pagos.tipo",
+                "metodo": "$pagos.metodo",
+            },
+            "monto_usd": {"$sum": "$pagos.monto_usd"},
+            "monto_bs": {"$sum": "$pagos.monto_bs"},
+            "pagos": {"$sum": 1},
+        }},
+    ]
+
+
+def acumular(desglose: List[Dict]) -> Dict:
+    """Totales, subtotales por moneda y por método de un desglose (tipo, método)"""
+    desglose = sorted(desglose, key=lambda d: (d["tipo"] or "", d["metodo"] or ""))
+    por_tipo: Dict[str, Dict] = {}
+    por_metodo: Dict[str, Dict] = {}
+    for fila in desglose:
+        for agrupado, clave in ((por_tipo, fila["tipo"]), (por_metodo, fila["metodo"])):
+            acumulado = agrupado.setdefault(clave or "sin_dato", {"monto_usd": 0.0, "monto_bs": 0.0, "pagos": 0})
+            acumulado["monto_usd"] = round(acumulado["monto_usd"] + fila["monto_usd"], 2)
+            acumulado["monto_bs"] = round(acumulado["monto_bs"] + fila["monto_bs"], 2)
+            acumulado["pagos"] += fila["pagos"]
+    return {
+        "monto_usd": round(sum(f["monto_usd"] for f in desglose), 2),
+        "monto_bs": round(sum(f["monto_bs"] for f in desglose), 2),
+        "pagos": sum(f["pagos"] for f in desglose),
+        "por_tipo": por_tipo,
+        "por_metodo": por_metodo,
+        "desglose": desglose,
+    }
+
+
+def resumen_periodo(periodo: date, granularidad: str, desglose: List[Dict], cerrado: bool) -> Dict:
+    return {"granularidad": granularidad, "periodo": periodo.isoformat(), "cerrado": cerrado, **acumular(desglose)}
+
+
+async def agregar_periodos(db, periodos: List[date], granularidad: str, cerrados: bool) -> Dict[str, Dict]:
+    """Resumen de cada período pedido con una sola agregación sobre el rango que los cubre"""
+    if not periodos:
+        return {}
+    desglose: Dict[str, List[Dict]] = {p.isoformat(): [] for p in periodos}
+    pipeline = pipeline_ingresos(periodos[0], siguiente_periodo(periodos[-1], granularidad), granularidad)
+    async for fila in db.facturas.aggregate(pipeline, allowDiskUse=True):
+        clave = fila["_id"]["periodo"]
+        if clave in desglose:
+            desglose[clave].append({
+                "tipo": fila["_id"].get("tipo"),
+                "metodo": fila["_id"].get("metodo"),
+                "monto_usd": round(fila["monto_usd"], 2),
+                "monto_bs": round(fila["monto_bs"], 2),
+                "pagos": fila["pagos"],
+            })
+    return {clave: resumen_periodo(date.fromisoformat(clave), granularidad, filas, cerrados)
+            for clave, filas in desglose.items()}
+
+
+async def ingresos(db, granularidad: str, desde: date, hasta: date, hoy: Optional[date] = None) -> Dict:
+    """Serie de ingresos del rango: períodos cerrados desde el rollup, el resto agregado al momento"""
+    if granularidad not in GRANULARIDADES:
+        raise ValueError(f"Granularidad inválida. Use: {', '.join(GRANULARIDADES)}")
+    if hasta < desde:
+        raise ValueError("La fecha 'hasta' debe ser igual o posterior a 'desde'")
+    periodos = periodos_entre(desde, hasta, granularidad)
+    if len(periodos) > MAX_PERIODOS:
+        raise ValueError(f"Demasiados períodos ({len(periodos)}); use una granularidad mayor o un rango menor")
+
+    en_curso = inicio_periodo(hoy or dia_actual(), granularidad)
+    cerrados = [p for p in periodos if p < en_curso]
+    abiertos = [p for p in periodos if p >= en_curso]
+
+    guardados = {
+        r["periodo"]: r async for r in db[COLECCION].find(
+            {"granularidad": granularidad, "periodo": {"$in": [p.isoformat() for p in cerrados]}}, {"_id": 0}
+        )
+    }
+    faltantes = [p for p in cerrados if p.isoformat() not in guardados]
+    # Los faltantes suelen ser contiguos (primer uso o tras invalidar); se agregan juntos por tramos
+    calculados: Dict[str, Dict] = {}
+    for tramo in tramos_contiguos(faltantes, granularidad):
+        calculados.update(await agregar_periodos(db, tramo, granularidad, cerrados=True))
+    if calculados:
+        ahora = datetime.now(timezone.utc).isoformat()
+        await db[COLECCION].bulk_write([
+            ReplaceOne({"granularidad": granularidad, "periodo": clave}, {**resumen, "updated_at": ahora}, upsert=True)
+            for clave, resumen in calculados.items()
+        ], ordered=False)
+    # Períodos futuros del rango también se agregan en vivo (normalmente vacíos)
+    en_vivo = await agregar_periodos(db, abiertos, granularidad, cerrados=False)
+
+    serie = []
+    for periodo in periodos:
+        clave = periodo.isoformat()
+        resumen = guardados.get(clave) or calculados.get(clave) or en_vivo[clave]
+        resumen.pop("updated_at", None)
+        serie.append(resumen)
+    return {
+        "granularidad": granularidad,
+        "desde": desde.isoformat(),
+        "hasta": hasta.isoformat(),
+        "zona_horaria": ZONA_HORARIA,
+        "periodos": serie,
+        "totales": acumular(combinar_desglose(serie)),
+        "periodos_desde_rollup": len(guardados),
+        "periodos_calculados": len(calculados) + len(en_vivo),
+    }
+
+
+def tramos_contiguos(periodos: List[date], granularidad: str) -> List[List[date]]:
+    tramos: List[List[date]] = []
+    for periodo in periodos:
+        if tramos and siguiente_periodo(tramos[-1][-1], granularidad) == periodo:
+            tramos[-1].append(periodo)
+        else:
+            tramos.append([periodo])
+    return tramos
+
+
+def combinar_desglose(serie: List[Dict]) -> List[Dict]:
+    combinado: Dict[Tuple, Dict] = {}
+    for resumen in serie:
+        for fila in resumen["desglose"]:
+            clave = (fila["tipo"], fila["metodo"])
+            acumulado = combinado.setdefault(clave, {"tipo": fila["tipo"], "metodo": fila["metodo"],
+                                                     "monto_usd": 0.0, "monto_bs": 0.0, "pagos": 0})
+            acumulado["monto_usd"] = round(acumulado["monto_usd"] + fila["monto_usd"], 2)
+            acumulado["monto_bs"] = round(acumulado["monto_bs"] + fila["monto_bs"], 2)
+            acumulado["pagos"] += fila["pagos"]
+    return list(combinado.values())
+
+
+async def invalidar_fecha(db, fecha: datetime):
+    """Descarta los resúmenes (de cualquier granularidad) que contienen la fecha de un pago"""
+    if not fecha.tzinfo:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    dia = fecha.astimezone(ZoneInfo(ZONA_HORARIA)).date()
+    await db[COLECCION].delete_many({"$or": [
+        {"granularidad": granularidad, "periodo": inicio_periodo(dia, granularidad).isoformat()}
+        for granularidad in GRANULARIDADES
+    ]})
+
+
+async def invalidar_todo(db):
+    await db[COLECCION].delete_many({})
+
+
+async def crear_indices(db):
+    await db[COLECCION].create_index([("granularidad", 1), ("periodo", 1)], unique=True)
+    await db.facturas.create_index("pagos.fecha_pago")
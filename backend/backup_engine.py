@@ -0,0 +1,646 @@
+"""
+Motor de backups en disco.
+
+Cada colección se recorre con un cursor por lotes y se escribe comprimida (gzip o zstd)
+como NDJSON (Extended JSON) o BSON concatenado. El resultado es un archivo .tar con
+un manifest.json (conteos y sha256 por colección) más un manifiesto gemelo junto al
+archivo para listar backups sin abrirlos. Nada se carga completo en memoria.
+
+Backups incrementales y diferenciales: cada escritura del servidor mantiene `updated_at`
+y los borrados dejan una lápida en `eliminaciones`. Un incremental guarda solo lo
+modificado desde la marca de agua del backup anterior de la cadena (un diferencial,
+desde la del backup completo base). Restaurar reproduce la base y luego cada eslabón.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import bson
+from bson import json_util
+from bson.json_util import JSONOptions, JSONMode
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+import analitica_ingresos
+import cuentas_por_cobrar
+import resumen_clientes
+from admin_tasks import ejecutar_por_coleccion
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = Path(os.environ.get('BACKUP_DIR', Path(__file__).parent / 'backups'))
+BACKUP_BATCH_SIZE = int(os.environ.get('BACKUP_BATCH_SIZE', '500'))
+
+# Extended JSON relajado: conserva ObjectId y fechas sin perder legibilidad
+EJSON_OPTIONS = JSONOptions(json_mode=JSONMode.RELAXED, tz_aware=True)
+
+FORMATOS = {"ndjson", "bson"}
+TIPOS = {"completo", "incremental", "diferencial"}
+COLECCION_ELIMINACIONES = "eliminaciones"
+COMPRESIONES = {"gzip": "gz", "zstd": "zst"}
+
+
+class HashingWriter:
+    """Envuelve un archivo y acumula sha256 y tamaño de lo escrito (bytes comprimidos)"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+    def close(self):
+        self.raw.close()
+
+
+def abrir_escritor(path: Path, compresion: str):
+    """Devuelve (escritor_comprimido, hashing_writer)"""
+    hashing = HashingWriter(open(path, 'wb'))
+    if compresion == "gzip":
+        return gzip.GzipFile(fileobj=hashing, mode='wb', compresslevel=6), hashing
+    if compresion == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            hashing.close()
+            raise ValueError("Compresión zstd no disponible: instale el paquete 'zstandard'")
+        return zstandard.ZstdCompressor(level=3).stream_writer(hashing, closefd=False), hashing
+    hashing.close()
+    raise ValueError(f"Compresión no soportada: {compresion}")
+
+
+def abrir_lector(fileobj, compresion: str):
+    """Lector descomprimido en streaming sobre un archivo (o miembro de tar)"""
+    if compresion == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compresion == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    raise ValueError(f"Compresión no soportada: {compresion}")
+
+
+def serializar_lote(documentos: List[Dict], formato: str) -> bytes:
+    if formato == "bson":
+        return b''.join(bson.encode(doc) for doc in documentos)
+    return b''.join(
+        json_util.dumps(doc, json_options=EJSON_OPTIONS).encode('utf-8') + b'\n' for doc in documentos
+    )
+
+
+def escribir_lote(escritor, documentos: List[Dict], formato: str):
+    escritor.write(serializar_lote(documentos, formato))
+
+
+def iterar_documentos(lector, formato: str):
+    """Itera los documentos de un lector descomprimido sin cargar el archivo completo"""
+    if formato == "bson":
+        yield from bson.decode_file_iter(lector)
+        return
+    for linea in lector:
+        linea = linea.strip()
+        if linea:
+            yield json_util.loads(linea, json_options=EJSON_OPTIONS)
+
+
+def nombre_miembro(coleccion: str, formato: str, compresion: str) -> str:
+    return f"{coleccion}.{formato}.{COMPRESIONES[compresion]}"
+
+
+class BackupJob:
+    """Estado y progreso de un backup ejecutándose en segundo plano"""
+
+    def __init__(self, colecciones: List[str], formato: str = "ndjson", compresion: str = "gzip"):
+        self.id = f"backup-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.colecciones = colecciones
+        self.formato = formato
+        self.compresion = compresion
+        self.estado = "pendiente"  # pendiente, en_progreso, completado, error
+        self.progreso: Dict[str, Dict[str, Any]] = {
+            c: {"documentos": 0, "estimado": None, "segundos": None} for c in colecciones
+        }
+        self.archivo: Optional[str] = None
+        self.manifest: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.iniciado = datetime.now(timezone.utc)
+        # Todo lo modificado después de este instante lo recoge el siguiente incremental
+        self.watermark = self.iniciado.isoformat()
+        self.finalizado: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def documentos_procesados(self) -> int:
+        return sum(p["documentos"] for p in self.progreso.values())
+
+    def porcentaje(self) -> Optional[float]:
+        estimados = [p["estimado"] for p in self.progreso.values()]
+        if any(e is None for e in estimados):
+            return None
+        total = sum(estimados)
+        if total == 0:
+            return 100.0 if self.estado == "completado" else 0.0
+        return round(min(100.0, 100.0 * self.documentos_procesados / total), 1)
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "estado": self.estado,
+            "formato": self.formato,
+            "compresion": self.compresion,
+            "colecciones": self.colecciones,
+            "progreso": self.progreso,
+            "documentos_procesados": self.documentos_procesados,
+            "porcentaje": self.porcentaje(),
+            "archivo": self.archivo,
+            "error": self.error,
+            "iniciado": self.iniciado.isoformat(),
+            "finalizado": self.finalizado.isoformat() if self.finalizado else None,
+        }
+
+
+BACKUP_JOBS: Dict[str, BackupJob] = {}
+
+
+async def volcar_coleccion(db, job: BackupJob, coleccion: str, directorio: Path,
+                           filtro: Optional[Dict] = None) -> Dict:
+    """Escribe una colección comprimida por lotes y devuelve su entrada del manifiesto"""
+    inicio = time.monotonic()
+    progreso = job.progreso[coleccion]
+    if filtro:
+        # Incremental: el conteo usa el índice sobre updated_at
+        progreso["estimado"] = await db[coleccion].count_documents(filtro)
+    else:
+        progreso["estimado"] = await db[coleccion].estimated_document_count()
+
+    miembro = nombre_miembro(coleccion, job.formato, job.compresion)
+    escritor, hashing = abrir_escritor(directorio / miembro, job.compresion)
+    try:
+        lote: List[Dict] = []
+        async for documento in db[coleccion].find(filtro or {}).batch_size(BACKUP_BATCH_SIZE):
+            lote.append(documento)
+            if len(lote) >= BACKUP_BATCH_SIZE:
+                # Serializar y comprimir fuera del event loop
+                await asyncio.to_thread(escribir_lote, escritor, lote, job.formato)
+                progreso["documentos"] += len(lote)
+                lote = []
+        if lote:
+            await asyncio.to_thread(escribir_lote, escritor, lote, job.formato)
+            progreso["documentos"] += len(lote)
+    finally:
+        await asyncio.to_thread(escritor.close)
+        hashing.close()
+
+    progreso["segundos"] = round(time.monotonic() - inicio, 3)
+    return {
+        "coleccion": coleccion,
+        "archivo": miembro,
+        # Definiciones de índices para recrearlos al restaurar
+        "indices": json.loads(json_util.dumps(await db[coleccion].index_information())),
+        "documentos": progreso["documentos"],
+        "bytes": hashing.size,
+        "sha256": hashing.sha256.hexdigest(),
+    }
+
+
+def empaquetar(directorio: Path, manifest: Dict, destino: Path) -> str:
+    """Crea el .tar (manifest primero) a partir de los archivos ya comprimidos; devuelve su sha256"""
+    manifest_bytes = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+    (directorio / "manifest.json").write_bytes(manifest_bytes)
+    with tarfile.open(destino, 'w') as tar:
+        tar.add(directorio / "manifest.json", arcname="manifest.json")
+        for entrada in manifest["colecciones"]:
+            tar.add(directorio / entrada["archivo"], arcname=entrada["archivo"])
+
+    sha = hashlib.sha256()
+    with open(destino, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+
+async def ejecutar_backup(db, job: BackupJob, extra_manifest: Optional[Dict] = None,
+                          filtros: Optional[Dict[str, Dict]] = None):
+    """Ejecuta el backup completo del job y deja el archivo y su manifiesto en BACKUP_DIR"""
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    directorio = BACKUP_DIR / f".{job.id}.tmp"
+    directorio.mkdir(parents=True, exist_ok=True)
+    job.estado = "en_progreso"
+    try:
+        # Colecciones en paralelo acotado; el progreso y el tiempo de cada una quedan en job.progreso
+        resultados = await ejecutar_por_coleccion(
+            job.colecciones,
+            lambda coleccion: volcar_coleccion(db, job, coleccion, directorio, (filtros or {}).get(coleccion))
+        )
+        entradas = [r["resultado"] for r in resultados]
+
+        manifest = {
+            "id": job.id,
+            "timestamp": job.iniciado.isoformat(),
+            "watermark": job.watermark,
+            "tipo": "completo",
+            "formato": job.formato,
+            "compresion": job.compresion,
+            "colecciones": entradas,
+            "total_documents": sum(e["documentos"] for e in entradas),
+            **(extra_manifest or {}),
+        }
+        destino = BACKUP_DIR / f"{job.id}.tar"
+        manifest["archivo_sha256"] = await asyncio.to_thread(empaquetar, directorio, manifest, destino)
+        manifest["archivo_bytes"] = destino.stat().st_size
+        (BACKUP_DIR / f"{job.id}.manifest.json").write_text(
+            json.dumps(manifest, ensure_ascii=False, indent=2), encoding='utf-8'
+        )
+
+        job.archivo = destino.name
+        job.manifest = manifest
+        job.estado = "completado"
+    except Exception as e:
+        logger.error(f"Error en backup {job.id}: {e}")
+        job.estado = "error"
+        job.error = str(e)
+    finally:
+        job.finalizado = datetime.now(timezone.utc)
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+def planificar_incremental(tipo: str, colecciones: List[str], base_id: Optional[str] = None):
+    """
+    Para un backup incremental o diferencial devuelve (extra_manifest, filtros, colecciones).
+    El incremental parte del último backup de la cadena; el diferencial, del completo base.
+    """
+    manifiestos = [m for m in listar_backups() if m.get("watermark") or m.get("timestamp")]
+    restaurado = ultima_restauracion()
+    if restaurado:
+        # Los backups anteriores a la última restauración ya no describen la base de datos
+        manifiestos = [m for m in manifiestos if (m.get("watermark") or m["timestamp"]) > restaurado]
+    if base_id:
+        base = next((m for m in manifiestos if m["id"] == base_id), None)
+        if not base or base.get("tipo", "completo") != "completo":
+            raise ValueError(f"El backup base {base_id} no existe o no es completo")
+    else:
+        base = next((m for m in manifiestos if m.get("tipo", "completo") == "completo"), None)
+        if not base:
+            raise ValueError("No hay un backup completo (posterior a la última restauración) sobre el cual construir la cadena")
+
+    if tipo == "diferencial":
+        padre = base
+    else:
+        # listar_backups está ordenado del más reciente al más antiguo
+        padre = next(m for m in manifiestos if m["id"] == base["id"] or m.get("base_id") == base["id"])
+
+    desde = padre.get("watermark") or padre["timestamp"]
+    filtro = {"updated_at": {"$gt": desde}}
+    colecciones = [c for c in colecciones if c != COLECCION_ELIMINACIONES] + [COLECCION_ELIMINACIONES]
+    extra = {"tipo": tipo, "base_id": base["id"], "parent_id": padre["id"], "desde": desde}
+    return extra, {c: filtro for c in colecciones}, colecciones
+
+
+def iniciar_backup(db, colecciones: List[str], formato: str = "ndjson", compresion: str = "gzip",
+                   extra_manifest: Optional[Dict] = None, tipo: str = "completo",
+                   base_id: Optional[str] = None) -> BackupJob:
+    """Registra el job y lanza el backup como tarea en segundo plano"""
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato no soportado: {formato}")
+    if compresion not in COMPRESIONES:
+        raise ValueError(f"Compresión no soportada: {compresion}")
+    if tipo not in TIPOS:
+        raise ValueError(f"Tipo de backup no soportado: {tipo}")
+
+    filtros = None
+    extra_manifest = dict(extra_manifest or {})
+    if tipo != "completo":
+        extra_cadena, filtros, colecciones = planificar_incremental(tipo, colecciones, base_id)
+        extra_manifest.update(extra_cadena)
+
+    job = BackupJob(colecciones, formato, compresion)
+    BACKUP_JOBS[job.id] = job
+    job.task = asyncio.create_task(ejecutar_backup(db, job, extra_manifest, filtros))
+    return job
+
+
+def listar_backups() -> List[Dict]:
+    """Manifiestos de los backups en disco, del más reciente al más antiguo"""
+    if not BACKUP_DIR.exists():
+        return []
+    manifiestos = []
+    for path in BACKUP_DIR.glob("*.manifest.json"):
+        try:
+            manifiestos.append(json.loads(path.read_text(encoding='utf-8')))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Manifiesto ilegible {path}: {e}")
+    return sorted(manifiestos, key=lambda m: m.get("timestamp", ""), reverse=True)
+
+
+def ruta_backup(backup_id: str) -> Optional[Path]:
+    # Evitar rutas fuera de BACKUP_DIR
+    if '/' in backup_id or '\\' in backup_id or backup_id.startswith('.'):
+        return None
+    path = BACKUP_DIR / f"{backup_id}.tar"
+    return path if path.exists() else None
+
+
+def leer_manifiesto(backup_id: str) -> Optional[Dict]:
+    if '/' in backup_id or '\\' in backup_id or backup_id.startswith('.'):
+        return None
+    path = BACKUP_DIR / f"{backup_id}.manifest.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding='utf-8'))
+
+
+def resolver_cadena(backup_id: str) -> List[Dict]:
+    """Manifiestos desde el backup completo base hasta backup_id, en orden de aplicación"""
+    cadena = []
+    actual = leer_manifiesto(backup_id)
+    if not actual:
+        raise ValueError(f"Backup no encontrado: {backup_id}")
+    while True:
+        cadena.append(actual)
+        if actual.get("tipo", "completo") == "completo":
+            break
+        padre = leer_manifiesto(actual["parent_id"])
+        if not padre:
+            raise ValueError(f"Cadena rota: falta el backup {actual['parent_id']}")
+        actual = padre
+    return list(reversed(cadena))
+
+
+def _siguiente_lote(iterador, tamaño: int) -> List[Dict]:
+    lote = []
+    for documento in iterador:
+        lote.append(documento)
+        if len(lote) >= tamaño:
+            break
+    return lote
+
+
+async def iterar_lotes_archivo(path: Path, manifest: Dict, entrada: Dict, tamaño: int = BACKUP_BATCH_SIZE):
+    """Genera lotes de documentos de una colección del archivo, leyendo fuera del event loop"""
+    tar = await asyncio.to_thread(tarfile.open, path, 'r')
+    try:
+        miembro = await asyncio.to_thread(tar.extractfile, entrada["archivo"])
+        lector = abrir_lector(miembro, manifest.get("compresion", "gzip"))
+        iterador = iterar_documentos(lector, manifest.get("formato", "ndjson"))
+        while True:
+            lote = await asyncio.to_thread(_siguiente_lote, iterador, tamaño)
+            if not lote:
+                break
+            yield lote
+    finally:
+        tar.close()
+
+
+async def iterar_lotes_lista(documentos: List[Dict], tamaño: int = BACKUP_BATCH_SIZE):
+    for i in range(0, len(documentos), tamaño):
+        yield documentos[i:i + tamaño]
+
+
+def leer_manifiesto_archivo(path: Path) -> Dict:
+    with tarfile.open(path, 'r') as tar:
+        miembro = tar.extractfile("manifest.json")
+        if miembro is None:
+            raise ValueError("El archivo no contiene manifest.json")
+        return json.loads(miembro.read().decode('utf-8'))
+
+
+class RestoreJob(BackupJob):
+    """Estado y progreso de una restauración en segundo plano"""
+
+    def __init__(self, colecciones: Optional[List[str]] = None):
+        super().__init__(colecciones or [])
+        self.id = self.id.replace("backup-", "restore-", 1)
+        self.cadena: List[str] = []
+
+    def registrar_coleccion(self, coleccion: str):
+        if coleccion not in self.progreso:
+            self.colecciones.append(coleccion)
+            self.progreso[coleccion] = {"documentos": 0, "estimado": None, "segundos": None}
+        self.progreso[coleccion].setdefault("errores", 0)
+        return self.progreso[coleccion]
+
+    def to_dict(self) -> Dict:
+        return {**super().to_dict(), "cadena": self.cadena}
+
+
+async def recrear_indices(coleccion, indices: Dict[str, Dict]):
+    """Crea en `coleccion` las definiciones de índices capturadas con index_information()"""
+    for nombre, info in indices.items():
+        if nombre == "_id_":
+            continue
+        opciones = {k: v for k, v in info.items() if k not in ("key", "v", "ns")}
+        # Desde el manifiesto JSON las claves llegan como listas [campo, dirección]
+        claves = [tuple(clave) for clave in info["key"]]
+        await coleccion.create_index(claves, name=nombre, **opciones)
+
+
+def lapida(coleccion: str, documento_id: Optional[str] = None, ahora: Optional[str] = None) -> Dict:
+    """Documento de `eliminaciones` para un borrado; sin documento_id indica que se vació la colección"""
+    ahora = ahora or datetime.now(timezone.utc).isoformat()
+    return {"id": str(uuid.uuid4()), "coleccion": coleccion, "documento_id": documento_id,
+            "deleted_at": ahora, "updated_at": ahora}
+
+
+async def reconstruir_coleccion(db, nombre: str) -> int:
+    """
+    Elimina la colección y la recrea con las mismas definiciones de índices; devuelve cuántos
+    documentos tenía. Un drop es una sola operación en el oplog, a diferencia de delete_many
+    que escribe una por documento.
+    """
+    coleccion = db[nombre]
+    indices = await coleccion.index_information()
+    total = await coleccion.estimated_document_count()
+    await coleccion.drop()
+    await db.create_collection(nombre)
+    await recrear_indices(coleccion, indices)
+    return total
+
+
+async def restaurar_coleccion_staging(db, job: RestoreJob, coleccion: str, lotes,
+                                     indices_backup: Optional[Dict[str, Dict]] = None) -> int:
+    """
+    Carga los lotes en una colección temporal con insert_many(ordered=False), recrea los
+    índices de la colección original y la renombra sobre ella de forma atómica.
+    Si algo falla, la colección original queda intacta.
+    """
+    inicio = time.monotonic()
+    progreso = job.registrar_coleccion(coleccion)
+    staging = f"{coleccion}__restore_{uuid.uuid4().hex[:8]}"
+    # Índices guardados en el backup más los que ya tenga la colección actual
+    indices = {**(indices_backup or {}), **await db[coleccion].index_information()}
+    try:
+        async for lote in lotes:
+            try:
+                await db[staging].insert_many(lote, ordered=False)
+                progreso["documentos"] += len(lote)
+            except BulkWriteError as e:
+                # Sin orden, los documentos válidos del lote se insertan igual
+                progreso["documentos"] += e.details.get("nInserted", 0)
+                progreso["errores"] += len(e.details.get("writeErrors", []))
+        if progreso["documentos"] == 0:
+            await db.create_collection(staging)
+        await recrear_indices(db[staging], indices)
+        await db[staging].rename(coleccion, dropTarget=True)
+    except BaseException:
+        await db[staging].drop()
+        raise
+    progreso["segundos"] = round(time.monotonic() - inicio, 3)
+    return progreso["documentos"]
+
+
+async def aplicar_incremento(db, job: RestoreJob, path: Path, manifest: Dict,
+                             colecciones: Optional[List[str]] = None) -> Dict[str, int]:
+    """Aplica un eslabón incremental: primero las lápidas y luego los upserts por _id"""
+    aplicados: Dict[str, int] = {}
+    entradas = {e["coleccion"]: e for e in manifest["colecciones"]}
+
+    # Las lápidas van primero: los documentos del incremento son el estado vigente
+    if COLECCION_ELIMINACIONES in entradas:
+        async for lote in iterar_lotes_archivo(path, manifest, entradas[COLECCION_ELIMINACIONES]):
+            for lapida in sorted(lote, key=lambda l: l.get("deleted_at", "")):
+                coleccion = lapida.get("coleccion")
+                if not coleccion or (colecciones and coleccion not in colecciones):
+                    continue
+                if lapida.get("documento_id"):
+                    await db[coleccion].delete_one({"id": lapida["documento_id"]})
+                else:
+                    await db[coleccion].delete_many({})
+
+    for coleccion, entrada in entradas.items():
+        if coleccion == COLECCION_ELIMINACIONES or (colecciones and coleccion not in colecciones):
+            continue
+        progreso = job.registrar_coleccion(coleccion)
+        aplicados[coleccion] = 0
+        async for lote in iterar_lotes_archivo(path, manifest, entrada):
+            operaciones = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in lote]
+            await db[coleccion].bulk_write(operaciones, ordered=False)
+            aplicados[coleccion] += len(lote)
+            progreso["documentos"] += len(lote)
+    return aplicados
+
+
+async def aplicar_completo(db, job: RestoreJob, path: Path, manifest: Dict,
+                           colecciones: Optional[List[str]] = None) -> Dict[str, int]:
+    """Reemplaza cada colección por su contenido en el backup completo"""
+    aplicados: Dict[str, int] = {}
+    for entrada in manifest["colecciones"]:
+        coleccion = entrada["coleccion"]
+        if colecciones and coleccion not in colecciones:
+            continue
+        job.registrar_coleccion(coleccion)["estimado"] = entrada.get("documentos")
+        aplicados[coleccion] = await restaurar_coleccion_staging(
+            db, job, coleccion, iterar_lotes_archivo(path, manifest, entrada), entrada.get("indices")
+        )
+    return aplicados
+
+
+async def aplicar_json_legado(db, job: RestoreJob, path: Path, colecciones: Optional[List[str]] = None):
+    """Backups .json del formato anterior ({"backup_data": {coleccion: [docs]}})"""
+    contenido = await asyncio.to_thread(path.read_text, encoding='utf-8')
+    datos = json_util.loads(contenido, json_options=EJSON_OPTIONS)
+    datos = datos.get("backup_data", datos)
+    aplicados = {}
+    for coleccion, documentos in datos.items():
+        if not isinstance(documentos, list) or (colecciones and coleccion not in colecciones):
+            continue
+        for doc in documentos:
+            # Los backups JSON antiguos guardaban _id como texto
+            doc.pop('_id', None)
+        job.registrar_coleccion(coleccion)["estimado"] = len(documentos)
+        aplicados[coleccion] = await restaurar_coleccion_staging(db, job, coleccion, iterar_lotes_lista(documentos))
+    return aplicados
+
+
+ULTIMA_RESTAURACION = "ultima_restauracion.json"
+
+
+def marcar_restauracion(job: RestoreJob):
+    """Una restauración rompe las cadenas incrementales anteriores: el próximo incremental
+    necesitará un backup completo posterior a este instante"""
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    (BACKUP_DIR / ULTIMA_RESTAURACION).write_text(
+        json.dumps({"id": job.id, "timestamp": datetime.now(timezone.utc).isoformat()}), encoding='utf-8'
+    )
+
+
+def ultima_restauracion() -> Optional[str]:
+    path = BACKUP_DIR / ULTIMA_RESTAURACION
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding='utf-8')).get("timestamp")
+
+
+async def ejecutar_restauracion(db, job: RestoreJob, archivo: Optional[Path] = None,
+                                backup_id: Optional[str] = None, colecciones: Optional[List[str]] = None,
+                                borrar_archivo: bool = False):
+    """Restaura un archivo subido o la cadena de un backup en disco"""
+    job.estado = "en_progreso"
+    try:
+        if archivo is not None and archivo.suffix == ".json":
+            job.cadena = [archivo.name]
+            await aplicar_json_legado(db, job, archivo, colecciones)
+        else:
+            if archivo is not None:
+                pasos = [(archivo, await asyncio.to_thread(leer_manifiesto_archivo, archivo))]
+            else:
+                pasos = []
+                for manifest in resolver_cadena(backup_id):
+                    path = ruta_backup(manifest["id"])
+                    if not path:
+                        raise ValueError(f"Falta el archivo del backup {manifest['id']}")
+                    pasos.append((path, manifest))
+            job.cadena = [m["id"] for _, m in pasos]
+            for path, manifest in pasos:
+                if manifest.get("tipo", "completo") == "completo":
+                    await aplicar_completo(db, job, path, manifest, colecciones)
+                else:
+                    await aplicar_incremento(db, job, path, manifest, colecciones)
+        if "facturas" in job.progreso:
+            # Las vistas derivadas de facturas se recalculan con lo restaurado
+            await cuentas_por_cobrar.reconstruir(db)
+            await analitica_ingresos.invalidar_todo(db)
+        if "facturas" in job.progreso or "ordenes_trabajo" in job.progreso:
+            await resumen_clientes.reconstruir(db)
+        marcar_restauracion(job)
+        job.estado = "completado"
+    except Exception as e:
+        logger.error(f"Error en restauración {job.id}: {e}")
+        job.estado = "error"
+        job.error = str(e)
+    finally:
+        job.finalizado = datetime.now(timezone.utc)
+        if borrar_archivo and archivo is not None:
+            archivo.unlink(missing_ok=True)
+
+
+def iniciar_restauracion(db, archivo: Optional[Path] = None, backup_id: Optional[str] = None,
+                         colecciones: Optional[List[str]] = None, borrar_archivo: bool = False) -> RestoreJob:
+    job = RestoreJob()
+    BACKUP_JOBS[job.id] = job
+    job.task = asyncio.create_task(
+        ejecutar_restauracion(db, job, archivo, backup_id, colecciones, borrar_archivo)
+    )
+    return job
+
+
+def ruta_subida(nombre_original: str) -> Path:
+    """Ruta temporal para un archivo de restauración subido, conservando su extensión"""
+    directorio = BACKUP_DIR / "subidas"
+    directorio.mkdir(parents=True, exist_ok=True)
+    extension = ".json" if nombre_original.lower().endswith(".json") else ".tar"
+    return directorio / f"{uuid.uuid4().hex}{extension}"
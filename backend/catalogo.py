@@ -0,0 +1,146 @@
+"""
+Precios de presupuestos calculados en el servidor desde una instantánea del catálogo.
+
+`servicios_repuestos` se mantiene en memoria como una instantánea inmutable y versionada:
+un dict id -> ItemCatalogo compacto (tipo, nombre, precio, activo). Cada cambio crea una
+instantánea nueva con versión + 1 en lugar de modificar la actual, así que una cotización
+en curso ve siempre un catálogo coherente y puede informar con qué versión se calculó.
+
+Cotizar no consulta Mongo: los endpoints de catálogo de este proceso aplican sus cambios
+a la instantánea al momento, y una tarea en segundo plano compara cada
+CATALOGO_REFRESCO_SEGUNDOS una marca barata (cantidad estimada + último updated_at) para
+recoger lo que escriban otros procesos o una restauración.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CATALOGO_REFRESCO_SEGUNDOS = float(os.environ.get('CATALOGO_REFRESCO_SEGUNDOS', '30'))
+IVA_PORCENTAJE = 16.0
+
+
+class ItemCatalogo(NamedTuple):
+    id: str
+    tipo: str
+    nombre: str
+    precio: float
+    activo: bool
+
+
+class SnapshotCatalogo(NamedTuple):
+    version: int
+    items: Dict[str, ItemCatalogo]
+
+
+def item_desde_documento(documento: Dict) -> ItemCatalogo:
+    return ItemCatalogo(
+        id=documento["id"],
+        tipo=documento.get("tipo", "servicio"),
+        nombre=documento.get("nombre", ""),
+        precio=float(documento.get("precio") or 0.0),
+        activo=documento.get("activo", True),  # Los datos de ejemplo antiguos no traen el campo
+    )
+
+
+class CatalogoPrecios:
+    """Instantánea del catálogo y motor de cotización"""
+
+    def __init__(self):
+        self.snapshot = SnapshotCatalogo(0, {})
+        self.marca: Optional[Tuple] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def cargado(self) -> bool:
+        return self.marca is not None
+
+    def reemplazar(self, items: Dict[str, ItemCatalogo]):
+        self.snapshot = SnapshotCatalogo(self.snapshot.version + 1, items)
+
+    async def marca_actual(self, db) -> Tuple:
+        ultimo = await db.servicios_repuestos.find_one({}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)])
+        return await db.servicios_repuestos.estimated_document_count(), (ultimo or {}).get("updated_at")
+
+    async def cargar(self, db):
+        marca = await self.marca_actual(db)
+        documentos = await db.servicios_repuestos.find(
+            {}, {"_id": 0, "id": 1, "tipo": 1, "nombre": 1, "precio": 1, "activo": 1}
+        ).to_list(None)
+        self.reemplazar({d["id"]: item_desde_documento(d) for d in documentos if d.get("id")})
+        self.marca = marca
+        logger.info(f"Catálogo cargado: {len(documentos)} ítems (versión {self.snapshot.version})")
+
+    async def refrescar_si_cambio(self, db):
+        if await self.marca_actual(db) != self.marca:
+            await self.cargar(db)
+
+    def actualizar_item(self, documento: Dict):
+        """Aplica a la instantánea un ítem creado o modificado por este proceso"""
+        # La marca guardada queda vieja a propósito: el próximo chequeo recarga una vez y se alinea
+        self.reemplazar({**self.snapshot.items, documento["id"]: item_desde_documento(documento)})
+
+    def quitar_item(self, item_id: str):
+        items = dict(self.snapshot.items)
+        items.pop(item_id, None)
+        self.reemplazar(items)
+
+    def cotizar(self, lineas: List[Tuple[str, int]], iva_porcentaje: float = IVA_PORCENTAJE) -> Dict:
+        """
+        Precio de cada línea (id de catálogo, cantidad) con la instantánea actual.
+        Devuelve los ítems listos para el presupuesto, los totales con IVA y los errores por línea.
+        """
+        snapshot = self.snapshot
+        items, errores = [], []
+        for indice, (item_id, cantidad) in enumerate(lineas):
+            item = snapshot.items.get(item_id)
+            if item is None:
+                errores.append({"linea": indice, "catalogo_id": item_id, "motivo": "Ítem no encontrado en el catálogo"})
+            elif not item.activo:
+                errores.append({"linea": indice, "catalogo_id": item_id, "motivo": f"{item.nombre} no está activo"})
+            elif cantidad <= 0:
+                errores.append({"linea": indice, "catalogo_id": item_id, "motivo": "La cantidad debe ser mayor que cero"})
+            else:
+                items.append({
+                    "catalogo_id": item.id,
+                    "tipo": item.tipo,
+                    "descripcion": item.nombre,
+                    "cantidad": cantidad,
+                    "precio_unitario_usd": item.precio,
+                    "total_usd": round(item.precio * cantidad, 2),
+                })
+        return {"catalogo_version": snapshot.version, "items": items, "errores": errores,
+                **totales(items, iva_porcentaje)}
+
+
+def totales(items: List[Dict], iva_porcentaje: float = IVA_PORCENTAJE) -> Dict[str, float]:
+    subtotal = round(sum(item["total_usd"] for item in items), 2)
+    iva = round(subtotal * iva_porcentaje / 100, 2)
+    return {"subtotal_usd": subtotal, "iva_porcentaje": iva_porcentaje, "iva_usd": iva, "total_usd": round(subtotal + iva, 2)}
+
+
+CATALOGO = CatalogoPrecios()
+
+
+async def refrescar_periodicamente(db):
+    while True:
+        await asyncio.sleep(CATALOGO_REFRESCO_SEGUNDOS)
+        try:
+            await CATALOGO.refrescar_si_cambio(db)
+        except Exception as e:
+            logger.error(f"Error refrescando el catálogo: {e}")
+
+
+async def iniciar(db):
+    """Carga la instantánea y arranca el refresco en segundo plano"""
+    await CATALOGO.cargar(db)
+    if CATALOGO.task is None or CATALOGO.task.done():
+        CATALOGO.task = asyncio.create_task(refrescar_periodicamente(db))
+
+
+def detener():
+    if CATALOGO.task is not None:
+        CATALOGO.task.cancel()
+        CATALOGO.task = None
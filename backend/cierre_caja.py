@@ -0,0 +1,163 @@
+"""
+Cierre de caja diario.
+
+Los pagos del día (`facturas.pagos`, filtrados por el índice de `pagos.fecha_pago`) se
+agrupan por moneda y método, con el IGTF cobrado, y se comparan con lo que declara el
+cajero. El resultado queda en `cierres_caja` como una foto inmutable: un documento por
+día (índice único sobre `fecha`) que no se modifica ni se vuelve a calcular. Los reportes
+de días cerrados leen esa foto; solo el día abierto se agrega en vivo.
+
+IGTF cobrado: cada pago lleva la parte proporcional del IGTF de su factura
+(monto_usd * igtf_usd / (total_usd + igtf_usd)), de modo que una factura saldada suma
+exactamente su IGTF aunque se haya pagado en varias partes.
+"""
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+from pymongo.errors import DuplicateKeyError
+
+from analitica_ingresos import ZONA_HORARIA, limite_utc
+
+COLECCION = "cierres_caja"
+TOLERANCIA = 0.01  # Diferencias menores se consideran cuadradas
+
+
+class CierreExistente(Exception):
+    pass
+
+
+def dia_local(momento: datetime) -> date:
+    if not momento.tzinfo:
+        momento = momento.replace(tzinfo=timezone.utc)
+    return momento.astimezone(ZoneInfo(ZONA_HORARIA)).date()
+
+
+def hoy() -> date:
+    return datetime.now(ZoneInfo(ZONA_HORARIA)).date()
+
+
+def pipeline_pagos_del_dia(dia: date) -> List[Dict]:
+    rango = {"$gte": limite_utc(dia), "$lt": limite_utc(dia + timedelta(days=1))}
+    return [
+        {"$match": {"pagos.fecha_pago": rango}},
+        {"$project": {"_id": 0, "pagos": 1, "total_usd": 1, "igtf_usd": 1, "tasa_cambio": 1}},
+        {"$unwind": "$pagos"},
+        {"$match": {"pagos.fecha_pago": rango}},
+        {"$set": {"fraccion_igtf": {"$cond": [
+            {"$gt": [{"$ifNull": ["$igtf_usd", 0]}, 0]},
+            {"$divide": ["$igtf_usd", {"$add": ["$total_usd", "$igtf_usd"]}]},
+            0
+        ]}}},
+        {"$group": {
+            "_id": {"tipo": "$pagos.tipo", "metodo": "$pagos.metodo"},
+            "pagos": {"$sum": 1},
+            "monto_usd": {"$sum": "$pagos.monto_usd"},
+            "monto_bs": {"$sum": "$pagos.monto_bs"},
+            "igtf_usd": {"$sum": {"$multiply": ["$pagos.monto_usd", "$fraccion_igtf"]}},
+            "igtf_bs": {"$sum": {"$multiply": ["$pagos.monto_usd", "$fraccion_igtf", "$tasa_cambio"]}},
+        }},
+        {"$sort": {"_id.tipo": 1, "_id.metodo": 1}},
+    ]
+
+
+def clave_metodo(tipo: str, metodo: str) -> str:
+    return f"{tipo}:{metodo}"
+
+
+async def resumen_del_dia(db, dia: date, declarado: Optional[Dict[str, float]] = None) -> Dict:
+    """
+    Pagos del día por moneda y método con lo esperado (en la moneda del pago: Bs o USD)
+    y, si se indica lo declarado por el cajero (clave "tipo:metodo"), la diferencia.
+    """
+    declarado = dict(declarado or {})
+    metodos = []
+    async for fila in db.facturas.aggregate(pipeline_pagos_del_dia(dia)):
+        tipo, metodo = fila["_id"].get("tipo"), fila["_id"].get("metodo")
+        esperado = fila["monto_usd"] if tipo == "dolares" else fila["monto_bs"]
+        metodos.append({
+            "tipo": tipo,
+            "metodo": metodo,
+            "moneda": "USD" if tipo == "dolares" else "Bs",
+            "pagos": fila["pagos"],
+            "monto_usd": round(fila["monto_usd"], 2),
+            "monto_bs": round(fila["monto_bs"], 2),
+            "igtf_usd": round(fila["igtf_usd"], 2),
+            "igtf_bs": round(fila["igtf_bs"], 2),
+            "esperado": round(esperado, 2),
+            "declarado": declarado.pop(clave_metodo(tipo, metodo), None),
+        })
+    # Lo declarado en métodos sin movimientos del sistema también se reporta (esperado 0)
+    for clave, monto in declarado.items():
+        tipo, _, metodo = clave.partition(":")
+        metodos.append({
+            "tipo": tipo, "metodo": metodo, "moneda": "USD" if tipo == "dolares" else "Bs", "pagos": 0,
+            "monto_usd": 0.0, "monto_bs": 0.0, "igtf_usd": 0.0, "igtf_bs": 0.0, "esperado": 0.0, "declarado": monto,
+        })
+    for item in metodos:
+        item["diferencia"] = None if item["declarado"] is None else round(item["declarado"] - item["esperado"], 2)
+
+    diferencias = [m["diferencia"] for m in metodos if m["diferencia"] is not None]
+    return {
+        "fecha": dia.isoformat(),
+        "zona_horaria": ZONA_HORARIA,
+        "metodos": metodos,
+        "totales": {
+            campo: round(sum(m[campo] for m in metodos), 2)
+            for campo in ("monto_usd", "monto_bs", "igtf_usd", "igtf_bs")
+        } | {"pagos": sum(m["pagos"] for m in metodos)},
+        "cuadrado": all(abs(d) < TOLERANCIA for d in diferencias) if diferencias else None,
+    }
+
+
+async def obtener_cierre(db, dia: date) -> Optional[Dict]:
+    return await db[COLECCION].find_one({"fecha": dia.isoformat()}, {"_id": 0})
+
+
+async def cerrar_dia(db, dia: date, declarado: Dict[str, float], cajero: Optional[str] = None,
+                     observaciones: Optional[str] = None) -> Dict:
+    """Calcula el resumen del día y lo guarda como cierre inmutable; falla si el día ya se cerró"""
+    if dia > hoy():
+        raise ValueError("No se puede cerrar un día futuro")
+    if await obtener_cierre(db, dia):
+        raise CierreExistente(f"El {dia.isoformat()} ya tiene cierre de caja")
+
+    ahora = datetime.now(timezone.utc).isoformat()
+    cierre = {
+        "id": str(uuid.uuid4()),
+        **await resumen_del_dia(db, dia, declarado),
+        "cajero": cajero,
+        "observaciones": observaciones,
+        "created_at": ahora,
+        "updated_at": ahora,
+    }
+    try:
+        await db[COLECCION].insert_one(cierre)
+    except DuplicateKeyError:
+        # Dos cierres simultáneos del mismo día: gana el primero
+        raise CierreExistente(f"El {dia.isoformat()} ya tiene cierre de caja")
+    cierre.pop("_id", None)
+    return cierre
+
+
+async def resumen_o_cierre(db, dia: date) -> Dict:
+    """Día cerrado: la foto guardada; día abierto: agregado en vivo"""
+    cierre = await obtener_cierre(db, dia)
+    if cierre:
+        return {"cerrado": True, **cierre}
+    return {"cerrado": False, **await resumen_del_dia(db, dia)}
+
+
+async def listar_cierres(db, desde: date, hasta: date) -> List[Dict]:
+    return await db[COLECCION].find(
+        {"fecha": {"$gte": desde.isoformat(), "$lte": hasta.isoformat()}}, {"_id": 0}
+    ).sort("fecha", 1).to_list(None)
+
+
+async def dia_cerrado(db, momento: datetime) -> bool:
+    return await db[COLECCION].find_one({"fecha": dia_local(momento).isoformat()}, {"_id": 1}) is not None
+
+
+async def crear_indices(db):
+    await db[COLECCION].create_index("fecha", unique=True)
@@ -0,0 +1,272 @@
+"""
+Conciliación de un extracto bancario (CSV) contra las referencias de `facturas.pagos`.
+
+El CSV se lee en streaming por lotes de CONCILIACION_BATCH_SIZE líneas. Por cada lote se
+hace una sola consulta `$in` sobre `pagos.referencia_norm` (índice multikey) y los pagos
+encontrados se guardan en un dict referencia -> pagos; las referencias ya vistas en el
+extracto viven en un set de la importación. Así cada línea se resuelve en O(1) en memoria
+y un extracto de 50k líneas son unas pocas decenas de consultas.
+
+Resultados por línea:
+    conciliado          referencia y monto coinciden con un único pago
+    monto_distinto      la referencia existe pero el monto difiere
+    sin_pago            la referencia no está registrada en ningún pago
+    duplicada_extracto  la referencia ya apareció antes en el mismo extracto
+    duplicada_sistema   la referencia está en más de un pago registrado
+Además se listan los pagos con referencia del período del extracto que no aparecieron en él;
+las fechas del extracto son días locales del taller.
+
+Las referencias se comparan normalizadas de los dos lados (sin espacios, mayúsculas, sin
+ceros a la izquierda). Cada pago guarda `referencia_norm` al registrarse; los pagos
+anteriores la reciben con `completar_referencias_norm`, y mientras tanto también se
+buscan por `pagos.referencia` con las variantes de la referencia del extracto.
+
+Nota: MongoDB no admite índices hashed sobre arrays, por eso el índice es multikey
+ascendente y el "hash" es el dict en memoria de cada importación.
+"""
+import asyncio
+import csv
+import io
+import os
+import re
+from datetime import date, timedelta
+from typing import Dict, IO, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+from analitica_ingresos import limite_utc
+
+CONCILIACION_BATCH_SIZE = int(os.environ.get('CONCILIACION_BATCH_SIZE', '5000'))
+MAX_DETALLES = 500  # Por categoría, para que la respuesta no crezca con el extracto
+TOLERANCIA = 0.01
+FECHA_ISO = re.compile(r"^\d{4}-\d{2}-\d{2}")  # Solo con fechas ISO se puede acotar el período del extracto
+MILES_CON_PUNTO = re.compile(r"^[-+]?\d{1,3}(\.\d{3})+$")  # 1.500 o 1.500.000, sin decimales
+ESTADOS = ["conciliado", "monto_distinto", "sin_pago", "duplicada_extracto", "duplicada_sistema"]
+COLUMNAS = {
+    "referencia": {"referencia", "ref", "nro_referencia", "numero_referencia", "reference"},
+    "monto": {"monto", "importe", "amount", "credito", "abono"},
+    "fecha": {"fecha", "date", "fecha_operacion"},
+    "descripcion": {"descripcion", "concepto", "description"},
+}
+
+
+def normalizar_referencia(referencia) -> str:
+    """Sin espacios, en mayúsculas y sin ceros a la izquierda (los bancos suelen rellenar)"""
+    texto = re.sub(r"\s+", "", str(referencia or "")).upper()
+    return texto.lstrip("0") or texto[:1]
+
+
+def variantes_referencia(referencia: str) -> Set[str]:
+    """Formas en que la referencia puede estar guardada en pagos sin `referencia_norm`"""
+    texto = re.sub(r"\s+", "", str(referencia or ""))
+    return {texto, texto.upper(), texto.lstrip("0") or texto[:1]} - {""}
+
+
+def parse_monto(valor, moneda: str = "bolivares") -> Optional[float]:
+    """
+    Monto del extracto en formato venezolano (1.234,56) o anglosajón (1,234.56). Sin coma, un
+    punto seguido de exactamente tres dígitos es de miles en Bs ("1.500" son 1500) y decimal en
+    USD; con varios puntos ("1.500.000") siempre es de miles.
+    """
+    texto = str(valor or "").strip().replace(" ", "")
+    if not texto:
+        return None
+    if MILES_CON_PUNTO.match(texto) and (moneda == "bolivares" or texto.count(".") > 1):
+        texto = texto.replace(".", "")
+    elif "," in texto and "." in texto:
+        # El separador que aparece último es el decimal: 1.234,56 o 1,234.56
+        texto = texto.replace(".", "").replace(",", ".") if texto.rfind(",") > texto.rfind(".") else texto.replace(",", "")
+    elif "," in texto:
+        texto = texto.replace(",", ".")
+    try:
+        return float(texto)
+    except ValueError:
+        return None
+
+
+def abrir_csv(binario: IO[bytes]) -> Tuple[csv.DictReader, Dict[str, Optional[str]]]:
+    """Lector del extracto (separador , ; o tabulador) y el nombre real de cada columna conocida"""
+    texto = io.TextIOWrapper(binario, encoding="utf-8-sig", errors="replace", newline="")
+    muestra = texto.read(4096)
+    texto.seek(0)
+    try:
+        dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+    except csv.Error:
+        dialecto = csv.excel
+    lector = csv.DictReader(texto, dialect=dialecto)
+    encabezados = {c: (c or "").strip().lower().replace(" ", "_") for c in lector.fieldnames or []}
+    mapa = {}
+    for campo, alias in COLUMNAS.items():
+        mapa[campo] = next((original for original, limpio in encabezados.items() if limpio in alias), None)
+    if not mapa["referencia"] or not mapa["monto"]:
+        raise ValueError("El extracto debe tener columnas de referencia y monto")
+    return lector, mapa
+
+
+def leer_lote(lector: csv.DictReader, mapa: Dict[str, Optional[str]], cantidad: int,
+              moneda: str = "bolivares") -> List[Dict]:
+    lote = []
+    for fila in lector:
+        lote.append({
+            "linea": lector.line_num,
+            "referencia": (fila.get(mapa["referencia"]) or "").strip(),
+            "monto": parse_monto(fila.get(mapa["monto"]), moneda),
+            "fecha": (fila.get(mapa["fecha"]) or "").strip() if mapa["fecha"] else None,
+            "descripcion": (fila.get(mapa["descripcion"]) or "").strip() if mapa["descripcion"] else None,
+        })
+        if len(lote) >= cantidad:
+            break
+    return lote
+
+
+def referencia_norm_de(pago: Dict) -> Optional[str]:
+    if not pago.get("referencia"):
+        return None
+    return pago.get("referencia_norm") or normalizar_referencia(pago["referencia"])
+
+
+async def pagos_por_referencia(db, referencias: Set[str]) -> Dict[str, List[Dict]]:
+    """Pagos registrados cuyas referencias están en el lote, agrupados por referencia normalizada"""
+    claves = {normalizar_referencia(referencia) for referencia in referencias}
+    variantes = set()
+    for referencia in referencias:
+        variantes |= variantes_referencia(referencia)
+    encontrados: Dict[str, List[Dict]] = {}
+    cursor = db.facturas.find(
+        {"$or": [
+            {"pagos.referencia_norm": {"$in": list(claves)}},
+            {"pagos.referencia": {"$in": list(variantes)}},  # Pagos aún sin referencia_norm
+        ]},
+        {"_id": 0, "id": 1, "numero_factura": 1, "pagos": 1}
+    )
+    async for factura in cursor:
+        for pago in factura.get("pagos", []):
+            clave = referencia_norm_de(pago)
+            if clave in claves:
+                encontrados.setdefault(clave, []).append({
+                    "factura_id": factura["id"],
+                    "numero_factura": factura.get("numero_factura"),
+                    "referencia": pago["referencia"],
+                    "tipo": pago.get("tipo"),
+                    "metodo": pago.get("metodo"),
+                    "monto_bs": pago.get("monto_bs"),
+                    "monto_usd": pago.get("monto_usd"),
+                    "fecha_pago": pago.get("fecha_pago"),
+                })
+    return encontrados
+
+
+def monto_del_pago(pago: Dict, moneda: str) -> float:
+    return pago.get("monto_usd" if moneda == "dolares" else "monto_bs") or 0.0
+
+
+async def conciliar(db, archivo: IO[bytes], moneda: str = "bolivares") -> Dict:
+    """Concilia el extracto; `moneda` indica si los montos del banco son Bs ("bolivares") o USD ("dolares")"""
+    lector, mapa = await asyncio.to_thread(abrir_csv, archivo)
+    vistas: Set[str] = set()
+    conteo = {estado: 0 for estado in ESTADOS}
+    detalles: Dict[str, List[Dict]] = {estado: [] for estado in ESTADOS if estado != "conciliado"}
+    lineas = sin_referencia = 0
+    fechas: List[str] = []
+
+    while True:
+        lote = await asyncio.to_thread(leer_lote, lector, mapa, CONCILIACION_BATCH_SIZE, moneda)
+        if not lote:
+            break
+        lineas += len(lote)
+        pendientes = {l["referencia"] for l in lote if l["referencia"] and normalizar_referencia(l["referencia"]) not in vistas}
+        registrados = await pagos_por_referencia(db, pendientes) if pendientes else {}
+
+        for linea in lote:
+            if not linea["referencia"]:
+                sin_referencia += 1
+                continue
+            if linea["fecha"] and FECHA_ISO.match(linea["fecha"]):
+                fechas.append(linea["fecha"][:10])
+            clave = normalizar_referencia(linea["referencia"])
+            pagos = registrados.get(clave, [])
+            if clave in vistas:
+                estado = "duplicada_extracto"
+            elif len(pagos) > 1:
+                estado = "duplicada_sistema"
+            elif not pagos:
+                estado = "sin_pago"
+            elif linea["monto"] is None or abs(monto_del_pago(pagos[0], moneda) - linea["monto"]) > TOLERANCIA:
+                estado = "monto_distinto"
+            else:
+                estado = "conciliado"
+            vistas.add(clave)
+            conteo[estado] += 1
+            if estado != "conciliado" and len(detalles[estado]) < MAX_DETALLES:
+                detalles[estado].append({**linea, "pagos": pagos})
+        # Solo se conservan las fechas extremas
+        if fechas:
+            fechas = [min(fechas), max(fechas)]
+
+    return {
+        "lineas": lineas,
+        "lineas_sin_referencia": sin_referencia,
+        "moneda": moneda,
+        "conteo": conteo,
+        "detalles": detalles,
+        "periodo_extracto": {"desde": fechas[0], "hasta": fechas[-1]} if fechas else None,
+        "pagos_sin_movimiento": await pagos_sin_movimiento(db, fechas, vistas, moneda),
+    }
+
+
+async def pagos_sin_movimiento(db, fechas: List[str], vistas: Set[str], moneda: str) -> List[Dict]:
+    """Pagos con referencia del período del extracto que el banco no reporta"""
+    if not fechas:
+        return []
+    # Días locales del extracto convertidos a límites UTC, como se guarda fecha_pago
+    rango = {
+        "$gte": limite_utc(date.fromisoformat(fechas[0])),
+        "$lt": limite_utc(date.fromisoformat(fechas[-1]) + timedelta(days=1)),
+    }
+    faltantes = []
+    pipeline = [
+        {"$match": {"pagos.fecha_pago": rango}},
+        {"$project": {"_id": 0, "id": 1, "numero_factura": 1, "pagos": 1}},
+        {"$unwind": "$pagos"},
+        {"$match": {"pagos.fecha_pago": rango, "pagos.tipo": moneda, "pagos.referencia": {"$nin": [None, ""]}}},
+    ]
+    async for fila in db.facturas.aggregate(pipeline):
+        pago = fila["pagos"]
+        if referencia_norm_de(pago) not in vistas:
+            faltantes.append({
+                "factura_id": fila["id"], "numero_factura": fila.get("numero_factura"),
+                "referencia": pago["referencia"], "metodo": pago.get("metodo"),
+                "monto": monto_del_pago(pago, moneda), "fecha_pago": pago.get("fecha_pago"),
+            })
+            if len(faltantes) >= MAX_DETALLES:
+                break
+    return faltantes
+
+
+async def completar_referencias_norm(db, lote: int = 1000) -> int:
+    """Agrega `referencia_norm` a los pagos con referencia que no la tienen; devuelve cuántos pagos"""
+    operaciones, total = [], 0
+    cursor = db.facturas.find(
+        {"pagos": {"$elemMatch": {"referencia": {"$nin": [None, ""]}, "referencia_norm": {"$exists": False}}}},
+        {"_id": 0, "id": 1, "pagos.referencia": 1, "pagos.referencia_norm": 1}
+    )
+    async for factura in cursor:
+        for indice, pago in enumerate(factura.get("pagos", [])):
+            if pago.get("referencia") and not pago.get("referencia_norm"):
+                # Los pagos solo se agregan al final, así que el índice identifica el pago;
+                # la referencia en el filtro evita escribir sobre otro si la lista cambió
+                operaciones.append(UpdateOne(
+                    {"id": factura["id"], f"pagos.{indice}.referencia": pago["referencia"]},
+                    {"$set": {f"pagos.{indice}.referencia_norm": normalizar_referencia(pago["referencia"])}}
+                ))
+        if len(operaciones) >= lote:
+            total += (await db.facturas.bulk_write(operaciones, ordered=False)).modified_count
+            operaciones = []
+    if operaciones:
+        total += (await db.facturas.bulk_write(operaciones, ordered=False)).modified_count
+    return total
+
+
+async def crear_indices(db):
+    await db.facturas.create_index("pagos.referencia")
+    await db.facturas.create_index("pagos.referencia_norm")
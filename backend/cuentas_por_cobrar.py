@@ -0,0 +1,221 @@
+"""
+Vista materializada de cuentas por cobrar para el reporte de antigüedad de saldos.
+
+Un documento por cliente en `cuentas_por_cobrar` con sus facturas abiertas:
+    {"cliente_id": ..., "facturas": {<factura_id>: {"saldo_bs", "saldo_usd", "fecha", "version"}}}
+
+Cada escritura de factura (creación, pago, revalorización) actualiza la entrada de esa
+factura con su saldo absoluto, solo si la versión es igual o más nueva que la guardada,
+así que aplicar dos veces el mismo cambio o recibirlos desordenados no descuadra la vista.
+Las facturas saldadas se quitan del mapa. El reporte recorre un documento por cliente y
+calcula los tramos con la fecha de corte, sin leer la colección de facturas.
+
+Reconstrucción completa (tras restaurar un backup o para reparar la vista):
+    python cuentas_por_cobrar.py
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+COLECCION = "cuentas_por_cobrar"
+# (clave, día mínimo, día máximo) según los días transcurridos desde la fecha de facturación
+TRAMOS = [("0_30", 0, 30), ("31_60", 31, 60), ("61_90", 61, 90), ("90_mas", 91, None)]
+LOTE_CLIENTES = 1000
+
+
+def operacion_cuenta(factura: Dict) -> UpdateOne:
+    """Upsert de la entrada de una factura, ignorado si la vista ya tiene una versión más nueva"""
+    campo = f"facturas.{factura['id']}"
+    version = factura.get("version") or 0
+    filtro = {
+        "cliente_id": factura["cliente_id"],
+        "$or": [{campo: {"$exists": False}}, {f"{campo}.version": {"$lte": version}}],
+    }
+    ahora = datetime.now(timezone.utc).isoformat()
+    if factura.get("saldo_pendiente_bs", 0) <= 0:
+        # Saldada: sin upsert, un cliente sin cuenta no necesita documento
+        return UpdateOne(filtro, {"$unset": {campo: ""}, "$set": {"updated_at": ahora}})
+
+    total_final_usd = factura.get("total_usd", 0.0) + factura.get("igtf_usd", 0.0)
+    pagado_usd = sum(p.get("monto_usd", 0.0) for p in factura.get("pagos", []))
+    return UpdateOne(filtro, {"$set": {
+        campo: {
+            "saldo_bs": factura["saldo_pendiente_bs"],
+            "saldo_usd": round(max(0.0, total_final_usd - pagado_usd), 2),
+            "fecha": factura.get("fecha_facturacion"),
+            "version": version,
+        },
+        "updated_at": ahora,
+    }}, upsert=True)
+
+
+async def actualizar_cuentas(db, facturas: List[Dict]):
+    """Refleja en la vista el estado actual de una o más facturas"""
+    if not facturas:
+        return
+    try:
+        await db[COLECCION].bulk_write([operacion_cuenta(f) for f in facturas], ordered=False)
+    except BulkWriteError as e:
+        # Un upsert choca con el índice único cuando la vista ya tenía una versión más nueva: se descarta
+        otros = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+        if otros:
+            raise
+
+
+async def actualizar_cuenta(db, factura: Dict):
+    try:
+        await actualizar_cuentas(db, [factura])
+    except Exception as e:
+        # La factura ya quedó escrita; la vista se repara con la reconstrucción completa
+        logger.error(f"No se pudo actualizar cuentas por cobrar de la factura {factura.get('id')}: {e}")
+
+
+async def reconstruir(db) -> int:
+    """Recalcula la vista completa desde facturas y la reemplaza con $out; devuelve cuántos clientes quedan"""
+    await db.facturas.aggregate([
+        {"$match": {"saldo_pendiente_bs": {"$gt": 0}}},
+        {"$group": {
+            "_id": "$cliente_id",
+            "facturas": {"$push": {
+                "k": "$id",
+                "v": {
+                    "saldo_bs": "$saldo_pendiente_bs",
+                    "saldo_usd": {"$max": [0, {"$subtract": [
+                        {"$add": ["$total_usd", {"$ifNull": ["$igtf_usd", 0]}]},
+                        {"$sum": {"$ifNull": ["$pagos.monto_usd", []]}}
+                    ]}]},
+                    "fecha": "$fecha_facturacion",
+                    "version": {"$ifNull": ["$version", 0]},
+                }
+            }}
+        }},
+        {"$project": {
+            "_id": 0,
+            "cliente_id": "$_id",
+            "facturas": {"$arrayToObject": "$facturas"},
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }},
+        # $out reemplaza la colección de una vez y conserva sus índices
+        {"$out": COLECCION},
+    ], allowDiskUse=True).to_list(None)
+    await crear_indices(db)
+    return await db[COLECCION].count_documents({})
+
+
+async def crear_indices(db):
+    await db[COLECCION].create_index("cliente_id", unique=True)
+
+
+def tramo_para(dias: int) -> str:
+    for clave, minimo, maximo in TRAMOS:
+        if dias >= minimo and (maximo is None or dias <= maximo):
+            return clave
+    return TRAMOS[0][0]  # Fechas futuras cuentan como corrientes
+
+
+def parse_fecha(valor) -> Optional[datetime]:
+    if isinstance(valor, datetime):
+        fecha = valor
+    elif isinstance(valor, str):
+        try:
+            fecha = datetime.fromisoformat(valor)
+        except ValueError:
+            return None
+    else:
+        return None
+    return fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc)
+
+
+def tramos_vacios() -> Dict[str, float]:
+    return {clave: 0.0 for clave, _, _ in TRAMOS}
+
+
+async def reporte_antiguedad(db, fecha_corte: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Saldos pendientes en Bs por cliente y tramo de antigüedad a la fecha de corte.
+    Los saldos son los actuales (la vista no guarda historia): la fecha de corte solo define
+    la antigüedad, y las facturas emitidas después del corte no se incluyen.
+    """
+    fecha_corte = fecha_corte or datetime.now(timezone.utc)
+    if not fecha_corte.tzinfo:
+        fecha_corte = fecha_corte.replace(tzinfo=timezone.utc)
+
+    clientes: List[Dict[str, Any]] = []
+    totales = tramos_vacios()
+    total_usd = 0.0
+    async for cuenta in db[COLECCION].find({}, {"_id": 0}):
+        tramos = tramos_vacios()
+        saldo_usd = 0.0
+        facturas_abiertas = 0
+        for entrada in (cuenta.get("facturas") or {}).values():
+            fecha = parse_fecha(entrada.get("fecha"))
+            if fecha and fecha > fecha_corte:
+                continue  # Emitida después del corte
+            facturas_abiertas += 1
+            dias = (fecha_corte - fecha).days if fecha else 0
+            tramos[tramo_para(dias)] += entrada.get("saldo_bs", 0.0)
+            saldo_usd += entrada.get("saldo_usd", 0.0)
+        total = sum(tramos.values())
+        if total <= 0:
+            continue
+        for clave in tramos:
+            totales[clave] += tramos[clave]
+        total_usd += saldo_usd
+        clientes.append({
+            "cliente_id": cuenta["cliente_id"],
+            "facturas_abiertas": facturas_abiertas,
+            "tramos_bs": {clave: round(valor, 2) for clave, valor in tramos.items()},
+            "total_bs": round(total, 2),
+            "total_usd": round(saldo_usd, 2),
+        })
+
+    # Nombres de clientes por lotes con $in, no uno por uno
+    for inicio in range(0, len(clientes), LOTE_CLIENTES):
+        lote = clientes[inicio:inicio + LOTE_CLIENTES]
+        nombres = {
+            c["id"]: c async for c in db.clientes.find(
+                {"id": {"$in": [c["cliente_id"] for c in lote]}},
+                {"_id": 0, "id": 1, "nombre": 1, "prefijo_documento": 1, "numero_documento": 1}
+            )
+        }
+        for item in lote:
+            cliente = nombres.get(item["cliente_id"], {})
+            item["cliente_nombre"] = cliente.get("nombre")
+            item["documento"] = f"{cliente.get('prefijo_documento', '')}-{cliente.get('numero_documento', '')}" if cliente else None
+
+    clientes.sort(key=lambda c: c["total_bs"], reverse=True)
+    return {
+        "fecha_corte": fecha_corte.isoformat(),
+        "saldos_al": datetime.now(timezone.utc).isoformat(),  # Los saldos son los actuales, no los del corte
+        "tramos": [clave for clave, _, _ in TRAMOS],
+        "clientes": clientes,
+        "totales_bs": {clave: round(valor, 2) for clave, valor in totales.items()},
+        "total_bs": round(sum(totales.values()), 2),
+        "total_usd": round(total_usd, 2),
+    }
+
+
+async def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    try:
+        print("🔄 Reconstruyendo cuentas por cobrar...")
+        clientes = await reconstruir(client[os.environ.get('DB_NAME', 'taller_mecanico')])
+        print(f"✅ {clientes} clientes con saldo pendiente")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
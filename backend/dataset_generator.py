@@ -0,0 +1,713 @@
+"""
+Generador determinista de datos sintéticos para pruebas de rendimiento.
+
+Con la misma semilla, la misma cantidad de clientes y la misma fecha final produce
+exactamente los mismos documentos (ids, matrículas, montos, fechas y numeración);
+solo `updated_at` toma la hora de la ejecución para que los backups incrementales los vean.
+
+Los clientes se generan por bloques en un hilo aparte y cada bloque se inserta con
+insert_many(ordered=False) en lotes paralelos, con un máximo de lotes en vuelo para
+que la memoria no crezca con el tamaño del dataset (~20 documentos por cliente).
+
+Uso por línea de comandos (lee MONGO_URL y DB_NAME de backend/.env):
+    python dataset_generator.py --clientes 65000 --semilla 42 [--vaciar]
+
+Solo genera sobre colecciones vacías; con --vaciar (o vaciar=true en la API) las vacía antes.
+"""
+import argparse
+import asyncio
+import bisect
+import logging
+import os
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import analitica_ingresos
+import backup_engine
+import cierre_caja
+import cuentas_por_cobrar
+import flujo_ordenes
+import resumen_clientes
+from conciliacion import normalizar_referencia
+
+logger = logging.getLogger(__name__)
+
+COLECCIONES_SINTETICAS = [
+    "tasas_cambio", "mecanicos", "servicios_repuestos", "clientes", "vehiculos",
+    "ordenes_trabajo", "historial_kilometraje", "presupuestos", "facturas"
+]
+# Derivadas de las órdenes y los pagos (eventos, fotos de cierre de caja): se vacían junto con el dataset
+COLECCIONES_DEPENDIENTES = [flujo_ordenes.COLECCION, cierre_caja.COLECCION]
+
+CLIENTES_POR_BLOQUE = 500
+IVA_PORCENTAJE = 16.0
+IGTF_PORCENTAJE = 0.03
+TASA_INICIAL = 36.5
+
+NOMBRES = [
+    "CARLOS", "MARÍA", "JOSÉ", "ANA", "LUIS", "CARMEN", "JUAN", "ROSA", "PEDRO", "LUISA",
+    "JORGE", "ELENA", "MIGUEL", "PATRICIA", "RAFAEL", "GABRIELA", "ANDRÉS", "DANIELA", "RICARDO", "VALENTINA"
+]
+APELLIDOS = [
+    "RODRÍGUEZ", "GONZÁLEZ", "PÉREZ", "HERNÁNDEZ", "GARCÍA", "MARTÍNEZ", "LÓPEZ", "RAMÍREZ",
+    "SÁNCHEZ", "TORRES", "DÍAZ", "MENDOZA", "ROJAS", "MORENO", "SUÁREZ", "CASTILLO"
+]
+EMPRESAS = [
+    "TRANSPORTES", "DISTRIBUIDORA", "INVERSIONES", "CONSTRUCTORA", "ALIMENTOS", "SERVICIOS", "LOGÍSTICA"
+]
+CIUDADES = [
+    "CARACAS", "VALENCIA", "MARACAIBO", "BARQUISIMETO", "MARACAY", "PUERTO LA CRUZ", "MÉRIDA", "SAN CRISTÓBAL"
+]
+PREFIJOS_TELEFONO = ["0412", "0414", "0416", "0424", "0426", "0212", "0241", "0261"]
+
+MARCAS_MODELOS = {
+    "TOYOTA": ["COROLLA", "HILUX", "FORTUNER", "YARIS", "LAND CRUISER"],
+    "CHEVROLET": ["AVEO", "OPTRA", "SPARK", "SILVERADO", "NPR"],
+    "FORD": ["FIESTA", "FOCUS", "EXPLORER", "F-150", "ECOSPORT"],
+    "HYUNDAI": ["ACCENT", "ELANTRA", "TUCSON", "GETZ"],
+    "MITSUBISHI": ["LANCER", "MONTERO", "L200"],
+    "RENAULT": ["LOGAN", "SANDERO", "CLIO"],
+    "KIA": ["RIO", "PICANTO", "SPORTAGE"],
+}
+COLORES = ["BLANCO", "NEGRO", "GRIS", "PLATA", "AZUL", "ROJO", "VERDE", "BEIGE"]
+COMBUSTIBLES = [("GASOLINA", 85), ("DIESEL", 12), ("GNV", 3)]
+ESPECIALIDADES = ["motor", "transmision", "frenos", "electricidad", "suspension"]
+ESTADOS_MECANICO = [("disponible", 85), ("vacaciones", 8), ("fuera_servicio", 5), ("inactivo", 2)]
+
+CATALOGO_BASE = [
+    ("servicio", "CAMBIO DE ACEITE Y FILTRO", 25.0),
+    ("servicio", "ALINEACIÓN Y BALANCEO", 30.0),
+    ("servicio", "DIAGNÓSTICO COMPUTARIZADO", 20.0),
+    ("servicio", "REPARACIÓN DE FRENOS", 40.0),
+    ("servicio", "MANTENIMIENTO PREVENTIVO", 60.0),
+    ("servicio", "CAMBIO DE CORREA DE TIEMPO", 90.0),
+    ("servicio", "REPARACIÓN DE TREN DELANTERO", 120.0),
+    ("servicio", "LIMPIEZA DE INYECTORES", 35.0),
+    ("servicio", "REVISIÓN ELÉCTRICA", 25.0),
+    ("servicio", "RECTIFICACIÓN DE MOTOR", 450.0),
+    ("repuesto", "FILTRO DE ACEITE", 12.0),
+    ("repuesto", "FILTRO DE AIRE", 15.0),
+    ("repuesto", "PASTILLAS DE FRENO DELANTERAS", 45.0),
+    ("repuesto", "DISCOS DE FRENO", 80.0),
+    ("repuesto", "BATERÍA 12V", 110.0),
+    ("repuesto", "BUJÍAS (JUEGO)", 28.0),
+    ("repuesto", "CORREA DE TIEMPO", 55.0),
+    ("repuesto", "AMORTIGUADOR", 70.0),
+    ("repuesto", "BOMBA DE AGUA", 65.0),
+    ("repuesto", "ACEITE 15W40 (GALÓN)", 22.0),
+]
+
+FALLAS = [
+    "RUIDO EN FRENOS DELANTEROS", "PÉRDIDA DE POTENCIA", "RECALENTAMIENTO DEL MOTOR",
+    "VIBRACIÓN AL FRENAR", "FALLA EN ENCENDIDO", "FUGA DE ACEITE", "LUZ DE CHECK ENCENDIDA",
+    "MANTENIMIENTO PREVENTIVO", "RUIDO EN SUSPENSIÓN", "BATERÍA DESCARGADA"
+]
+
+# Flujo de una orden; las recientes pueden estar en cualquier etapa, las viejas casi siempre entregadas
+ESTADOS_ORDEN = ["recibido", "diagnosticando", "presupuestado", "aprobado", "en_reparacion", "terminado", "entregado"]
+PESOS_ORDEN_RECIENTE = [8, 8, 12, 8, 14, 15, 35]
+PESOS_ORDEN_ANTIGUA = [0, 0, 2, 0, 1, 2, 95]
+DIAS_ORDEN_RECIENTE = 21
+
+METODOS_PAGO = {
+    "bolivares": ["pago_movil", "transferencia", "tarjeta_debito", "tarjeta_credito", "efectivo"],
+    "dolares": ["zelle", "efectivo", "transferencia_internacional"],
+}
+METODOS_SIN_REFERENCIA = {"efectivo"}
+
+
+def uuid_determinista(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def elegir_ponderado(rng: random.Random, opciones: List[Tuple[Any, int]]):
+    valores, pesos = zip(*opciones)
+    return rng.choices(valores, weights=pesos)[0]
+
+
+def matricula_desde_indice(indice: int) -> str:
+    """Matrícula única por índice: ABC123 admite 26³ × 1000 vehículos distintos"""
+    numero = indice % 1000
+    letras = indice // 1000
+    a, resto = divmod(letras, 26 * 26)
+    b, c = divmod(resto, 26)
+    return f"{chr(65 + a % 26)}{chr(65 + b)}{chr(65 + c)}{numero:03d}"
+
+
+def telefono(rng: random.Random) -> str:
+    return f"{rng.choice(PREFIJOS_TELEFONO)}-{rng.randint(100, 999)}.{rng.randint(10, 99)}.{rng.randint(10, 99)}"
+
+
+class GeneradorDatos:
+    """Produce los documentos de cada colección con la forma de los modelos del servidor"""
+
+    def __init__(self, clientes: int, semilla: int = 42, fecha_fin: Optional[datetime] = None,
+                 dias_historia: int = 730):
+        self.clientes = clientes
+        self.semilla = semilla
+        if fecha_fin is None:
+            fecha_fin = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.fecha_fin = fecha_fin if fecha_fin.tzinfo else fecha_fin.replace(tzinfo=timezone.utc)
+        self.fecha_inicio = self.fecha_fin - timedelta(days=dias_historia)
+        self.updated_at = datetime.now(timezone.utc).isoformat()
+
+        # Numeración correlativa; los bloques se generan en orden para que sea determinista
+        self.vehiculos_generados = 0
+        self.presupuestos_generados = 0
+        self.facturas_generadas = 0
+
+        rng = self._rng("base")
+        self.tasas = self._serie_tasas(rng)
+        self.fechas_tasas = [fecha for fecha, _ in self.tasas]
+        self.mecanicos = self._mecanicos(rng, max(3, clientes // 200))
+        self.catalogo = self._catalogo(rng, max(len(CATALOGO_BASE), min(2000, clientes // 50)))
+
+    def _rng(self, etiqueta: str) -> random.Random:
+        # Semilla en texto: random la convierte con sha512, estable entre ejecuciones
+        return random.Random(f"{self.semilla}:{etiqueta}")
+
+    def _fecha(self, rng: random.Random, desde: datetime, hasta: datetime) -> datetime:
+        segundos = max(0, int((hasta - desde).total_seconds()))
+        return desde + timedelta(seconds=rng.randint(0, segundos))
+
+    def _serie_tasas(self, rng: random.Random) -> List[Tuple[datetime, float]]:
+        """Una tasa por semana con devaluación gradual"""
+        tasas = []
+        fecha, tasa = self.fecha_inicio, TASA_INICIAL
+        while fecha <= self.fecha_fin:
+            tasas.append((fecha, round(tasa, 2)))
+            tasa *= 1 + rng.uniform(0.002, 0.015)
+            fecha += timedelta(days=7)
+        return tasas
+
+    def tasa_en(self, fecha: datetime) -> float:
+        """Tasa vigente en una fecha (búsqueda binaria sobre la serie semanal)"""
+        indice = bisect.bisect_right(self.fechas_tasas, fecha) - 1
+        return self.tasas[max(0, indice)][1]
+
+    def _mecanicos(self, rng: random.Random, cantidad: int) -> List[Dict]:
+        mecanicos = []
+        for _ in range(cantidad):
+            numero = telefono(rng)
+            estado = elegir_ponderado(rng, ESTADOS_MECANICO)
+            mecanicos.append({
+                "id": uuid_determinista(rng),
+                "nombre": f"{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)}",
+                "especialidad": rng.choice(ESPECIALIDADES),
+                "telefono": numero,
+                "whatsapp": numero,
+                "avatar": "",
+                "estado": estado,
+                "activo": estado != "inactivo",
+                "ubicacion_actual": None,
+                "ultimo_acceso": None,
+                "created_at": self.fecha_inicio.isoformat(),
+                "updated_at": self.updated_at,
+            })
+        return mecanicos
+
+    def _catalogo(self, rng: random.Random, cantidad: int) -> List[Dict]:
+        catalogo = []
+        marcas = list(MARCAS_MODELOS)
+        for i in range(cantidad):
+            tipo, nombre, precio = CATALOGO_BASE[i % len(CATALOGO_BASE)]
+            if i >= len(CATALOGO_BASE):
+                # Variantes por marca del mismo servicio o repuesto
+                nombre = f"{nombre} {marcas[(i // len(CATALOGO_BASE)) % len(marcas)]} #{i // len(CATALOGO_BASE)}"
+                precio = precio * rng.uniform(0.8, 1.4)
+            catalogo.append({
+                "id": uuid_determinista(rng),
+                "tipo": tipo,
+                "nombre": nombre,
+                "descripcion": nombre.capitalize(),
+                "precio": round(precio, 2),
+                "activo": rng.random() > 0.03,
+                "created_at": self.fecha_inicio.isoformat(),
+                "updated_at": self.updated_at,
+            })
+        return catalogo
+
+    def documentos_fijos(self) -> Dict[str, List[Dict]]:
+        """Tasas de cambio, mecánicos y catálogo (independientes de los clientes)"""
+        rng = self._rng("tasas")
+        tasas = []
+        for i, (fecha, tasa) in enumerate(self.tasas):
+            tasas.append({
+                "id": uuid_determinista(rng),
+                "tasa_bs_usd": tasa,
+                "fecha_actualizacion": fecha.isoformat(),
+                "usuario_actualizacion": "sistema",
+                "observaciones": "TASA SINTÉTICA",
+                "activa": i == len(self.tasas) - 1,
+                "created_at": fecha.isoformat(),
+                "updated_at": self.updated_at,
+            })
+        return {"tasas_cambio": tasas, "mecanicos": self.mecanicos, "servicios_repuestos": self.catalogo}
+
+    def bloques(self, tamano: int = CLIENTES_POR_BLOQUE) -> Iterator[Tuple[int, int, int]]:
+        """(índice de bloque, primer cliente, último cliente + 1)"""
+        for numero, inicio in enumerate(range(0, self.clientes, tamano)):
+            yield numero, inicio, min(inicio + tamano, self.clientes)
+
+    def bloque(self, numero: int, inicio: int, fin: int) -> Dict[str, List[Dict]]:
+        """Genera los clientes [inicio, fin) con todo su historial"""
+        rng = self._rng(f"bloque-{numero}")
+        docs: Dict[str, List[Dict]] = {c: [] for c in COLECCIONES_SINTETICAS[3:]}
+        for _ in range(inicio, fin):
+            self._cliente(rng, docs)
+        return docs
+
+    def _cliente(self, rng: random.Random, docs: Dict[str, List[Dict]]):
+        es_empresa = rng.random() < 0.2
+        if es_empresa:
+            nombre = f"{rng.choice(EMPRESAS)} {rng.choice(APELLIDOS)} C.A."
+            tipo_documento, prefijo = "RIF", rng.choice(["J", "J", "J", "G"])
+            numero_documento = f"{rng.randint(10000000, 99999999)}-{rng.randint(0, 9)}"
+        else:
+            nombre = f"{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)} {rng.choice(APELLIDOS)}"
+            tipo_documento, prefijo = "CI", "V" if rng.random() < 0.93 else "E"
+            numero_documento = str(rng.randint(4000000, 32000000))
+
+        alta = self._fecha(rng, self.fecha_inicio, self.fecha_fin - timedelta(days=1))
+        cliente = {
+            "id": uuid_determinista(rng),
+            "nombre": nombre,
+            "tipo_documento": tipo_documento,
+            "prefijo_documento": prefijo,
+            "numero_documento": numero_documento,
+            "telefono": telefono(rng),
+            "telefono_secundario": telefono(rng) if rng.random() < 0.3 else None,
+            "direccion_fiscal": f"{rng.choice(CIUDADES)} - AV {rng.choice(APELLIDOS)} #{rng.randint(1, 300)}",
+            "empresa": nombre if es_empresa else None,
+            "email": f"cliente{rng.getrandbits(40):x}@ejemplo.com",
+            "created_at": alta.isoformat(),
+            "updated_at": self.updated_at,
+        }
+        docs["clientes"].append(cliente)
+
+        # Flotas con varios vehículos; particulares casi siempre uno
+        if es_empresa:
+            cantidad_vehiculos = rng.randint(2, 6)
+        else:
+            cantidad_vehiculos = elegir_ponderado(rng, [(1, 80), (2, 17), (3, 3)])
+        for _ in range(cantidad_vehiculos):
+            self._vehiculo(rng, cliente, alta, docs)
+
+    def _vehiculo(self, rng: random.Random, cliente: Dict, alta: datetime, docs: Dict[str, List[Dict]]):
+        marca = rng.choice(list(MARCAS_MODELOS))
+        kilometraje = rng.randint(5000, 180000)
+        vehiculo = {
+            "id": uuid_determinista(rng),
+            "matricula": matricula_desde_indice(self.vehiculos_generados),
+            "marca": marca,
+            "modelo": rng.choice(MARCAS_MODELOS[marca]),
+            "año": rng.randint(1998, self.fecha_fin.year),
+            "color": rng.choice(COLORES),
+            "kilometraje": kilometraje,
+            "tipo_combustible": elegir_ponderado(rng, COMBUSTIBLES),
+            "serial_niv": f"{rng.getrandbits(68):017X}"[-17:],
+            "tara": round(rng.uniform(900, 3500), 1),
+            "foto_vehiculo": "",
+            "cliente_id": cliente["id"],
+            "foto_matricula": "",
+            "created_at": alta.isoformat(),
+            "updated_at": self.updated_at,
+        }
+        self.vehiculos_generados += 1
+        docs["vehiculos"].append(vehiculo)
+
+        visitas = elegir_ponderado(rng, [(0, 10), (1, 25), (2, 22), (3, 17), (4, 12), (5, 8), (6, 6)])
+        fechas = sorted(self._fecha(rng, alta, self.fecha_fin) for _ in range(visitas))
+        for fecha in fechas:
+            kilometraje_anterior = kilometraje
+            kilometraje += rng.randint(2000, 15000)
+            self._orden(rng, cliente, vehiculo, fecha, kilometraje_anterior, kilometraje, docs)
+        vehiculo["kilometraje"] = kilometraje
+
+    def _orden(self, rng: random.Random, cliente: Dict, vehiculo: Dict, fecha: datetime,
+               kilometraje_anterior: int, kilometraje: int, docs: Dict[str, List[Dict]]):
+        reciente = (self.fecha_fin - fecha).days <= DIAS_ORDEN_RECIENTE
+        estado = rng.choices(ESTADOS_ORDEN, weights=PESOS_ORDEN_RECIENTE if reciente else PESOS_ORDEN_ANTIGUA)[0]
+        etapa = ESTADOS_ORDEN.index(estado)
+
+        items = []
+        for producto in rng.sample(self.catalogo, rng.randint(1, 4)):
+            cantidad = 1 if producto["tipo"] == "servicio" else rng.randint(1, 4)
+            items.append((producto, cantidad))
+        subtotal_usd = round(sum(p["precio"] * c for p, c in items), 2)
+        falla = rng.choice(FALLAS)
+
+        orden = {
+            "id": uuid_determinista(rng),
+            "vehiculo_id": vehiculo["id"],
+            "cliente_id": cliente["id"],
+            "mecanico_id": rng.choice(self.mecanicos)["id"] if etapa >= 1 else None,
+            "diagnostico": falla if etapa >= 1 else None,
+            "fallas": falla,
+            "reparaciones_realizadas": ", ".join(p["nombre"] for p, _ in items if p["tipo"] == "servicio") if etapa >= 5 else None,
+            "repuestos_utilizados": ", ".join(f"{p['nombre']} x{c}" for p, c in items if p["tipo"] == "repuesto") if etapa >= 5 else None,
+            "servicios_repuestos": [{"id": p["id"], "cantidad": c, "precio": p["precio"]} for p, c in items] if etapa >= 2 else [],
+            "estado": estado,
+            "presupuesto_total": subtotal_usd if etapa >= 2 else None,
+            "fecha_ingreso": fecha.isoformat(),
+            "fecha_estimada_entrega": (fecha + timedelta(days=rng.randint(1, 10))).isoformat(),
+            "observaciones": None,
+            "aprobado_cliente": etapa >= 3,
+            "created_at": fecha.isoformat(),
+            "updated_at": self.updated_at,
+        }
+        docs["ordenes_trabajo"].append(orden)
+        docs["historial_kilometraje"].append({
+            "id": uuid_determinista(rng),
+            "vehiculo_id": vehiculo["id"],
+            "kilometraje_anterior": kilometraje_anterior,
+            "kilometraje_nuevo": kilometraje,
+            "fecha_actualizacion": fecha.isoformat(),
+            "motivo": "Entrada al taller",
+            "observaciones": None,
+            "created_at": fecha.isoformat(),
+            "updated_at": self.updated_at,
+        })
+
+        if etapa < 2:
+            return
+        presupuesto = self._presupuesto(rng, orden, items, subtotal_usd, fecha, etapa)
+        docs["presupuestos"].append(presupuesto)
+        if etapa >= 5 and presupuesto["estado"] == "aprobado":
+            docs["facturas"].append(self._factura(rng, presupuesto, vehiculo, kilometraje, fecha, entregada=etapa == 6))
+
+    def _presupuesto(self, rng: random.Random, orden: Dict, items: List[Tuple[Dict, int]],
+                     subtotal_usd: float, fecha: datetime, etapa: int) -> Dict:
+        self.presupuestos_generados += 1
+        iva_usd = round(subtotal_usd * IVA_PORCENTAJE / 100, 2)
+        if etapa == 2:
+            estado = "rechazado" if rng.random() < 0.15 else "pendiente"
+        else:
+            estado = "aprobado"
+        creado = fecha + timedelta(hours=rng.randint(2, 48))
+        return {
+            "id": uuid_determinista(rng),
+            "numero_presupuesto": f"P-2024-{str(self.presupuestos_generados).zfill(3)}",
+            "vehiculo_id": orden["vehiculo_id"],
+            "cliente_id": orden["cliente_id"],
+            "orden_trabajo_id": orden["id"],
+            "items": [
+                {
+                    "id": uuid_determinista(rng),
+                    "tipo": p["tipo"],
+                    "descripcion": p["nombre"],
+                    "cantidad": c,
+                    "precio_unitario_usd": p["precio"],
+                    "total_usd": round(p["precio"] * c, 2),
+                }
+                for p, c in items
+            ],
+            "subtotal_usd": subtotal_usd,
+            "iva_porcentaje": IVA_PORCENTAJE,
+            "iva_usd": iva_usd,
+            "total_usd": round(subtotal_usd + iva_usd, 2),
+            "estado": estado,
+            "fecha_creacion": creado.isoformat(),
+            "fecha_aprobacion": (creado + timedelta(hours=rng.randint(1, 72))).isoformat() if estado == "aprobado" else None,
+            "observaciones": None,
+            "created_at": creado.isoformat(),
+            "updated_at": self.updated_at,
+        }
+
+    def _factura(self, rng: random.Random, presupuesto: Dict, vehiculo: Dict, kilometraje: int,
+                 fecha: datetime, entregada: bool) -> Dict:
+        self.facturas_generadas += 1
+        facturacion = min(self.fecha_fin, fecha + timedelta(days=rng.randint(1, 10)))
+        tasa = self.tasa_en(facturacion)
+        total_usd = presupuesto["total_usd"]
+        total_bs = round(total_usd * tasa, 2)
+
+        # Entregadas casi siempre pagadas; terminadas suelen tener saldo pendiente
+        if entregada:
+            fraccion = elegir_ponderado(rng, [(1.0, 85), (None, 10), (0.0, 5)])
+        else:
+            fraccion = elegir_ponderado(rng, [(1.0, 20), (None, 30), (0.0, 50)])
+        if fraccion is None:
+            fraccion = rng.uniform(0.2, 0.8)
+
+        cantidad_pagos = 0 if fraccion == 0 else rng.randint(1, 3)
+        monedas = [("dolares" if rng.random() < 0.4 else "bolivares") for _ in range(cantidad_pagos)]
+        aplica_igtf = "dolares" in monedas
+        igtf_usd = round(total_usd * IGTF_PORCENTAJE, 2) if aplica_igtf else 0.0
+        igtf_bs = round(igtf_usd * tasa, 2) if aplica_igtf else 0.0
+        total_final_bs = round(total_bs + igtf_bs, 2)
+
+        pagos = []
+        por_pagar = round(total_final_bs * fraccion, 2)
+        pesos = [rng.uniform(1, 3) for _ in monedas]
+        fecha_pago = facturacion
+        for i, moneda in enumerate(monedas):
+            if i == len(monedas) - 1:
+                # El último pago cierra el monto exacto sin arrastrar el redondeo
+                monto_bs = round(por_pagar - sum(p["monto_bs"] for p in pagos), 2)
+            else:
+                monto_bs = round(por_pagar * pesos[i] / sum(pesos), 2)
+            metodo = rng.choice(METODOS_PAGO[moneda])
+            fecha_pago = min(self.fecha_fin, fecha_pago + timedelta(hours=rng.randint(0, 240)))
+            referencia = None if metodo in METODOS_SIN_REFERENCIA else str(rng.randint(10 ** 7, 10 ** 12))
+            pagos.append({
+                "tipo": moneda,
+                "metodo": metodo,
+                "monto_usd": round(monto_bs / tasa, 2),
+                "monto_bs": monto_bs,
+                "referencia": referencia,
+                "referencia_norm": normalizar_referencia(referencia) if referencia else None,
+                "fecha_pago": fecha_pago.isoformat(),
+            })
+
+        # Mismo significado que en el servidor: lo pagado en USD a la tasa de la factura
+        monto_pagado_bs = round(sum(p["monto_usd"] for p in pagos) * tasa, 2)
+        saldo = round(max(0.0, total_final_bs - monto_pagado_bs), 2)
+        if saldo <= 0.01:
+            estado_pago = "pagado_total"
+        elif monto_pagado_bs > 0:
+            estado_pago = "pagado_parcial"
+        else:
+            estado_pago = "pendiente"
+
+        return {
+            "id": uuid_determinista(rng),
+            "numero_factura": f"FAC-2024-{str(self.facturas_generadas).zfill(3)}",
+            "presupuesto_id": presupuesto["id"],
+            "vehiculo_id": presupuesto["vehiculo_id"],
+            "cliente_id": presupuesto["cliente_id"],
+            "vehiculo_datos": {
+                "matricula": vehiculo["matricula"],
+                "color": vehiculo["color"],
+                "año": vehiculo["año"],
+                "km_ingreso": kilometraje,
+            },
+            "items": presupuesto["items"],
+            "subtotal_usd": presupuesto["subtotal_usd"],
+            "iva_usd": presupuesto["iva_usd"],
+            "total_usd": total_usd,
+            "tasa_cambio": tasa,
+            "subtotal_bs": round(presupuesto["subtotal_usd"] * tasa, 2),
+            "iva_bs": round(presupuesto["iva_usd"] * tasa, 2),
+            "total_bs": total_bs,
+            "aplica_igtf": aplica_igtf,
+            "igtf_usd": igtf_usd,
+            "igtf_bs": igtf_bs,
+            "total_final_bs": total_final_bs,
+            "tasa_emision": tasa,
+            "subtotal_bs_emision": round(presupuesto["subtotal_usd"] * tasa, 2),
+            "iva_bs_emision": round(presupuesto["iva_usd"] * tasa, 2),
+            "total_bs_emision": total_bs,
+            "pagos": pagos,
+            "monto_pagado_bs": monto_pagado_bs,
+            "saldo_pendiente_bs": max(0, saldo),
+            "estado_pago": estado_pago,
+            "fecha_facturacion": facturacion.isoformat(),
+            "fecha_vencimiento": (facturacion + timedelta(days=30)).isoformat(),
+            "observaciones": None,
+            "created_at": facturacion.isoformat(),
+            "updated_at": self.updated_at,
+        }
+
+
+class GeneracionJob:
+    """Estado y progreso de una generación de datos sintéticos en segundo plano"""
+
+    def __init__(self, parametros: Dict[str, Any]):
+        self.id = f"sinteticos-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.parametros = parametros
+        self.estado = "pendiente"  # pendiente, en_progreso, completado, error
+        self.progreso: Dict[str, int] = {c: 0 for c in COLECCIONES_SINTETICAS}
+        self.clientes_generados = 0
+        self.error: Optional[str] = None
+        self.iniciado = datetime.now(timezone.utc)
+        self.finalizado: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def documentos_insertados(self) -> int:
+        return sum(self.progreso.values())
+
+    def to_dict(self) -> Dict:
+        fin = self.finalizado or datetime.now(timezone.utc)
+        segundos = max((fin - self.iniciado).total_seconds(), 1e-6)
+        return {
+            "id": self.id,
+            "estado": self.estado,
+            "parametros": self.parametros,
+            "progreso": self.progreso,
+            "clientes_generados": self.clientes_generados,
+            "documentos_insertados": self.documentos_insertados,
+            "documentos_por_segundo": round(self.documentos_insertados / segundos, 1),
+            "error": self.error,
+            "iniciado": self.iniciado.isoformat(),
+            "finalizado": self.finalizado.isoformat() if self.finalizado else None,
+        }
+
+
+GENERACION_JOBS: Dict[str, GeneracionJob] = {}
+
+
+async def ejecutar_generacion(db, job: GeneracionJob, generador: GeneradorDatos,
+                              batch_size: int = 1000, concurrencia: int = 8, vaciar: bool = False,
+                              vaciar_coleccion: Optional[Callable[[str], Awaitable[int]]] = None,
+                              series: Sequence[str] = ()):
+    """
+    Genera los bloques de clientes en un hilo y los inserta en lotes paralelos.
+    El semáforo se toma antes de lanzar cada lote: como mucho `concurrencia` lotes en vuelo.
+    """
+    job.estado = "en_progreso"
+    semaforo = asyncio.Semaphore(concurrencia)
+    tareas = set()
+
+    async def insertar(coleccion: str, lote: List[Dict]):
+        try:
+            await db[coleccion].insert_many(lote, ordered=False)
+            job.progreso[coleccion] += len(lote)
+        except Exception as e:
+            job.error = job.error or f"{coleccion}: {e}"
+        finally:
+            semaforo.release()
+
+    async def despachar(documentos: Dict[str, List[Dict]]):
+        for coleccion, lista in documentos.items():
+            for i in range(0, len(lista), batch_size):
+                await semaforo.acquire()
+                tarea = asyncio.create_task(insertar(coleccion, lista[i:i + batch_size]))
+                tareas.add(tarea)
+                tarea.add_done_callback(tareas.discard)
+
+    try:
+        await verificar_destino(db, vaciar)
+        if vaciar:
+            await vaciar_destino(db, vaciar_coleccion, series)
+        await despachar(generador.documentos_fijos())
+        for numero, inicio, fin in generador.bloques():
+            if job.error:
+                break
+            # La generación es CPU: fuera del event loop, mientras los lotes anteriores se insertan
+            documentos = await asyncio.to_thread(generador.bloque, numero, inicio, fin)
+            await despachar(documentos)
+            job.clientes_generados = fin
+        await asyncio.gather(*tareas)
+        if not job.error:
+            await cuentas_por_cobrar.reconstruir(db)
+            await resumen_clientes.reconstruir(db)
+            await analitica_ingresos.invalidar_todo(db)
+        job.estado = "error" if job.error else "completado"
+    except Exception as e:
+        logger.error(f"Error generando datos sintéticos {job.id}: {e}")
+        job.estado = "error"
+        job.error = str(e)
+    finally:
+        job.finalizado = datetime.now(timezone.utc)
+    return job
+
+
+async def colecciones_con_datos(db) -> List[str]:
+    return [c for c in COLECCIONES_SINTETICAS if await db[c].find_one({}, {"_id": 1})]
+
+
+async def verificar_destino(db, vaciar: bool = False):
+    """
+    El dataset es determinista (ids, matrículas desde AAA000, numeración, una tasa activa):
+    sobre datos existentes chocaría con el índice único de matrícula y dejaría dos tasas
+    activas. Solo se genera sobre colecciones vacías, o vaciándolas antes con `vaciar`.
+    """
+    ocupadas = await colecciones_con_datos(db)
+    if ocupadas and not vaciar:
+        raise ValueError(f"Las colecciones {', '.join(ocupadas)} ya tienen datos; "
+                         f"vacíelas o genere con vaciar=true")
+
+
+async def vaciar_destino(db, vaciar_coleccion: Callable[[str], Awaitable[int]], series: Sequence[str] = ()):
+    """
+    Vacía las colecciones que genera el dataset (y lo que depende de ellas) con `vaciar_coleccion`,
+    que elimina y recrea cada una con sus índices y deja la lápida para los backups (el servidor
+    pasa el mismo helper de su reset), y reinicia los contadores de numeración de `series`.
+    """
+    if vaciar_coleccion is None:
+        raise ValueError("Falta la función para vaciar las colecciones")
+    for coleccion in COLECCIONES_SINTETICAS + COLECCIONES_DEPENDIENTES:
+        await vaciar_coleccion(coleccion)
+    if series:
+        await db.contadores.delete_many({"_id": {"$in": list(series)}})
+
+
+def iniciar_generacion(db, clientes: int, semilla: int = 42, fecha_fin: Optional[datetime] = None,
+                       batch_size: int = 1000, concurrencia: int = 8, vaciar: bool = False,
+                       vaciar_coleccion: Optional[Callable[[str], Awaitable[int]]] = None,
+                       series: Sequence[str] = ()) -> GeneracionJob:
+    """Registra el job y lanza la generación como tarea en segundo plano"""
+    if clientes <= 0:
+        raise ValueError("La cantidad de clientes debe ser mayor que cero")
+    if batch_size <= 0 or concurrencia <= 0:
+        raise ValueError("batch_size y concurrencia deben ser mayores que cero")
+    generador = GeneradorDatos(clientes, semilla, fecha_fin)
+    job = GeneracionJob({
+        "clientes": clientes,
+        "semilla": semilla,
+        "fecha_fin": generador.fecha_fin.isoformat(),
+        "batch_size": batch_size,
+        "concurrencia": concurrencia,
+        "vaciar": vaciar,
+    })
+    GENERACION_JOBS[job.id] = job
+    job.task = asyncio.create_task(ejecutar_generacion(
+        db, job, generador, batch_size, concurrencia, vaciar, vaciar_coleccion, series
+    ))
+    return job
+
+
+async def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    parser = argparse.ArgumentParser(description="Genera un dataset sintético determinista para pruebas de rendimiento")
+    parser.add_argument("--clientes", type=int, default=1000, help="cantidad de clientes (~20 documentos por cliente)")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--fecha-fin", help="fecha final del historial (YYYY-MM-DD); por defecto hoy")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--concurrencia", type=int, default=8)
+    parser.add_argument("--vaciar", action="store_true", help="vaciar antes las colecciones del dataset si tienen datos")
+    parser.add_argument("--mongo-url", default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    parser.add_argument("--db", default=os.environ.get('DB_NAME', 'taller_mecanico'))
+    args = parser.parse_args()
+
+    fecha_fin = datetime.fromisoformat(args.fecha_fin).replace(tzinfo=timezone.utc) if args.fecha_fin else None
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db]
+
+    async def vaciar_coleccion(coleccion: str) -> int:
+        total = await backup_engine.reconstruir_coleccion(db, coleccion)
+        await db[backup_engine.COLECCION_ELIMINACIONES].insert_one(backup_engine.lapida(coleccion))
+        return total
+
+    try:
+        # Sin el servidor no se conocen sus series de numeración: los contadores nunca quedan
+        # por debajo de los documentos existentes, así que a lo sumo dejan un salto de números
+        job = iniciar_generacion(db, args.clientes, args.semilla, fecha_fin,
+                                 args.batch_size, args.concurrencia, args.vaciar,
+                                 vaciar_coleccion, series=[flujo_ordenes.SERIE_EVENTOS])
+        while not job.task.done():
+            await asyncio.sleep(2)
+            estado = job.to_dict()
+            print(f"   {estado['clientes_generados']}/{args.clientes} clientes, "
+                  f"{estado['documentos_insertados']} documentos ({estado['documentos_por_segundo']}/s)")
+        resumen = job.to_dict()
+        if job.estado != "completado":
+            raise SystemExit(f"❌ Error: {job.error}")
+        print(f"✅ {resumen['documentos_insertados']} documentos en "
+              f"{(job.finalizado - job.iniciado).total_seconds():.1f}s")
+        for coleccion, cantidad in resumen["progreso"].items():
+            print(f"   - {coleccion}: {cantidad}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
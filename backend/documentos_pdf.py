@@ -0,0 +1,366 @@
+"""
+Generación de PDF de facturas y presupuestos en el servidor.
+
+El dibujo (reportlab) y la unión de archivos (pypdf) son trabajo de CPU, así que corren en
+un pool de procesos y nunca bloquean el event loop. A los workers solo viajan dicts planos
+ya armados desde Mongo y el logo ya rasterizado.
+
+- El logo de `configuraciones` se decodifica y reduce a PNG una sola vez; se vuelve a
+  rasterizar solo cuando cambia su `updated_at` y con él el hash del data URL.
+- Los PDF quedan en una caché LRU en memoria acotada por bytes, con clave
+  tipo + id + versión (+ logo), así que un documento que no cambió no se vuelve a dibujar.
+  Las facturas usan su campo `version`; los presupuestos, su marca `updated_at`.
+- La impresión por lote reutiliza la caché, dibuja en paralelo solo lo que falta y une
+  todo en un único PDF.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+from libro_ventas import fecha_local, filtro_rango
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', str(min(4, os.cpu_count() or 1))))
+PDF_CACHE_MB = int(os.environ.get('PDF_CACHE_MB', '64'))
+LOGO_ALTO_PX = 160
+TIPOS = {"factura": "facturas", "presupuesto": "presupuestos"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_logo: Dict[str, Any] = {"marca": None, "hash": None, "png": None}
+_logo_lock = asyncio.Lock()
+
+
+class CachePDF:
+    """PDF renderizados por clave, con desalojo LRU al superar el presupuesto de bytes"""
+
+    def __init__(self, maximo_bytes: int):
+        self.maximo_bytes = maximo_bytes
+        self.entradas: "OrderedDict[str, bytes]" = OrderedDict()
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave: str) -> Optional[bytes]:
+        pdf = self.entradas.get(clave)
+        if pdf is None:
+            self.fallos += 1
+            return None
+        self.entradas.move_to_end(clave)
+        self.aciertos += 1
+        return pdf
+
+    def put(self, clave: str, pdf: bytes):
+        if len(pdf) > self.maximo_bytes:
+            return
+        anterior = self.entradas.pop(clave, None)
+        if anterior is not None:
+            self.bytes -= len(anterior)
+        self.entradas[clave] = pdf
+        self.bytes += len(pdf)
+        while self.bytes > self.maximo_bytes:
+            _, desalojado = self.entradas.popitem(last=False)
+            self.bytes -= len(desalojado)
+
+    def to_dict(self) -> Dict:
+        return {
+            "documentos": len(self.entradas),
+            "bytes": self.bytes,
+            "maximo_bytes": self.maximo_bytes,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+        }
+
+
+CACHE = CachePDF(PDF_CACHE_MB * 1024 * 1024)
+
+
+def obtener_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: no heredar del proceso del servidor los hilos de Motor ni el event loop
+        _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def cerrar_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def en_pool(funcion, *args):
+    try:
+        return await asyncio.get_running_loop().run_in_executor(obtener_pool(), funcion, *args)
+    except BrokenProcessPool:
+        # Un worker murió (p. ej. por memoria): el próximo pedido arranca un pool nuevo
+        cerrar_pool()
+        raise
+
+
+# --- Trabajo que corre dentro de los workers -------------------------------------------
+
+def rasterizar_logo(data_url: str) -> bytes:
+    """Decodifica el data URL del logo y lo reduce a un PNG de alto fijo"""
+    from PIL import Image
+
+    _, _, contenido = data_url.partition(",")
+    imagen = Image.open(io.BytesIO(base64.b64decode(contenido)))
+    imagen = imagen.convert("RGBA")
+    if imagen.height > LOGO_ALTO_PX:
+        ancho = max(1, round(imagen.width * LOGO_ALTO_PX / imagen.height))
+        imagen = imagen.resize((ancho, LOGO_ALTO_PX), Image.LANCZOS)
+    salida = io.BytesIO()
+    imagen.save(salida, format="PNG", optimize=True)
+    return salida.getvalue()
+
+
+def formato_monto(valor: float) -> str:
+    # Formato venezolano: punto de miles y coma decimal
+    return f"{valor or 0:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def dibujar_documento(datos: Dict[str, Any], logo_png: Optional[bytes]) -> bytes:
+    """PDF de una factura o presupuesto a partir del dict armado por `datos_documento`"""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.units import mm
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    salida = io.BytesIO()
+    pdf = canvas.Canvas(salida, pagesize=letter)
+    ancho, alto = letter
+    margen = 18 * mm
+    titulo = f"{datos['titulo']} {datos['numero']}"
+    pdf.setTitle(titulo)
+
+    def encabezado() -> float:
+        y = alto - margen
+        if logo_png:
+            logo = ImageReader(io.BytesIO(logo_png))
+            ancho_logo, alto_logo = logo.getSize()
+            alto_dibujo = 18 * mm
+            pdf.drawImage(logo, margen, y - alto_dibujo, width=alto_dibujo * ancho_logo / alto_logo,
+                          height=alto_dibujo, mask="auto")
+        pdf.setFont("Helvetica-Bold", 14)
+        pdf.drawRightString(ancho - margen, y - 5 * mm, titulo)
+        pdf.setFont("Helvetica", 9)
+        pdf.drawRightString(ancho - margen, y - 10 * mm, f"Fecha: {datos['fecha']}")
+        return y - 24 * mm
+
+    y = encabezado()
+    pdf.setFont("Helvetica-Bold", 10)
+    pdf.drawString(margen, y, "Cliente")
+    pdf.drawString(ancho / 2, y, "Vehículo")
+    pdf.setFont("Helvetica", 9)
+    for i, (izquierda, derecha) in enumerate(zip(datos["cliente"], datos["vehiculo"])):
+        pdf.drawString(margen, y - (i + 1) * 4.5 * mm, izquierda)
+        pdf.drawString(ancho / 2, y - (i + 1) * 4.5 * mm, derecha)
+    y -= (len(datos["cliente"]) + 2) * 4.5 * mm
+
+    columnas = [margen, margen + 95 * mm, margen + 115 * mm, margen + 145 * mm]
+
+    def cabecera_items(y: float) -> float:
+        pdf.setFont("Helvetica-Bold", 9)
+        for x, texto in zip(columnas, ["Descripción", "Cant.", "P. Unit. USD", "Total USD"]):
+            pdf.drawString(x, y, texto)
+        pdf.line(margen, y - 1.5 * mm, ancho - margen, y - 1.5 * mm)
+        pdf.setFont("Helvetica", 9)
+        return y - 6 * mm
+
+    y = cabecera_items(y)
+    for item in datos["items"]:
+        if y < margen + 50 * mm:
+            pdf.showPage()
+            y = cabecera_items(encabezado())
+        pdf.drawString(columnas[0], y, item["descripcion"][:60])
+        pdf.drawString(columnas[1], y, str(item["cantidad"]))
+        pdf.drawString(columnas[2], y, formato_monto(item["precio_unitario_usd"]))
+        pdf.drawString(columnas[3], y, formato_monto(item["total_usd"]))
+        y -= 5 * mm
+
+    y -= 4 * mm
+    pdf.line(margen + 95 * mm, y + 3 * mm, ancho - margen, y + 3 * mm)
+    for etiqueta, valor, negrita in datos["totales"]:
+        pdf.setFont("Helvetica-Bold" if negrita else "Helvetica", 9)
+        pdf.drawString(margen + 95 * mm, y, etiqueta)
+        pdf.drawRightString(ancho - margen, y, valor)
+        y -= 5 * mm
+
+    if datos.get("observaciones"):
+        pdf.setFont("Helvetica-Oblique", 8)
+        pdf.drawString(margen, y - 4 * mm, f"Observaciones: {datos['observaciones'][:120]}")
+    pdf.showPage()
+    pdf.save()
+    return salida.getvalue()
+
+
+def dibujar_lote(documentos: List[Dict[str, Any]], logo_png: Optional[bytes]) -> List[bytes]:
+    return [dibujar_documento(datos, logo_png) for datos in documentos]
+
+
+def unir_pdfs(pdfs: List[bytes]) -> bytes:
+    from pypdf import PdfWriter
+
+    escritor = PdfWriter()
+    for pdf in pdfs:
+        escritor.append(io.BytesIO(pdf))
+    salida = io.BytesIO()
+    escritor.write(salida)
+    return salida.getvalue()
+
+
+# --- Orquestación en el servidor --------------------------------------------------------
+
+async def logo_rasterizado(db) -> Optional[bytes]:
+    """PNG del logo del sistema; solo se rasteriza de nuevo si el logo guardado cambió"""
+    # Primero solo la marca de modificación, para no traer el data URL en cada PDF
+    config = await db.configuraciones.find_one({"tipo": "sistema"}, {"_id": 0, "updated_at": 1})
+    marca = (config or {}).get("updated_at")
+    if config and marca and _logo["marca"] == marca:
+        return _logo["png"]
+
+    async with _logo_lock:
+        config = await db.configuraciones.find_one({"tipo": "sistema"}, {"_id": 0, "logo": 1, "updated_at": 1})
+        data_url = (config or {}).get("logo")
+        if not data_url:
+            _logo.update(marca=None, hash=None, png=None)
+            return None
+        huella = hashlib.sha1(data_url.encode()).hexdigest()
+        if _logo["hash"] != huella:
+            try:
+                _logo["png"] = await en_pool(rasterizar_logo, data_url)
+            except Exception as e:
+                logger.error(f"No se pudo rasterizar el logo: {e}")
+                _logo["png"] = None
+            _logo["hash"] = huella
+        _logo["marca"] = config.get("updated_at")
+    return _logo["png"]
+
+
+def clave_cache(tipo: str, documento: Dict) -> str:
+    version = documento.get("version", 0) if tipo == "factura" else documento.get("updated_at")
+    return f"{tipo}:{documento['id']}:{version}:{_logo['hash']}"
+
+
+def lineas_cliente(cliente: Dict) -> List[str]:
+    return [
+        cliente.get("nombre", ""),
+        f"{cliente.get('prefijo_documento', '')}{cliente.get('numero_documento', '')}",
+        (cliente.get("direccion_fiscal") or "")[:60],
+        cliente.get("telefono") or "",
+    ]
+
+
+def lineas_vehiculo(vehiculo: Dict) -> List[str]:
+    return [
+        f"Matrícula: {vehiculo.get('matricula', '')}",
+        f"{vehiculo.get('marca', '')} {vehiculo.get('modelo', '')}".strip(),
+        f"Color: {vehiculo.get('color') or '-'}   Año: {vehiculo.get('año') or '-'}",
+        f"Km: {vehiculo.get('km_ingreso') or vehiculo.get('kilometraje') or '-'}",
+    ]
+
+
+def datos_documento(tipo: str, documento: Dict, cliente: Dict, vehiculo: Dict) -> Dict[str, Any]:
+    """Dict plano (serializable) con todo lo que el worker necesita para dibujar"""
+    if tipo == "factura":
+        totales = [
+            ("Subtotal", f"Bs {formato_monto(documento.get('subtotal_bs'))}", False),
+            ("IVA 16%", f"Bs {formato_monto(documento.get('iva_bs'))}", False),
+            ("IGTF 3%", f"Bs {formato_monto(documento.get('igtf_bs'))}", False),
+            ("Total", f"Bs {formato_monto(documento.get('total_final_bs'))}", True),
+            ("Total USD", f"$ {formato_monto(documento.get('total_usd', 0) + (documento.get('igtf_usd') or 0))}", False),
+            ("Tasa", f"{formato_monto(documento.get('tasa_cambio'))} Bs/USD", False),
+            ("Saldo pendiente", f"Bs {formato_monto(documento.get('saldo_pendiente_bs'))}", True),
+        ]
+        return {
+            "titulo": "Factura",
+            "numero": documento.get("numero_factura", ""),
+            "fecha": fecha_local(documento.get("fecha_facturacion")),  # Día local, como el lote del día
+            "cliente": lineas_cliente(cliente),
+            "vehiculo": lineas_vehiculo({**vehiculo, **(documento.get("vehiculo_datos") or {})}),
+            "items": documento.get("items", []),
+            "totales": totales,
+            "observaciones": documento.get("observaciones"),
+        }
+    return {
+        "titulo": "Presupuesto",
+        "numero": documento.get("numero_presupuesto", ""),
+        "fecha": fecha_local(documento.get("fecha_creacion")),
+        "cliente": lineas_cliente(cliente),
+        "vehiculo": lineas_vehiculo(vehiculo),
+        "items": documento.get("items", []),
+        "totales": [
+            ("Subtotal", f"$ {formato_monto(documento.get('subtotal_usd'))}", False),
+            ("IVA 16%", f"$ {formato_monto(documento.get('iva_usd'))}", False),
+            ("Total", f"$ {formato_monto(documento.get('total_usd'))}", True),
+        ],
+        "observaciones": documento.get("observaciones"),
+    }
+
+
+async def relacionados(db, documentos: List[Dict]) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+    """Clientes y vehículos de los documentos con un $in por colección"""
+    cliente_ids = list({d["cliente_id"] for d in documentos})
+    vehiculo_ids = list({d["vehiculo_id"] for d in documentos})
+    clientes, vehiculos = await asyncio.gather(
+        db.clientes.find({"id": {"$in": cliente_ids}}, {"_id": 0}).to_list(None),
+        db.vehiculos.find({"id": {"$in": vehiculo_ids}}, {"_id": 0, "foto_vehiculo": 0, "foto_matricula": 0}).to_list(None),
+    )
+    return {c["id"]: c for c in clientes}, {v["id"]: v for v in vehiculos}
+
+
+async def renderizar(db, tipo: str, documentos: List[Dict]) -> List[bytes]:
+    """PDF de cada documento, en el mismo orden; solo se dibujan los que no están en caché"""
+    logo_png = await logo_rasterizado(db)
+    claves = [clave_cache(tipo, d) for d in documentos]
+    pdfs: List[Optional[bytes]] = [CACHE.get(clave) for clave in claves]
+    faltantes = [i for i, pdf in enumerate(pdfs) if pdf is None]
+    if not faltantes:
+        return pdfs
+
+    clientes, vehiculos = await relacionados(db, [documentos[i] for i in faltantes])
+    datos = [
+        datos_documento(tipo, documentos[i], clientes.get(documentos[i]["cliente_id"], {}),
+                        vehiculos.get(documentos[i]["vehiculo_id"], {}))
+        for i in faltantes
+    ]
+    # Un lote contiguo por worker para repartir el trabajo sin enviar un futuro por documento
+    tamano = max(1, -(-len(datos) // PDF_WORKERS))
+    lotes = await asyncio.gather(*[
+        en_pool(dibujar_lote, datos[inicio:inicio + tamano], logo_png)
+        for inicio in range(0, len(datos), tamano)
+    ])
+    for i, pdf in zip(faltantes, (pdf for lote in lotes for pdf in lote)):
+        pdfs[i] = pdf
+        CACHE.put(claves[i], pdf)
+    return pdfs
+
+
+async def pdf_documento(db, tipo: str, documento_id: str) -> Optional[Tuple[str, bytes]]:
+    """(nombre de archivo, PDF) de una factura o presupuesto, o None si no existe"""
+    documento = await db[TIPOS[tipo]].find_one({"id": documento_id}, {"_id": 0})
+    if not documento:
+        return None
+    pdf, = await renderizar(db, tipo, [documento])
+    numero = documento.get("numero_factura") or documento.get("numero_presupuesto") or documento_id
+    return f"{numero}.pdf", pdf
+
+
+async def pdf_facturas_del_dia(db, dia: date) -> Tuple[int, Optional[bytes]]:
+    """Todas las facturas emitidas el día (local, límites de filtro_rango) unidas en un solo PDF"""
+    facturas = await db.facturas.find(filtro_rango(dia, dia), {"_id": 0}).sort("numero_factura", 1).to_list(None)
+    if not facturas:
+        return 0, None
+    pdfs = await renderizar(db, "factura", facturas)
+    return len(facturas), await en_pool(unir_pdfs, pdfs)
@@ -0,0 +1,210 @@
+"""
+Máquina de estados de las órdenes de trabajo y registro de eventos.
+
+Una orden avanza un paso a la vez:
+    recibido → diagnosticando → presupuestado → aprobado → en_reparacion → terminado → entregado
+Si el cliente rechaza el presupuesto, la orden vuelve a diagnosticando (para presupuestar de
+nuevo) o pasa a cancelado; antes de empezar la reparación también se puede cancelar.
+`entregado` y `cancelado` son finales.
+
+Cada transición válida se agrega a `eventos_orden` (solo inserciones, nunca se modifica):
+    {"secuencia", "orden_id", "estado_anterior", "estado_nuevo", "fecha",
+     "duracion_segundos", "version", "nota"}
+`duracion_segundos` es el tiempo que la orden pasó en `estado_anterior` (desde `estado_desde`
+de la orden), así que "¿cuánto esperan los carros en diagnosticando?" es una agregación
+sobre el registro. `secuencia` es global y creciente (contador en `contadores`): las
+proyecciones (tablero, SLA, productividad) leen los eventos posteriores a la última
+secuencia que procesaron.
+
+La orden guarda `estado_version`; la transición solo se aplica si la orden sigue en el
+estado y la versión leídos, de modo que dos cambios simultáneos no se pisan.
+"""
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+COLECCION = "eventos_orden"
+SERIE_EVENTOS = "eventos_orden"
+ESTADOS = ["recibido", "diagnosticando", "presupuestado", "aprobado", "en_reparacion", "terminado", "entregado", "cancelado"]
+ESTADOS_FINALES = ["entregado", "cancelado"]
+TRANSICIONES = {
+    "recibido": ["diagnosticando", "cancelado"],
+    "diagnosticando": ["presupuestado", "cancelado"],
+    "presupuestado": ["aprobado", "diagnosticando", "cancelado"],
+    "aprobado": ["en_reparacion", "cancelado"],
+    "en_reparacion": ["terminado"],
+    "terminado": ["entregado"],
+    "entregado": [],
+    "cancelado": [],
+}
+# Un evento recién numerado puede tardar unos milisegundos en insertarse; leer solo los que ya
+# tienen este margen evita que un lector avance su secuencia por encima de uno que falta
+EVENTOS_MARGEN_SEGUNDOS = float(os.environ.get('EVENTOS_MARGEN_SEGUNDOS', '5'))
+MAX_EVENTOS_POR_LECTURA = 1000
+
+
+class TransicionInvalida(Exception):
+    pass
+
+
+class OrdenModificada(Exception):
+    """La orden cambió de estado entre la lectura y la escritura"""
+    pass
+
+
+def validar_transicion(actual: str, nuevo: str):
+    if nuevo not in ESTADOS:
+        raise TransicionInvalida(f"Estado inválido: {nuevo}. Use: {', '.join(ESTADOS)}")
+    if nuevo not in TRANSICIONES.get(actual, []):
+        permitidos = ", ".join(TRANSICIONES.get(actual, [])) or "ninguno"
+        raise TransicionInvalida(f"No se puede pasar de '{actual}' a '{nuevo}' (permitido: {permitidos})")
+
+
+def parse_fecha(valor) -> Optional[datetime]:
+    if isinstance(valor, str):
+        try:
+            valor = datetime.fromisoformat(valor)
+        except ValueError:
+            return None
+    if not isinstance(valor, datetime):
+        return None
+    return valor if valor.tzinfo else valor.replace(tzinfo=timezone.utc)
+
+
+async def reservar_secuencia(db) -> int:
+    """Siguiente número global de evento; nunca queda por debajo del último evento guardado (p. ej. tras restaurar)"""
+    ultimo = await db[COLECCION].find_one({}, {"_id": 0, "secuencia": 1}, sort=[("secuencia", -1)])
+    contador = await db.contadores.find_one_and_update(
+        {"_id": SERIE_EVENTOS},
+        [{"$set": {"valor": {"$add": [{"$max": [{"$ifNull": ["$valor", 0]}, (ultimo or {}).get("secuencia", 0)]}, 1]}}}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return contador["valor"]
+
+
+async def agregar_evento(db, orden_id: str, estado_anterior: Optional[str], estado_nuevo: str, fecha: datetime,
+                         duracion_segundos: Optional[float], version: int, nota: Optional[str] = None) -> Dict:
+    evento = {
+        "id": str(uuid.uuid4()),
+        "secuencia": await reservar_secuencia(db),
+        "orden_id": orden_id,
+        "estado_anterior": estado_anterior,
+        "estado_nuevo": estado_nuevo,
+        "fecha": fecha.isoformat(),
+        "duracion_segundos": duracion_segundos,
+        "version": version,
+        "nota": nota,
+        "updated_at": fecha.isoformat(),  # Para los backups incrementales, igual que el resto de colecciones
+    }
+    await db[COLECCION].insert_one(evento)
+    evento.pop("_id", None)
+    return evento
+
+
+async def registrar_creacion(db, orden: Dict):
+    """Evento inicial de una orden recién creada; la orden ya trae estado_desde y estado_version = 1"""
+    try:
+        await agregar_evento(db, orden["id"], None, orden["estado"], parse_fecha(orden["estado_desde"]), None, 1)
+    except Exception as e:
+        logger.error(f"No se pudo registrar el evento de creación de la orden {orden['id']}: {e}")
+
+
+async def transicionar(db, orden: Dict, nuevo: str, cambios: Optional[Dict] = None,
+                       nota: Optional[str] = None) -> Dict:
+    """
+    Aplica la transición (y los demás `cambios` de la orden en la misma escritura) si es válida
+    y la orden no cambió desde que se leyó; devuelve la orden actualizada.
+    """
+    actual = orden.get("estado", ESTADOS[0])
+    validar_transicion(actual, nuevo)
+
+    ahora = datetime.now(timezone.utc)
+    version = orden.get("estado_version") or 0
+    desde = parse_fecha(orden.get("estado_desde"))
+    # Órdenes anteriores al registro no tienen estado_desde: su duración queda sin dato
+    duracion = round((ahora - desde).total_seconds(), 3) if desde else None
+
+    filtro = {"id": orden["id"], "estado": actual}
+    filtro["estado_version"] = version if version else {"$in": [None, 0]}
+    actualizada = await db.ordenes_trabajo.find_one_and_update(
+        filtro,
+        {"$set": {
+            **(cambios or {}),
+            "estado": nuevo,
+            "estado_desde": ahora.isoformat(),
+            "estado_version": version + 1,
+            "updated_at": ahora.isoformat(),
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+    if not actualizada:
+        raise OrdenModificada("La orden cambió de estado mientras se actualizaba; vuelva a intentarlo")
+    try:
+        await agregar_evento(db, orden["id"], actual, nuevo, ahora, duracion, version + 1, nota)
+    except Exception as e:
+        # La orden ya cambió; el hueco se ve en el registro como un salto de versión
+        logger.error(f"No se pudo registrar la transición {actual} → {nuevo} de la orden {orden['id']}: {e}")
+    return actualizada
+
+
+async def eventos_de_orden(db, orden_id: str) -> List[Dict]:
+    return await db[COLECCION].find({"orden_id": orden_id}, {"_id": 0}).sort("secuencia", 1).to_list(None)
+
+
+async def eventos_desde(db, despues_de: int, limite: int = MAX_EVENTOS_POR_LECTURA) -> Dict:
+    """Eventos con secuencia mayor a `despues_de`, en orden, para proyecciones incrementales"""
+    limite = max(1, min(limite, MAX_EVENTOS_POR_LECTURA))
+    estables = (datetime.now(timezone.utc) - timedelta(seconds=EVENTOS_MARGEN_SEGUNDOS)).isoformat()
+    eventos = await db[COLECCION].find(
+        {"secuencia": {"$gt": despues_de}, "fecha": {"$lte": estables}}, {"_id": 0}
+    ).sort("secuencia", 1).limit(limite).to_list(None)
+    return {
+        "eventos": eventos,
+        "ultima_secuencia": eventos[-1]["secuencia"] if eventos else despues_de,
+        "hay_mas": len(eventos) == limite,
+    }
+
+
+async def tiempos_por_estado(db, desde: Optional[datetime] = None, hasta: Optional[datetime] = None) -> List[Dict]:
+    """Tiempo que pasan las órdenes en cada estado, según las transiciones que salieron de él en el rango"""
+    filtro: Dict = {"estado_anterior": {"$ne": None}, "duracion_segundos": {"$ne": None}}
+    if desde or hasta:
+        filtro["fecha"] = {}
+        if desde:
+            filtro["fecha"]["$gte"] = desde.astimezone(timezone.utc).isoformat()
+        if hasta:
+            filtro["fecha"]["$lt"] = hasta.astimezone(timezone.utc).isoformat()
+    filas = await db[COLECCION].aggregate([
+        {"$match": filtro},
+        {"$group": {
+            "_id": "$estado_anterior",
+            "transiciones": {"$sum": 1},
+            "promedio_segundos": {"$avg": "$duracion_segundos"},
+            "minimo_segundos": {"$min": "$duracion_segundos"},
+            "maximo_segundos": {"$max": "$duracion_segundos"},
+        }},
+    ]).to_list(None)
+    por_estado = {fila["_id"]: fila for fila in filas}
+    return [
+        {
+            "estado": estado,
+            "transiciones": por_estado[estado]["transiciones"],
+            "promedio_horas": round(por_estado[estado]["promedio_segundos"] / 3600, 2),
+            "minimo_horas": round(por_estado[estado]["minimo_segundos"] / 3600, 2),
+            "maximo_horas": round(por_estado[estado]["maximo_segundos"] / 3600, 2),
+        }
+        for estado in ESTADOS if estado in por_estado
+    ]
+
+
+async def crear_indices(db):
+    await db[COLECCION].create_index("secuencia", unique=True)
+    await db[COLECCION].create_index([("orden_id", 1), ("secuencia", 1)])
+    await db[COLECCION].create_index([("estado_anterior", 1), ("fecha", 1)])
@@ -0,0 +1,247 @@
+"""
+Exportación del libro de ventas (declaración mensual de IVA) desde `facturas`.
+
+Las facturas del rango se recorren con un cursor ordenado por `fecha_facturacion`
+(respaldado por su índice) y las filas se emiten por lotes a medida que llegan: CSV se
+transmite directamente en la respuesta y XLSX se escribe con openpyxl en modo write_only
+a un archivo temporal. Los datos fiscales de los clientes se resuelven con un `$in` por
+lote contra una caché acotada, así que la memoria no crece con el tamaño del rango.
+
+Los montos en Bs y la tasa son los de la emisión (`tasa_emision`, `*_bs_emision`), que las
+revalorizaciones no modifican: un mes ya declarado se exporta siempre igual. Las facturas
+anteriores a esos campos los reciben con `completar_montos_emision`.
+"""
+import asyncio
+import csv
+import io
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Dict, List
+
+from pymongo import UpdateOne
+
+from analitica_ingresos import limite_utc
+from cierre_caja import dia_local
+
+logger = logging.getLogger(__name__)
+
+FORMATOS = {"csv": "text/csv; charset=utf-8", "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+LIBRO_VENTAS_BATCH_SIZE = int(os.environ.get('LIBRO_VENTAS_BATCH_SIZE', '500'))
+MAX_CLIENTES_CACHE = 5000
+COLUMNAS = [
+    "Fecha", "N° Factura", "RIF/CI", "Cliente", "Base Imponible Bs", "IVA 16% Bs",
+    "IGTF 3% Bs", "Total Bs", "Total USD", "Tasa de Cambio", "Estado de Pago",
+]
+CAMPOS_MONTO = ["base_bs", "iva_bs", "igtf_bs", "total_bs", "total_usd"]
+PROYECCION = {
+    "_id": 0, "numero_factura": 1, "cliente_id": 1, "fecha_facturacion": 1, "tasa_cambio": 1,
+    "subtotal_bs": 1, "iva_bs": 1, "igtf_bs": 1, "total_final_bs": 1, "total_usd": 1, "igtf_usd": 1,
+    "estado_pago": 1, "tasa_emision": 1, "subtotal_bs_emision": 1, "iva_bs_emision": 1, "total_bs_emision": 1,
+}
+CAMPOS_EMISION = {"subtotal_bs_emision": "subtotal_bs", "iva_bs_emision": "iva_bs", "total_bs_emision": "total_bs"}
+
+
+class CacheClientes:
+    """Datos fiscales de clientes, cargados por lotes con $in y con tope de entradas (LRU)"""
+
+    def __init__(self, db, maximo: int = MAX_CLIENTES_CACHE):
+        self.db = db
+        self.maximo = maximo
+        self.clientes: "OrderedDict[str, Dict]" = OrderedDict()
+        self.consultas = 0
+
+    async def cargar(self, cliente_ids: List[str]):
+        faltantes = list({cid for cid in cliente_ids if cid not in self.clientes})
+        if faltantes:
+            self.consultas += 1
+            encontrados = {
+                c["id"]: c async for c in self.db.clientes.find(
+                    {"id": {"$in": faltantes}},
+                    {"_id": 0, "id": 1, "nombre": 1, "prefijo_documento": 1, "numero_documento": 1}
+                )
+            }
+            for cid in faltantes:
+                self.clientes[cid] = encontrados.get(cid, {})
+        for cid in cliente_ids:
+            self.clientes.move_to_end(cid)
+        while len(self.clientes) > self.maximo:
+            self.clientes.popitem(last=False)
+
+    def get(self, cliente_id: str) -> Dict:
+        return self.clientes.get(cliente_id, {})
+
+
+def filtro_rango(desde: date, hasta: date) -> Dict:
+    # Días locales del taller (ZONA_HORARIA), igual que el cierre de caja y la analítica: las
+    # fechas se guardan como ISO en UTC, así que los límites son las medianoches locales en UTC
+    return {"fecha_facturacion": {"$gte": limite_utc(desde), "$lt": limite_utc(hasta + timedelta(days=1))}}
+
+
+def documento_fiscal(cliente: Dict) -> str:
+    if not cliente:
+        return ""
+    prefijo = (cliente.get("prefijo_documento") or "").rstrip("-")
+    return f"{prefijo}-{cliente.get('numero_documento', '')}" if prefijo else cliente.get("numero_documento", "")
+
+
+def fecha_local(valor) -> str:
+    """Día local de la factura (el mismo que usa filtro_rango), no el día UTC"""
+    try:
+        fecha = datetime.fromisoformat(str(valor))
+    except ValueError:
+        return str(valor or "")[:10]
+    return dia_local(fecha).isoformat()
+
+
+def fila_factura(factura: Dict, cliente: Dict) -> Dict:
+    if factura.get("tasa_emision"):
+        tasa = factura["tasa_emision"]
+        igtf_bs = (factura.get("igtf_usd") or 0.0) * tasa
+        base_bs, iva_bs = factura.get("subtotal_bs_emision", 0.0), factura.get("iva_bs_emision", 0.0)
+        total_bs = factura.get("total_bs_emision", 0.0) + igtf_bs
+    else:
+        # Sin migrar todavía: los montos actuales, que coinciden con la emisión si no se revalorizó
+        tasa = factura.get("tasa_cambio", 0.0)
+        igtf_bs = factura.get("igtf_bs", 0.0)
+        base_bs, iva_bs = factura.get("subtotal_bs", 0.0), factura.get("iva_bs", 0.0)
+        total_bs = factura.get("total_final_bs", 0.0)
+    return {
+        "fecha": fecha_local(factura.get("fecha_facturacion")),
+        "numero_factura": factura.get("numero_factura", ""),
+        "documento": documento_fiscal(cliente),
+        "cliente": cliente.get("nombre", ""),
+        "base_bs": round(base_bs, 2),
+        "iva_bs": round(iva_bs, 2),
+        "igtf_bs": round(igtf_bs, 2),
+        "total_bs": round(total_bs, 2),
+        "total_usd": round(factura.get("total_usd", 0.0) + (factura.get("igtf_usd") or 0.0), 2),
+        "tasa_cambio": tasa,
+        "estado_pago": factura.get("estado_pago", ""),
+    }
+
+
+async def filas_libro(db, desde: date, hasta: date) -> AsyncIterator[List[Dict]]:
+    """Lotes de filas del libro en orden cronológico, con los datos del cliente ya resueltos"""
+    cache = CacheClientes(db)
+    cursor = db.facturas.find(filtro_rango(desde, hasta), PROYECCION).sort(
+        [("fecha_facturacion", 1), ("numero_factura", 1)]
+    ).batch_size(LIBRO_VENTAS_BATCH_SIZE)
+    lote: List[Dict] = []
+
+    async def resolver(facturas: List[Dict]) -> List[Dict]:
+        await cache.cargar([f.get("cliente_id") for f in facturas])
+        return [fila_factura(f, cache.get(f.get("cliente_id"))) for f in facturas]
+
+    async for factura in cursor:
+        lote.append(factura)
+        if len(lote) >= LIBRO_VENTAS_BATCH_SIZE:
+            yield await resolver(lote)
+            lote = []
+    if lote:
+        yield await resolver(lote)
+
+
+def fila_totales(totales: Dict[str, float], facturas: int) -> List:
+    return ["TOTALES", f"{facturas} facturas", "", "", *[round(totales[c], 2) for c in CAMPOS_MONTO], "", ""]
+
+
+async def exportar_csv(db, desde: date, hasta: date) -> AsyncIterator[bytes]:
+    """Cuerpo CSV por partes: encabezado, un bloque por lote y la fila de totales"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write("\ufeff")  # BOM para que Excel reconozca UTF-8
+    escritor.writerow(COLUMNAS)
+    totales = {campo: 0.0 for campo in CAMPOS_MONTO}
+    facturas = 0
+
+    async for filas in filas_libro(db, desde, hasta):
+        for fila in filas:
+            escritor.writerow(list(fila.values()))
+            for campo in CAMPOS_MONTO:
+                totales[campo] += fila[campo]
+        facturas += len(filas)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+    escritor.writerow(fila_totales(totales, facturas))
+    yield buffer.getvalue().encode("utf-8")
+
+
+async def exportar_xlsx(db, desde: date, hasta: date) -> str:
+    """Escribe el libro en un .xlsx temporal y devuelve su ruta; el llamador lo elimina"""
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ValueError("Formato xlsx no disponible: instale el paquete 'openpyxl'")
+
+    # write_only vuelca cada fila a disco en lugar de mantener la hoja en memoria
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet("Libro de Ventas")
+    hoja.append([f"Libro de Ventas del {desde.isoformat()} al {hasta.isoformat()}"])
+    hoja.append(COLUMNAS)
+    totales = {campo: 0.0 for campo in CAMPOS_MONTO}
+    facturas = 0
+
+    async for filas in filas_libro(db, desde, hasta):
+        for fila in filas:
+            hoja.append(list(fila.values()))
+            for campo in CAMPOS_MONTO:
+                totales[campo] += fila[campo]
+        facturas += len(filas)
+    hoja.append(fila_totales(totales, facturas))
+
+    descriptor, ruta = tempfile.mkstemp(prefix="libro-ventas-", suffix=".xlsx")
+    os.close(descriptor)
+    try:
+        await asyncio.to_thread(libro.save, ruta)
+    except Exception:
+        os.remove(ruta)
+        raise
+    return ruta
+
+
+def nombre_archivo(desde: date, hasta: date, formato: str) -> str:
+    return f"libro-ventas-{desde.isoformat()}-a-{hasta.isoformat()}.{formato}"
+
+
+async def completar_montos_emision(db) -> int:
+    """
+    Guarda la tasa y los montos de emisión en las facturas que no los tienen. Si la factura se
+    revalorizó, salen de su primera auditoría (los valores anteriores a cualquier cambio de
+    tasa); si no, o si falta la auditoría, son los montos actuales.
+    """
+    actualizadas = 0
+    operaciones = []
+    async for factura in db.facturas.find(
+        {"tasa_emision": {"$exists": False}, "ultima_revalorizacion": {"$exists": True}}, {"_id": 0, "id": 1}
+    ):
+        primera = await db.revalorizaciones.find_one(
+            {"factura_id": factura["id"]}, {"_id": 0, "tasa_anterior": 1, "valores_anteriores": 1}, sort=[("fecha", 1)]
+        )
+        if not primera:
+            continue
+        anteriores = primera.get("valores_anteriores") or {}
+        operaciones.append(UpdateOne(
+            {"id": factura["id"], "tasa_emision": {"$exists": False}},
+            {"$set": {"tasa_emision": primera["tasa_anterior"],
+                      **{emision: anteriores.get(actual) for emision, actual in CAMPOS_EMISION.items()}}}
+        ))
+        if len(operaciones) >= LIBRO_VENTAS_BATCH_SIZE:
+            actualizadas += (await db.facturas.bulk_write(operaciones, ordered=False)).modified_count
+            operaciones = []
+    if operaciones:
+        actualizadas += (await db.facturas.bulk_write(operaciones, ordered=False)).modified_count
+
+    restantes = await db.facturas.update_many(
+        {"tasa_emision": {"$exists": False}},
+        [{"$set": {"tasa_emision": "$tasa_cambio", **{emision: f"${actual}" for emision, actual in CAMPOS_EMISION.items()}}}]
+    )
+    return actualizadas + restantes.modified_count
+
+
+async def crear_indices(db):
+    await db.facturas.create_index([("fecha_facturacion", 1), ("numero_factura", 1)])
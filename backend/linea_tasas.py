@@ -0,0 +1,118 @@
+"""
+Línea de tiempo en memoria de las tasas de cambio.
+
+`tasas_cambio` guarda todo el historial; aquí se mantiene ordenado como dos listas
+paralelas (fecha_actualizacion, tasa_bs_usd) para responder "¿qué tasa regía en el
+momento T?" con bisect en O(log n), sin una consulta por fila en reportes ni en pagos
+con fecha pasada.
+
+La línea se carga completa al arrancar, se actualiza al registrar una tasa desde este
+proceso y, como otros procesos (u otra restauración) pueden cambiar la colección, cada
+TASAS_REFRESCO_SEGUNDOS se compara una marca barata (cantidad estimada + último
+updated_at indexado) y se recarga solo si cambió.
+"""
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_right
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TASAS_REFRESCO_SEGUNDOS = float(os.environ.get('TASAS_REFRESCO_SEGUNDOS', '30'))
+
+
+def parse_fecha(valor) -> Optional[datetime]:
+    if isinstance(valor, str):
+        try:
+            valor = datetime.fromisoformat(valor)
+        except ValueError:
+            return None
+    if not isinstance(valor, datetime):
+        return None
+    return valor if valor.tzinfo else valor.replace(tzinfo=timezone.utc)
+
+
+class LineaTasas:
+    """Historial de tasas ordenado por fecha de vigencia"""
+
+    def __init__(self):
+        self.fechas: List[datetime] = []
+        self.tasas: List[float] = []
+        self.marca: Optional[Tuple] = None
+        self.verificado = 0.0
+        self._lock = asyncio.Lock()
+
+    async def marca_actual(self, db) -> Tuple:
+        ultima = await db.tasas_cambio.find_one({}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)])
+        return await db.tasas_cambio.estimated_document_count(), (ultima or {}).get("updated_at")
+
+    async def cargar(self, db):
+        """Relee todo el historial (unos pocos miles de documentos como mucho)"""
+        async with self._lock:
+            marca = await self.marca_actual(db)
+            fechas, tasas = [], []
+            async for tasa in db.tasas_cambio.find(
+                {}, {"_id": 0, "fecha_actualizacion": 1, "tasa_bs_usd": 1}
+            ).sort("fecha_actualizacion", 1):
+                fecha = parse_fecha(tasa.get("fecha_actualizacion"))
+                if fecha and tasa.get("tasa_bs_usd"):
+                    fechas.append(fecha)
+                    tasas.append(tasa["tasa_bs_usd"])
+            # El orden en Mongo es de strings ISO; se reordena por fecha real por si hay zonas distintas
+            pares = sorted(zip(fechas, tasas), key=lambda par: par[0])
+            self.fechas = [fecha for fecha, _ in pares]
+            self.tasas = [tasa for _, tasa in pares]
+            self.marca = marca
+            self.verificado = time.monotonic()
+        logger.info(f"Línea de tasas cargada: {len(self.fechas)} tasas")
+
+    async def asegurar(self, db):
+        """Recarga si la colección cambió desde la última verificación (como mucho cada N segundos)"""
+        if self.marca is not None and time.monotonic() - self.verificado < TASAS_REFRESCO_SEGUNDOS:
+            return
+        marca = await self.marca_actual(db)
+        if marca != self.marca:
+            await self.cargar(db)
+        else:
+            self.verificado = time.monotonic()
+
+    def agregar(self, fecha, tasa: float):
+        """Registra en memoria una tasa recién insertada por este proceso"""
+        fecha = parse_fecha(fecha)
+        if not fecha:
+            return
+        indice = bisect_right(self.fechas, fecha)
+        self.fechas.insert(indice, fecha)
+        self.tasas.insert(indice, tasa)
+        # Queda disponible al instante; la próxima consulta compara la marca y recarga desde Mongo,
+        # con lo que también recoge lo que otros procesos hayan escrito mientras tanto
+        self.verificado = 0.0
+
+    def tasa_en(self, momento) -> Optional[float]:
+        """Tasa vigente en el momento indicado, o None si es anterior a la primera tasa"""
+        momento = parse_fecha(momento)
+        if not momento or not self.fechas:
+            return None
+        indice = bisect_right(self.fechas, momento) - 1
+        return self.tasas[indice] if indice >= 0 else None
+
+    def actual(self) -> Optional[float]:
+        return self.tasas[-1] if self.tasas else None
+
+    def to_dict(self) -> Dict:
+        return {
+            "tasas": len(self.fechas),
+            "desde": self.fechas[0].isoformat() if self.fechas else None,
+            "hasta": self.fechas[-1].isoformat() if self.fechas else None,
+            "actual": self.actual(),
+        }
+
+
+LINEA_TASAS = LineaTasas()
+
+
+async def crear_indices(db):
+    await db.tasas_cambio.create_index("fecha_actualizacion")
@@ -0,0 +1,204 @@
+"""
+Resumen por cliente: saldo abierto, visitas, última visita e ingresos históricos.
+
+Un documento por cliente en `resumen_clientes`, para que la ficha del cliente no tenga
+que recorrer sus facturas ni sus órdenes:
+    {"cliente_id", "saldo_bs", "saldo_usd", "facturas_abiertas", "visitas", "ultima_visita",
+     "facturas", "facturado_usd", "cobrado_usd", "cobrado_bs", "updated_at"}
+
+Los contadores se actualizan con $inc al crear una orden (visita), una factura o un pago;
+lo cobrado se suma con el monto y la tasa del día del pago, así que una revalorización no
+lo cambia. El saldo, que sí cambia con pagos y revalorizaciones, se copia con valor
+absoluto desde la vista de cuentas por cobrar (que ya descarta versiones viejas). Dos pagos
+simultáneos del mismo cliente pueden terminar en otro orden, así que tras escribir el saldo
+se vuelve a leer la vista: si cambió entre medio, se copia otra vez. Quien escribe último
+siempre verifica después, de modo que el saldo que queda es el vigente.
+
+Si algo se desalinea (una escritura fallida, una restauración), se recalcula todo:
+    python resumen_clientes.py
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+import cuentas_por_cobrar
+
+logger = logging.getLogger(__name__)
+
+COLECCION = "resumen_clientes"
+CONTADORES = ["visitas", "facturas", "facturado_usd", "cobrado_usd", "cobrado_bs"]
+MAX_INTENTOS_SALDO = 5
+
+
+def resumen_vacio(cliente_id: str) -> Dict:
+    return {
+        "cliente_id": cliente_id, "saldo_bs": 0.0, "saldo_usd": 0.0, "facturas_abiertas": 0,
+        "ultima_visita": None, **{campo: 0 for campo in CONTADORES},
+    }
+
+
+async def incrementar(db, operaciones: List[UpdateOne]):
+    """Aplica los $inc; un fallo se registra y no interrumpe la operación que lo originó"""
+    if not operaciones:
+        return
+    try:
+        await db[COLECCION].bulk_write(operaciones, ordered=False)
+    except Exception as e:
+        logger.error(f"No se pudo actualizar el resumen de clientes: {e}")
+
+
+def operacion(cliente_id: str, incrementos: Dict[str, float], ultima_visita: Optional[str] = None) -> UpdateOne:
+    actualizacion = {"$inc": incrementos, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    if ultima_visita:
+        actualizacion["$max"] = {"ultima_visita": ultima_visita}
+    return UpdateOne({"cliente_id": cliente_id}, actualizacion, upsert=True)
+
+
+async def registrar_visita(db, orden: Dict):
+    """Una orden de trabajo nueva es una visita del cliente"""
+    await incrementar(db, [operacion(orden["cliente_id"], {"visitas": 1}, orden.get("fecha_ingreso"))])
+
+
+async def registrar_facturas(db, facturas: List[Dict]):
+    por_cliente: Dict[str, Dict[str, float]] = {}
+    for factura in facturas:
+        acumulado = por_cliente.setdefault(factura["cliente_id"], {"facturas": 0, "facturado_usd": 0.0})
+        acumulado["facturas"] += 1
+        acumulado["facturado_usd"] = round(acumulado["facturado_usd"] + factura.get("total_usd", 0.0), 2)
+    await incrementar(db, [operacion(cliente_id, incrementos) for cliente_id, incrementos in por_cliente.items()])
+    await actualizar_saldos(db, por_cliente)
+
+
+async def registrar_pago(db, factura: Dict, pago: Dict):
+    await incrementar(db, [operacion(factura["cliente_id"], {
+        "cobrado_usd": round(pago.get("monto_usd", 0.0), 2),
+        "cobrado_bs": round(pago.get("monto_bs", 0.0), 2),
+    })])
+    await actualizar_saldos(db, [factura["cliente_id"]])
+
+
+async def saldos_vigentes(db, cliente_ids: List[str]) -> Dict[str, Dict]:
+    """Saldo de cada cliente según la vista de cuentas por cobrar"""
+    saldos = {cliente_id: {"saldo_bs": 0.0, "saldo_usd": 0.0, "facturas_abiertas": 0} for cliente_id in cliente_ids}
+    async for cuenta in db[cuentas_por_cobrar.COLECCION].find(
+        {"cliente_id": {"$in": cliente_ids}}, {"_id": 0, "cliente_id": 1, "facturas": 1}
+    ):
+        entradas = (cuenta.get("facturas") or {}).values()
+        saldos[cuenta["cliente_id"]] = {
+            "saldo_bs": round(sum(e.get("saldo_bs", 0.0) for e in entradas), 2),
+            "saldo_usd": round(sum(e.get("saldo_usd", 0.0) for e in entradas), 2),
+            "facturas_abiertas": len(entradas),
+        }
+    return saldos
+
+
+async def actualizar_saldos(db, cliente_ids: Iterable[str]):
+    """Copia el saldo actual de cada cliente desde la vista y repite con los que cambiaron mientras tanto"""
+    pendientes = list(set(cliente_ids))
+    try:
+        for _ in range(MAX_INTENTOS_SALDO):
+            if not pendientes:
+                return
+            saldos = await saldos_vigentes(db, pendientes)
+            ahora = datetime.now(timezone.utc).isoformat()
+            await db[COLECCION].bulk_write([
+                UpdateOne({"cliente_id": cliente_id}, {"$set": {**saldo, "updated_at": ahora}}, upsert=True)
+                for cliente_id, saldo in saldos.items()
+            ], ordered=False)
+            # Otro pago pudo escribir un saldo más nuevo antes que este: se verifica contra la vista
+            vigentes = await saldos_vigentes(db, pendientes)
+            pendientes = [cliente_id for cliente_id in pendientes if vigentes[cliente_id] != saldos[cliente_id]]
+        if pendientes:
+            logger.warning(f"El saldo de {len(pendientes)} clientes siguió cambiando; lo corrige la próxima escritura")
+    except Exception as e:
+        logger.error(f"No se pudo actualizar el saldo en el resumen de clientes: {e}")
+
+
+async def obtener(db, cliente_id: str) -> Dict:
+    resumen = await db[COLECCION].find_one({"cliente_id": cliente_id}, {"_id": 0})
+    return {**resumen_vacio(cliente_id), **(resumen or {})}
+
+
+def pipeline_reconstruccion() -> List[Dict]:
+    """Facturas y órdenes agrupadas por cliente en una sola agregación que reemplaza la colección"""
+    return [
+        {"$project": {
+            "_id": 0,
+            "cliente_id": 1,
+            "total_usd": 1,
+            "cobrado_usd": {"$sum": {"$ifNull": ["$pagos.monto_usd", []]}},
+            "cobrado_bs": {"$sum": {"$ifNull": ["$pagos.monto_bs", []]}},
+            "abierta": {"$gt": ["$saldo_pendiente_bs", 0]},
+            "saldo_pendiente_bs": {"$max": [0, {"$ifNull": ["$saldo_pendiente_bs", 0]}]},
+            # Mismo cálculo que la reconstrucción de cuentas por cobrar
+            "saldo_pendiente_usd": {"$max": [0, {"$subtract": [
+                {"$add": ["$total_usd", {"$ifNull": ["$igtf_usd", 0]}]},
+                {"$sum": {"$ifNull": ["$pagos.monto_usd", []]}}
+            ]}]},
+        }},
+        {"$group": {
+            "_id": "$cliente_id",
+            "facturas": {"$sum": 1},
+            "facturado_usd": {"$sum": "$total_usd"},
+            "cobrado_usd": {"$sum": "$cobrado_usd"},
+            "cobrado_bs": {"$sum": "$cobrado_bs"},
+            "saldo_bs": {"$sum": "$saldo_pendiente_bs"},
+            "saldo_usd": {"$sum": {"$cond": ["$abierta", "$saldo_pendiente_usd", 0]}},
+            "facturas_abiertas": {"$sum": {"$cond": ["$abierta", 1, 0]}},
+        }},
+        {"$unionWith": {"coll": "ordenes_trabajo", "pipeline": [
+            {"$group": {"_id": "$cliente_id", "visitas": {"$sum": 1}, "ultima_visita": {"$max": "$fecha_ingreso"}}}
+        ]}},
+        {"$group": {
+            "_id": "$_id",
+            **{campo: {"$sum": f"${campo}"} for campo in
+               ["facturas", "facturado_usd", "cobrado_usd", "cobrado_bs", "saldo_bs", "saldo_usd", "facturas_abiertas", "visitas"]},
+            "ultima_visita": {"$max": "$ultima_visita"},
+        }},
+        {"$match": {"_id": {"$ne": None}}},
+        {"$project": {
+            "_id": 0,
+            "cliente_id": "$_id",
+            **{campo: {"$round": [f"${campo}", 2]} for campo in
+               ["facturado_usd", "cobrado_usd", "cobrado_bs", "saldo_bs", "saldo_usd"]},
+            "facturas": 1, "facturas_abiertas": 1, "visitas": 1, "ultima_visita": 1,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }},
+        {"$out": COLECCION},
+    ]
+
+
+async def reconstruir(db) -> int:
+    """Recalcula el resumen de todos los clientes; devuelve cuántos tienen facturas u órdenes"""
+    await db.facturas.aggregate(pipeline_reconstruccion(), allowDiskUse=True).to_list(None)
+    await crear_indices(db)
+    return await db[COLECCION].count_documents({})
+
+
+async def crear_indices(db):
+    await db[COLECCION].create_index("cliente_id", unique=True)
+    # Conteo y última visita por cliente en la reconstrucción
+    await db.ordenes_trabajo.create_index([("cliente_id", 1), ("fecha_ingreso", -1)])
+
+
+async def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    try:
+        print("🔄 Reconstruyendo el resumen de clientes...")
+        clientes = await reconstruir(client[os.environ.get('DB_NAME', 'taller_mecanico')])
+        print(f"✅ {clientes} clientes con actividad")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,180 @@
+"""
+Revalorización de facturas abiertas cuando cambia la tasa de cambio.
+
+Las facturas están denominadas en USD (vienen del presupuesto) y sus campos *_bs son la
+valoración a `tasa_cambio`. Revalorizar cambia esa tasa y recalcula todos los *_bs desde
+los montos en USD, incluido lo ya pagado (suma de pagos.monto_usd), de modo que el saldo
+en Bs sea exactamente el saldo en USD a la tasa nueva. Los montos de emisión (`tasa_emision`,
+`*_bs_emision`) no se tocan: el libro de ventas ya declarado no cambia.
+
+Las facturas pendientes o con pago parcial se leen por lotes con una proyección mínima,
+se recalculan por lote y se escriben con bulk_write. Cada escritura exige la misma
+`version` que se leyó: si entre medio se registró un pago, esa factura se omite en lugar
+de pisar sus totales. Los valores anteriores quedan en la colección `revalorizaciones`.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+
+import cuentas_por_cobrar
+import resumen_clientes
+
+logger = logging.getLogger(__name__)
+
+COLECCION_AUDITORIA = "revalorizaciones"
+REVALORIZACION_BATCH_SIZE = int(os.environ.get('REVALORIZACION_BATCH_SIZE', '1000'))
+ESTADOS_ABIERTOS = ["pendiente", "pagado_parcial"]
+CAMPOS_BS = ["subtotal_bs", "iva_bs", "total_bs", "igtf_bs", "total_final_bs", "monto_pagado_bs", "saldo_pendiente_bs"]
+PROYECCION = {
+    "_id": 0, "id": 1, "numero_factura": 1, "cliente_id": 1, "fecha_facturacion": 1, "version": 1, "tasa_cambio": 1,
+    "subtotal_usd": 1, "iva_usd": 1, "total_usd": 1, "igtf_usd": 1, "pagos.monto_usd": 1,
+    **{campo: 1 for campo in CAMPOS_BS}
+}
+
+
+class RevalorizacionJob:
+    """Estado y progreso de una revalorización en segundo plano"""
+
+    def __init__(self, tasa_nueva: float, tasa_id: Optional[str] = None):
+        self.id = f"revalorizacion-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.tasa_nueva = tasa_nueva
+        self.tasa_id = tasa_id
+        self.estado = "pendiente"  # pendiente, en_progreso, completado, error
+        self.facturas_revalorizadas = 0
+        # Facturas que recibieron un pago mientras se recalculaban: conservan su tasa
+        self.facturas_omitidas: List[str] = []
+        self.error: Optional[str] = None
+        self.iniciado = datetime.now(timezone.utc)
+        self.finalizado: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "estado": self.estado,
+            "tasa_nueva": self.tasa_nueva,
+            "tasa_id": self.tasa_id,
+            "facturas_revalorizadas": self.facturas_revalorizadas,
+            "facturas_omitidas": self.facturas_omitidas,
+            "error": self.error,
+            "iniciado": self.iniciado.isoformat(),
+            "finalizado": self.finalizado.isoformat() if self.finalizado else None,
+        }
+
+
+REVALORIZACION_JOBS: Dict[str, RevalorizacionJob] = {}
+
+
+def revalorizar_factura(factura: Dict, tasa: float) -> Dict[str, float]:
+    """Nuevos valores en Bs de una factura, calculados desde sus montos en USD"""
+    total_usd = factura.get("total_usd", 0.0)
+    igtf_usd = factura.get("igtf_usd", 0.0)
+    pagado_usd = sum(p.get("monto_usd", 0.0) for p in factura.get("pagos", []))
+    total_final_usd = total_usd + igtf_usd
+    return {
+        "subtotal_bs": round(factura.get("subtotal_usd", 0.0) * tasa, 2),
+        "iva_bs": round(factura.get("iva_usd", 0.0) * tasa, 2),
+        "total_bs": round(total_usd * tasa, 2),
+        "igtf_bs": round(igtf_usd * tasa, 2),
+        "total_final_bs": round(total_final_usd * tasa, 2),
+        "monto_pagado_bs": round(pagado_usd * tasa, 2),
+        "saldo_pendiente_bs": round(max(0.0, total_final_usd - pagado_usd) * tasa, 2),
+    }
+
+
+def revalorizar_lote(facturas: List[Dict], tasa: float) -> List[Dict[str, float]]:
+    """Nuevos valores en Bs de cada factura del lote"""
+    return [revalorizar_factura(factura, tasa) for factura in facturas]
+
+
+def filtro_version(factura: Dict) -> Dict:
+    # Las facturas anteriores al control de versiones no tienen el campo
+    version = factura.get("version") or 0
+    return {"id": factura["id"], "version": version if version else {"$in": [0, None]}}
+
+
+async def aplicar_lote(db, job: RevalorizacionJob, facturas: List[Dict]):
+    ahora = datetime.now(timezone.utc).isoformat()
+    nuevos = revalorizar_lote(facturas, job.tasa_nueva)
+    operaciones = [
+        UpdateOne(filtro_version(factura), {
+            "$set": {**valores, "tasa_cambio": job.tasa_nueva, "ultima_revalorizacion": job.id, "updated_at": ahora},
+            "$inc": {"version": 1}
+        })
+        for factura, valores in zip(facturas, nuevos)
+    ]
+    resultado = await db.facturas.bulk_write(operaciones, ordered=False)
+
+    aplicadas = {f["id"] for f in facturas}
+    if resultado.matched_count < len(facturas):
+        marcadas = await db.facturas.find(
+            {"id": {"$in": list(aplicadas)}, "ultima_revalorizacion": job.id}, {"_id": 0, "id": 1}
+        ).to_list(None)
+        aplicadas = {f["id"] for f in marcadas}
+        job.facturas_omitidas.extend(f["id"] for f in facturas if f["id"] not in aplicadas)
+
+    auditoria = [
+        {
+            "id": str(uuid.uuid4()),
+            "revalorizacion_id": job.id,
+            "factura_id": factura["id"],
+            "numero_factura": factura.get("numero_factura"),
+            "tasa_anterior": factura.get("tasa_cambio"),
+            "tasa_nueva": job.tasa_nueva,
+            "tasa_id": job.tasa_id,
+            "valores_anteriores": {campo: factura.get(campo) for campo in CAMPOS_BS},
+            "valores_nuevos": valores,
+            "fecha": ahora,
+            "updated_at": ahora,
+        }
+        for factura, valores in zip(facturas, nuevos)
+        if factura["id"] in aplicadas
+    ]
+    if auditoria:
+        await db[COLECCION_AUDITORIA].insert_many(auditoria)
+        await cuentas_por_cobrar.actualizar_cuentas(db, [
+            {**factura, **valores, "version": (factura.get("version") or 0) + 1}
+            for factura, valores in zip(facturas, nuevos)
+            if factura["id"] in aplicadas
+        ])
+        await resumen_clientes.actualizar_saldos(db, [f["cliente_id"] for f in facturas if f["id"] in aplicadas])
+    job.facturas_revalorizadas += len(auditoria)
+
+
+async def ejecutar_revalorizacion(db, job: RevalorizacionJob):
+    job.estado = "en_progreso"
+    try:
+        cursor = db.facturas.find(
+            {"estado_pago": {"$in": ESTADOS_ABIERTOS}, "tasa_cambio": {"$ne": job.tasa_nueva}}, PROYECCION
+        ).batch_size(REVALORIZACION_BATCH_SIZE)
+        lote = []
+        async for factura in cursor:
+            lote.append(factura)
+            if len(lote) >= REVALORIZACION_BATCH_SIZE:
+                await aplicar_lote(db, job, lote)
+                lote = []
+        if lote:
+            await aplicar_lote(db, job, lote)
+        job.estado = "completado"
+    except Exception as e:
+        logger.error(f"Error en revalorización {job.id}: {e}")
+        job.estado = "error"
+        job.error = str(e)
+    finally:
+        job.finalizado = datetime.now(timezone.utc)
+    return job
+
+
+def iniciar_revalorizacion(db, tasa_nueva: float, tasa_id: Optional[str] = None) -> RevalorizacionJob:
+    """Registra el job y lanza la revalorización como tarea en segundo plano"""
+    if tasa_nueva <= 0:
+        raise ValueError("La tasa de cambio debe ser mayor que cero")
+    job = RevalorizacionJob(tasa_nueva, tasa_id)
+    REVALORIZACION_JOBS[job.id] = job
+    job.task = asyncio.create_task(ejecutar_revalorizacion(db, job))
+    return job
@@ -1,19 +1,42 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request, UploadFile, File, Form
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
+import bson
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime, timezone
+from datetime import date, datetime, timedelta, timezone
 import base64
+import asyncio
+import time
 
 # Import AI integrations
-from emergentintegrations.llm.chat import LlmChat, UserMessage, FileContentWithMimeType
+from ai_providers import AIChat
+from ai_prompts import get_prompt, parse_ai_json, list_prompts
+from ai_router import ai_router, AIDeadlineExceeded
 import json
+import backup_engine
+import dataset_generator
+import revalorizacion
+import cuentas_por_cobrar
+import libro_ventas
+import documentos_pdf
+import linea_tasas
+import catalogo
+import analitica_ingresos
+import cierre_caja
+import conciliacion
+import resumen_clientes
+import flujo_ordenes
+from admin_tasks import ejecutar_por_coleccion
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -31,25 +54,11 @@ api_router = APIRouter(prefix="/api")
 
 # Initialize AI Chat
 def get_ai_chat():
-    return LlmChat(
-        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+    return AIChat(
+        task="extraer_datos",
         session_id=str(uuid.uuid4()),
-        system_message="""Eres un asistente especializado en talleres mecánicos. Tu trabajo es extraer información específica de vehículos a partir de texto dictado o imágenes de matrículas.
-
-Cuando recibas información, extrae y estructura los siguientes datos en formato JSON:
-- matricula: número de matrícula/placa del vehículo
-- marca: marca del vehículo (Toyota, Honda, etc.)
-- modelo: modelo específico del vehículo
-- año: año del vehículo
-- color: color del vehículo
-- kilometraje: kilometraje actual si se menciona
-- cliente_nombre: nombre del cliente
-- cliente_telefono: teléfono del cliente si se menciona
-- cliente_empresa: nombre de la empresa si es una flota
-- observaciones: cualquier observación adicional sobre el estado del vehículo
-
-Si algún dato no está disponible, usa null. Responde SOLO con el JSON, sin texto adicional."""
-    ).with_model("openai", "gpt-4o")
+        system_message=get_prompt("extraer_datos").system_message
+    )
 
 # Define Models
 class Cliente(BaseModel):
@@ -154,12 +163,14 @@ class OrdenTrabajo(BaseModel):
     reparaciones_realizadas: Optional[str] = None  # Trabajos realizados
     repuestos_utilizados: Optional[str] = None  # Lista de repuestos usados
     servicios_repuestos: List[Dict[str, Any]] = []  # [{"id": "service_id", "cantidad": 1, "precio": 100}]
-    estado: str = "recibido"  # "recibido", "diagnosticando", "presupuestado", "aprobado", "en_reparacion", "terminado", "entregado"
+    estado: str = "recibido"  # "recibido", "diagnosticando", "presupuestado", "aprobado", "en_reparacion", "terminado", "entregado", "cancelado"
     presupuesto_total: Optional[float] = None
     fecha_ingreso: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     fecha_estimada_entrega: Optional[datetime] = None
     observaciones: Optional[str] = None
     aprobado_cliente: bool = False
+    estado_desde: Optional[datetime] = None  # Desde cuándo está en el estado actual
+    estado_version: int = 0  # Cantidad de transiciones registradas en eventos_orden
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class OrdenTrabajoCreate(BaseModel):
@@ -181,6 +192,10 @@ class OrdenTrabajoUpdate(BaseModel):
     observaciones: Optional[str] = None
     aprobado_cliente: Optional[bool] = None
 
+class CambioEstadoOrden(BaseModel):
+    estado: str
+    nota: Optional[str] = None
+
 class HistorialKilometraje(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     vehiculo_id: str
@@ -204,20 +219,23 @@ class TasaCambio(BaseModel):
     usuario_actualizacion: Optional[str] = None
     observaciones: Optional[str] = None
     activa: bool = True
+    revalorizacion_id: Optional[str] = None  # Revalorización de facturas lanzada con esta tasa
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class TasaCambioCreate(BaseModel):
-    tasa_bs_usd: float
+    tasa_bs_usd: float = Field(gt=0)
     observaciones: Optional[str] = None
+    revalorizar: bool = False  # Recalcular los Bs de las facturas abiertas con la nueva tasa
 
 # Sistema de Presupuestos
 class ItemPresupuesto(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    catalogo_id: Optional[str] = None  # Ítem de servicios_repuestos del que salió el precio
     tipo: str  # "servicio" o "repuesto"
     descripcion: str
     cantidad: int
     precio_unitario_usd: float
-    total_usd: float
+    total_usd: float = 0.0  # Lo calcula el servidor: cantidad x precio unitario
 
 class Presupuesto(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -236,11 +254,26 @@ class Presupuesto(BaseModel):
     observaciones: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class LineaCotizacion(BaseModel):
+    catalogo_id: str
+    cantidad: int = Field(default=1, gt=0)
+
+class CotizarPresupuesto(BaseModel):
+    lineas: List[LineaCotizacion]
+
+class ItemManualPresupuesto(BaseModel):
+    catalogo_id: Optional[str] = None  # Solo para rechazarlo: los ítems del catálogo van en `lineas`
+    tipo: str  # "servicio" o "repuesto"
+    descripcion: str
+    cantidad: int = Field(gt=0)
+    precio_unitario_usd: float = Field(ge=0)
+
 class PresupuestoCreate(BaseModel):
     vehiculo_id: str
     cliente_id: str
     orden_trabajo_id: Optional[str] = None
-    items: List[ItemPresupuesto] = []
+    lineas: List[LineaCotizacion] = []  # Ítems del catálogo: precio y descripción los pone el servidor
+    items: List[ItemManualPresupuesto] = []  # Ítems fuera de catálogo con precio manual
     observaciones: Optional[str] = None
 
 # Sistema de Facturas
@@ -251,7 +284,9 @@ class MetodoPago(BaseModel):
     monto_usd: float
     monto_bs: float
     referencia: Optional[str] = None  # Número de referencia del pago
+    referencia_norm: Optional[str] = None  # Referencia normalizada para la conciliación bancaria
     fecha_pago: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    tasa_cambio: Optional[float] = None  # Tasa vigente en fecha_pago usada para convertir entre Bs y USD
 
 class Factura(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -277,12 +312,21 @@ class Factura(BaseModel):
     igtf_usd: float = 0.0
     igtf_bs: float = 0.0
     total_final_bs: float  # Total + IGTF si aplica
+    # Montos en Bs a la tasa del día de emisión: no cambian con las revalorizaciones y son los
+    # que declara el libro de ventas (las facturas anteriores los reciben por migración)
+    tasa_emision: Optional[float] = None
+    subtotal_bs_emision: Optional[float] = None
+    iva_bs_emision: Optional[float] = None
+    total_bs_emision: Optional[float] = None
     # Pagos realizados
     pagos: List[MetodoPago] = []
+    # Suma de pagos.monto_usd valorada a tasa_cambio de la factura (no los Bs recibidos el día
+    # de cada pago): es comparable con total_final_bs y se revaloriza junto con él
     monto_pagado_bs: float = 0.0
     saldo_pendiente_bs: float = 0.0
     # Estados
     estado_pago: str = "pendiente"  # pendiente, pagado_parcial, pagado_total
+    version: int = 0  # Se incrementa con cada pago registrado
     fecha_facturacion: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     fecha_vencimiento: Optional[datetime] = None
     observaciones: Optional[str] = None
@@ -293,6 +337,11 @@ class FacturaCreate(BaseModel):
     fecha_vencimiento: Optional[datetime] = None
     observaciones: Optional[str] = None
 
+class FacturacionLote(BaseModel):
+    presupuesto_ids: List[str]  # Presupuestos aprobados; se emite una factura por cada uno
+    fecha_vencimiento: Optional[datetime] = None
+    observaciones: Optional[str] = None
+
 class RegistrarPago(BaseModel):
     factura_id: str
     tipo: str  # "bolivares" o "dolares"
@@ -300,23 +349,46 @@ class RegistrarPago(BaseModel):
     monto_usd: Optional[float] = None
     monto_bs: Optional[float] = None
     referencia: Optional[str] = None
+    fecha_pago: Optional[datetime] = None  # Para pagos registrados con fecha pasada; por defecto ahora
+
+class MontoDeclarado(BaseModel):
+    tipo: str  # "bolivares" o "dolares"
+    metodo: str
+    monto: float  # En la moneda del tipo: Bs o USD
+
+class CierreCajaCreate(BaseModel):
+    fecha: Optional[date] = None  # Por defecto hoy
+    cajero: Optional[str] = None
+    declarado: List[MontoDeclarado] = []  # Lo contado en caja por moneda y método
+    observaciones: Optional[str] = None
 
 class AIExtraRequest(BaseModel):
     texto_dictado: Optional[str] = None
     imagen_base64: Optional[str] = None
+    deadline_ms: Optional[int] = None  # Presupuesto de tiempo del cliente (también vía cabecera X-Deadline-Ms)
+    hedge: Optional[bool] = None  # Forzar/desactivar petición de cobertura a un modelo alterno
 
 # Modelos para administración de bases de datos
 class ResetDatabase(BaseModel):
     collections: List[str]  # Lista de colecciones a resetear
     create_sample_data: bool = False  # Si crear datos de ejemplo
+    modo: str = "drop"  # "drop" elimina y recrea la colección; "delete" borra documento a documento
 
 class BackupDatabase(BaseModel):
     collections: Optional[List[str]] = None  # Si None, hace backup de todo
+    formato: str = "ndjson"  # "ndjson" (Extended JSON por línea) o "bson"
+    compresion: str = "gzip"  # "gzip" o "zstd"
+    tipo: str = "completo"  # "completo", "incremental" (desde el último de la cadena) o "diferencial" (desde el completo)
+    base_id: Optional[str] = None  # Backup completo base; por defecto el más reciente
+
+class GenerarDatosSinteticos(BaseModel):
+    clientes: int = 1000  # ~20 documentos por cliente entre vehículos, órdenes, presupuestos y facturas
+    semilla: int = 42  # Misma semilla y misma fecha_fin producen el mismo dataset
+    fecha_fin: Optional[datetime] = None  # Último día del historial; por defecto hoy
+    batch_size: int = 1000
+    concurrencia: int = 8  # Lotes de insert_many en vuelo a la vez
+    vaciar: bool = False  # Vaciar antes las colecciones del dataset; sin esto solo se genera sobre colecciones vacías
     
-class RestoreDatabase(BaseModel):
-    backup_data: Dict[str, List[Dict]]  # Datos del backup a restaurar
-    collections: Optional[List[str]] = None  # Colecciones específicas a restaurar
-
 # Helper functions
 def convert_to_uppercase(data):
     """Convert text fields to uppercase for Venezuelan requirements"""
@@ -339,6 +411,21 @@ def prepare_for_mongo(data):
                 data[key] = value.isoformat()
     return data
 
+def con_updated_at(data):
+    """Marca un documento (o un $set) con la hora de modificación; es la marca de agua de los backups incrementales"""
+    data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    return data
+
+async def registrar_eliminacion(coleccion: str, documento_id: Optional[str] = None):
+    """Deja una lápida en `eliminaciones` para que los backups incrementales repliquen el borrado.
+    Sin documento_id indica que se vació la colección completa."""
+    await db.eliminaciones.insert_one(backup_engine.lapida(coleccion, documento_id))
+
+async def registrar_eliminaciones(coleccion: str, documento_ids: List[str]):
+    """Lápidas de varios documentos con un solo insert_many"""
+    ahora = datetime.now(timezone.utc).isoformat()
+    await db.eliminaciones.insert_many([backup_engine.lapida(coleccion, documento_id, ahora) for documento_id in documento_ids])
+
 def parse_from_mongo(item):
     """Parse datetime strings back from MongoDB"""
     if isinstance(item, dict):
@@ -350,82 +437,102 @@ def parse_from_mongo(item):
                     pass
     return item
 
+# Presupuesto de tiempo de las llamadas de IA
+AI_DEFAULT_DEADLINE_SECONDS = float(os.environ.get('AI_DEFAULT_DEADLINE_SECONDS', '15'))
+AI_MAX_DEADLINE_SECONDS = float(os.environ.get('AI_MAX_DEADLINE_SECONDS', '60'))
+
+def resolver_deadline(http_request: Request, deadline_ms: Optional[int] = None) -> float:
+    """Instante límite (time.monotonic) a partir del presupuesto del cliente o el predeterminado"""
+    valor = deadline_ms or http_request.headers.get('X-Deadline-Ms')
+    try:
+        segundos = float(valor) / 1000 if valor else AI_DEFAULT_DEADLINE_SECONDS
+    except ValueError:
+        segundos = AI_DEFAULT_DEADLINE_SECONDS
+    return time.monotonic() + min(max(segundos, 0.0), AI_MAX_DEADLINE_SECONDS)
+
+async def ejecutar_cancelable(http_request: Request, coro):
+    """Ejecuta la llamada a la IA y la cancela si el cliente se desconecta antes de la respuesta"""
+    tarea = asyncio.create_task(coro)
+    try:
+        while True:
+            hechas, _ = await asyncio.wait({tarea}, timeout=0.5)
+            if hechas:
+                return tarea.result()
+            if await http_request.is_disconnected():
+                tarea.cancel()
+                raise HTTPException(status_code=499, detail="Cliente desconectado")
+    finally:
+        if not tarea.done():
+            tarea.cancel()
+
 # AI Routes
 @api_router.post("/ai/extraer-datos")
-async def extraer_datos_vehiculo(request: AIExtraRequest):
+async def extraer_datos_vehiculo(request: AIExtraRequest, http_request: Request):
     """Extrae datos del vehículo usando IA a partir de texto dictado o imagen de matrícula"""
     try:
         chat = get_ai_chat()
+        deadline = resolver_deadline(http_request, request.deadline_ms)
         
         if request.imagen_base64:
             # Procesar imagen de matrícula
             try:
-                # Decode base64 image
-                image_data = base64.b64decode(request.imagen_base64.split(',')[1] if ',' in request.imagen_base64 else request.imagen_base64)
-                
-                # Save temporarily for AI processing
-                temp_path = f"/tmp/matricula_{uuid.uuid4()}.jpg"
-                with open(temp_path, "wb") as f:
-                    f.write(image_data)
+                imagen_base64 = request.imagen_base64.split(',')[1] if ',' in request.imagen_base64 else request.imagen_base64
+                # Validar que la imagen sea base64 válido antes de enviarla
+                base64.b64decode(imagen_base64)
                 
-                # Create file content for AI
-                image_file = FileContentWithMimeType(
-                    file_path=temp_path,
-                    mime_type="image/jpeg"
-                )
-                
-                user_message = UserMessage(
-                    text="Extrae la información de la matrícula/placa de este vehículo y cualquier otra información visible del vehículo (marca, modelo, color, etc.). Responde en formato JSON.",
-                    file_contents=[image_file]
-                )
-                
-                response = await chat.send_message(user_message)
-                
-                # Clean up temp file
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
+                response = await ejecutar_cancelable(http_request, chat.send_message(
+                    get_prompt("extraer_datos_imagen").render(),
+                    images=[imagen_base64], deadline=deadline, hedge=request.hedge
+                ))
                     
+            except (AIDeadlineExceeded, HTTPException):
+                raise
             except Exception as e:
                 raise HTTPException(status_code=400, detail=f"Error procesando imagen: {str(e)}")
         
         elif request.texto_dictado:
             # Procesar texto dictado
-            user_message = UserMessage(
-                text=f"Extrae la información del vehículo del siguiente texto dictado: {request.texto_dictado}"
-            )
-            response = await chat.send_message(user_message)
+            response = await ejecutar_cancelable(http_request, chat.send_message(
+                get_prompt("extraer_datos").render(texto=request.texto_dictado),
+                deadline=deadline, hedge=request.hedge
+            ))
         
         else:
             raise HTTPException(status_code=400, detail="Se requiere texto dictado o imagen")
         
         # Parse AI response
         try:
-            # Clean the response to get just the JSON
-            json_str = response.strip()
-            if json_str.startswith('```json'):
-                json_str = json_str[7:-3]
-            elif json_str.startswith('```'):
-                json_str = json_str[3:-3]
-            
-            datos_extraidos = json.loads(json_str)
+            datos_extraidos = parse_ai_json(response)
             return {"success": True, "datos": datos_extraidos}
             
         except json.JSONDecodeError:
             # If JSON parsing fails, return the raw response for debugging
             return {"success": False, "error": "Error parsing AI response", "raw_response": response}
             
+    except HTTPException:
+        raise
+    except AIDeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=f"La IA no respondió dentro del tiempo límite: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en extracción de datos: {str(e)}")
 
+@api_router.get("/ai/prompts")
+async def obtener_plantillas_prompts():
+    """Lista las plantillas de prompts registradas con su versión y hash del prefijo estático"""
+    return {"success": True, "prompts": list_prompts()}
+
+@api_router.get("/ai/rutas")
+async def obtener_rutas_ia():
+    """Modelos candidatos por nivel y latencias p50/p95 y tasa de error por modelo"""
+    return {"success": True, **ai_router.report()}
+
 # Cliente Routes
 @api_router.post("/clientes", response_model=Cliente)
 async def crear_cliente(cliente: ClienteCreate):
     cliente_dict = convert_to_uppercase(cliente.dict())
     cliente_dict = prepare_for_mongo(cliente_dict)
     cliente_obj = Cliente(**cliente_dict)
-    await db.clientes.insert_one(prepare_for_mongo(cliente_obj.dict()))
+    await db.clientes.insert_one(con_updated_at(prepare_for_mongo(cliente_obj.dict())))
     return cliente_obj
 
 @api_router.put("/clientes/{cliente_id}", response_model=Cliente)
@@ -440,7 +547,7 @@ async def actualizar_cliente(cliente_id: str, datos: dict):
     datos_actualizacion = {k: v for k, v in datos.items() if k in campos_permitidos}
     datos_actualizacion = prepare_for_mongo(datos_actualizacion)
     
-    await db.clientes.update_one({"id": cliente_id}, {"$set": datos_actualizacion})
+    await db.clientes.update_one({"id": cliente_id}, {"$set": con_updated_at(datos_actualizacion)})
     
     cliente_actualizado = await db.clientes.find_one({"id": cliente_id})
     return Cliente(**parse_from_mongo(cliente_actualizado))
@@ -457,6 +564,13 @@ async def obtener_cliente(cliente_id: str):
         raise HTTPException(status_code=404, detail="Cliente no encontrado")
     return Cliente(**parse_from_mongo(cliente))
 
+@api_router.get("/clientes/{cliente_id}/resumen")
+async def obtener_resumen_cliente(cliente_id: str):
+    """Saldo abierto, visitas, última visita e ingresos históricos del cliente, sin recorrer sus facturas"""
+    if not await db.clientes.find_one({"id": cliente_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    return {"success": True, "resumen": await resumen_clientes.obtener(db, cliente_id)}
+
 # Verificar matrícula única
 @api_router.get("/vehiculos/verificar-matricula/{matricula}")
 async def verificar_matricula_unica(matricula: str):
@@ -483,7 +597,7 @@ async def actualizar_vehiculo(vehiculo_id: str, datos: dict):
     datos_actualizacion = {k: v for k, v in datos.items() if k in campos_permitidos}
     datos_actualizacion = prepare_for_mongo(datos_actualizacion)
     
-    await db.vehiculos.update_one({"id": vehiculo_id}, {"$set": datos_actualizacion})
+    await db.vehiculos.update_one({"id": vehiculo_id}, {"$set": con_updated_at(datos_actualizacion)})
     
     vehiculo_actualizado = await db.vehiculos.find_one({"id": vehiculo_id})
     return Vehiculo(**parse_from_mongo(vehiculo_actualizado))
@@ -524,13 +638,16 @@ async def cambiar_matricula_vehiculo(vehiculo_id: str, datos: dict):
         "usuario": "sistema"  # En el futuro se puede agregar autenticación
     }
     
-    await db.cambios_matricula.insert_one(prepare_for_mongo(registro_cambio))
+    # Actualizar la matrícula del vehículo (antes del registro, por si el índice único la rechaza)
+    try:
+        await db.vehiculos.update_one(
+            {"id": vehiculo_id}, 
+            {"$set": con_updated_at({"matricula": matricula_nueva})}
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="La nueva matrícula ya está registrada")
     
-    # Actualizar la matrícula del vehículo
-    await db.vehiculos.update_one(
-        {"id": vehiculo_id}, 
-        {"$set": {"matricula": matricula_nueva}}
-    )
+    await db.cambios_matricula.insert_one(con_updated_at(prepare_for_mongo(registro_cambio)))
     
     return {"success": True, "matricula_anterior": matricula_anterior, "matricula_nueva": matricula_nueva}
 
@@ -545,7 +662,7 @@ async def eliminar_vehiculo(vehiculo_id: str):
     # Verificar que no tenga órdenes activas
     ordenes_activas = await db.ordenes_trabajo.find({
         "vehiculo_id": vehiculo_id,
-        "estado": {"$nin": ["terminado", "entregado"]}
+        "estado": {"$nin": ["terminado", *flujo_ordenes.ESTADOS_FINALES]}
     }).to_list(1)
     
     if ordenes_activas:
@@ -561,55 +678,109 @@ async def eliminar_vehiculo(vehiculo_id: str):
         "fecha_eliminacion": datetime.now(timezone.utc),
         "usuario": "sistema"
     }
-    await db.vehiculos_eliminados.insert_one(prepare_for_mongo(registro_eliminacion))
+    await db.vehiculos_eliminados.insert_one(con_updated_at(prepare_for_mongo(registro_eliminacion)))
     
     # Eliminar vehículo
     await db.vehiculos.delete_one({"id": vehiculo_id})
+    await registrar_eliminacion("vehiculos", vehiculo_id)
     
     # Marcar órdenes como "vehículo eliminado" en lugar de eliminarlas
     await db.ordenes_trabajo.update_many(
         {"vehiculo_id": vehiculo_id},
-        {"$set": {"vehiculo_eliminado": True, "matricula_original": vehiculo["matricula"]}}
+        {"$set": con_updated_at({"vehiculo_eliminado": True, "matricula_original": vehiculo["matricula"]})}
     )
     
     return {"success": True, "matricula": vehiculo["matricula"]}
 
-# Endpoint temporal para limpiar duplicados
+# Matrícula normalizada en el servidor: sin espacios a los lados y en mayúsculas
+MATRICULA_NORMALIZADA = {"$toUpper": {"$trim": {"input": "$matricula"}}}
+LOTE_LIMPIEZA = 1000
+INDICE_MATRICULA_UNICA = "matricula_unica"
+MAX_DETALLES_LIMPIEZA = 1000
+
+async def aplicar_en_lotes(coleccion, operaciones) -> int:
+    """Ejecuta un iterable asíncrono de operaciones con bulk_write en lotes sin orden"""
+    lote, total = [], 0
+    async for operacion in operaciones:
+        lote.append(operacion)
+        if len(lote) >= LOTE_LIMPIEZA:
+            await coleccion.bulk_write(lote, ordered=False)
+            total += len(lote)
+            lote = []
+    if lote:
+        await coleccion.bulk_write(lote, ordered=False)
+        total += len(lote)
+    return total
+
 @api_router.post("/admin/limpiar-duplicados")
-async def limpiar_matriculas_duplicadas():
-    """Elimina vehículos con matrículas duplicadas, manteniendo el más reciente"""
-    vehiculos = await db.vehiculos.find().to_list(1000)
-    matriculas_vistas = {}
-    duplicados_eliminados = []
+async def limpiar_matriculas_duplicadas(dry_run: bool = False):
+    """
+    Elimina vehículos con matrículas duplicadas (comparadas ya normalizadas), manteniendo el más
+    reciente, y normaliza el resto. Los duplicados se buscan con $group en toda la colección y
+    los cambios se aplican con bulk_write por lotes. Con dry_run solo informa lo que cambiaría.
+    Al terminar se asegura el índice único sobre matricula.
+    """
+    # Grupos con más de un vehículo por matrícula; el primero de cada grupo es el más reciente
+    grupos = db.vehiculos.aggregate([
+        {"$match": {"matricula": {"$type": "string"}}},
+        {"$sort": {"created_at": -1}},
+        {"$group": {
+            "_id": MATRICULA_NORMALIZADA,
+            "vehiculos": {"$push": {"id": "$id", "matricula": "$matricula", "created_at": "$created_at"}},
+            "total": {"$sum": 1}
+        }},
+        {"$match": {"total": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    
+    duplicados = []
+    async for grupo in grupos:
+        for vehiculo in grupo["vehiculos"][1:]:
+            duplicados.append({**vehiculo, "matricula_normalizada": grupo["_id"]})
+    ids_duplicados = {d["id"] for d in duplicados}
+    
+    # Vehículos que quedan y cuya matrícula no está normalizada
+    pendientes_normalizar = db.vehiculos.aggregate([
+        {"$match": {"matricula": {"$type": "string"}, "$expr": {"$ne": ["$matricula", MATRICULA_NORMALIZADA]}}},
+        {"$project": {"_id": 0, "id": 1, "matricula": 1}}
+    ], allowDiskUse=True)
+    
+    if dry_run:
+        normalizar = [v async for v in pendientes_normalizar if v["id"] not in ids_duplicados]
+        return {
+            "dry_run": True,
+            "duplicados_a_eliminar": len(duplicados),
+            "matriculas_a_normalizar": len(normalizar),
+            "detalles": duplicados[:MAX_DETALLES_LIMPIEZA],
+            "normalizaciones": normalizar[:MAX_DETALLES_LIMPIEZA]
+        }
     
-    # Normalizar todas las matrículas a mayúsculas primero
-    for vehiculo in vehiculos:
-        matricula_normalizada = vehiculo["matricula"].upper()
-        await db.vehiculos.update_one(
-            {"id": vehiculo["id"]}, 
-            {"$set": {"matricula": matricula_normalizada}}
-        )
+    async def borrados():
+        for duplicado in duplicados:
+            yield DeleteOne({"id": duplicado["id"]})
     
-    # Obtener vehículos actualizados
-    vehiculos = await db.vehiculos.find().sort("created_at", -1).to_list(1000)
-    
-    for vehiculo in vehiculos:
-        matricula = vehiculo["matricula"]
-        if matricula in matriculas_vistas:
-            # Es un duplicado, eliminar
-            await db.vehiculos.delete_one({"id": vehiculo["id"]})
-            duplicados_eliminados.append({
-                "id": vehiculo["id"],
-                "matricula": matricula,
-                "created_at": vehiculo.get("created_at")
-            })
-        else:
-            matriculas_vistas[matricula] = vehiculo
+    eliminados = await aplicar_en_lotes(db.vehiculos, borrados())
+    if duplicados:
+        await registrar_eliminaciones("vehiculos", [d["id"] for d in duplicados])
+    
+    marca = con_updated_at({})["updated_at"]
+    
+    async def normalizaciones():
+        async for vehiculo in pendientes_normalizar:
+            if vehiculo["id"] not in ids_duplicados:
+                yield UpdateOne(
+                    {"id": vehiculo["id"]},
+                    {"$set": {"matricula": vehiculo["matricula"].strip().upper(), "updated_at": marca}}
+                )
+    
+    normalizadas = await aplicar_en_lotes(db.vehiculos, normalizaciones())
+    await db.vehiculos.create_index("matricula", unique=True, name=INDICE_MATRICULA_UNICA)
     
     return {
-        "duplicados_eliminados": len(duplicados_eliminados),
-        "detalles": duplicados_eliminados,
-        "matriculas_unicas_restantes": len(matriculas_vistas)
+        "dry_run": False,
+        "duplicados_eliminados": eliminados,
+        "matriculas_normalizadas": normalizadas,
+        "detalles": duplicados[:MAX_DETALLES_LIMPIEZA],
+        "matriculas_unicas_restantes": await db.vehiculos.estimated_document_count()
     }
 
 # Vehículo Routes
@@ -639,7 +810,11 @@ async def crear_vehiculo(vehiculo: VehiculoCreate):
     # Crear vehículo
     vehiculo_dict = prepare_for_mongo(vehiculo_dict)
     vehiculo_obj = Vehiculo(**vehiculo_dict)
-    await db.vehiculos.insert_one(prepare_for_mongo(vehiculo_obj.dict()))
+    try:
+        await db.vehiculos.insert_one(con_updated_at(prepare_for_mongo(vehiculo_obj.dict())))
+    except DuplicateKeyError:
+        # Otro registro concurrente ganó la matrícula entre la verificación y la inserción
+        raise HTTPException(status_code=400, detail="Esta matrícula ya está registrada")
     return vehiculo_obj
 
 @api_router.get("/vehiculos", response_model=List[Vehiculo])
@@ -659,7 +834,7 @@ async def obtener_vehiculo(vehiculo_id: str):
 async def crear_mecanico(mecanico: MecanicoCreate):
     mecanico_dict = prepare_for_mongo(mecanico.dict())
     mecanico_obj = MecanicoEspecialista(**mecanico_dict)
-    await db.mecanicos.insert_one(prepare_for_mongo(mecanico_obj.dict()))
+    await db.mecanicos.insert_one(con_updated_at(prepare_for_mongo(mecanico_obj.dict())))
     return mecanico_obj
 
 @api_router.put("/mecanicos/{mecanico_id}", response_model=MecanicoEspecialista)
@@ -674,7 +849,7 @@ async def actualizar_mecanico(mecanico_id: str, datos: dict):
     datos_actualizacion = {k: v for k, v in datos.items() if k in campos_permitidos}
     datos_actualizacion = prepare_for_mongo(datos_actualizacion)
     
-    await db.mecanicos.update_one({"id": mecanico_id}, {"$set": datos_actualizacion})
+    await db.mecanicos.update_one({"id": mecanico_id}, {"$set": con_updated_at(datos_actualizacion)})
     
     mecanico_actualizado = await db.mecanicos.find_one({"id": mecanico_id})
     return MecanicoEspecialista(**parse_from_mongo(mecanico_actualizado))
@@ -689,7 +864,7 @@ async def eliminar_mecanico(mecanico_id: str):
     # Verificar si el mecánico tiene órdenes asignadas
     ordenes_activas = await db.ordenes_trabajo.count_documents({
         "mecanico_id": mecanico_id,
-        "estado": {"$ne": "entregado"}
+        "estado": {"$nin": flujo_ordenes.ESTADOS_FINALES}
     })
     
     if ordenes_activas > 0:
@@ -699,6 +874,7 @@ async def eliminar_mecanico(mecanico_id: str):
         )
     
     await db.mecanicos.delete_one({"id": mecanico_id})
+    await registrar_eliminacion("mecanicos", mecanico_id)
     return {"message": "Mecánico eliminado correctamente"}
 
 @api_router.get("/mecanicos", response_model=List[MecanicoEspecialista])
@@ -716,7 +892,8 @@ async def obtener_mecanicos_activos():
 async def crear_servicio_repuesto(item: ServicioRepuestoCreate):
     item_dict = prepare_for_mongo(item.dict())
     item_obj = ServicioRepuesto(**item_dict)
-    await db.servicios_repuestos.insert_one(prepare_for_mongo(item_obj.dict()))
+    await db.servicios_repuestos.insert_one(con_updated_at(prepare_for_mongo(item_obj.dict())))
+    catalogo.CATALOGO.actualizar_item(item_obj.dict())
     return item_obj
 
 @api_router.get("/servicios-repuestos", response_model=List[ServicioRepuesto])
@@ -757,9 +934,10 @@ async def actualizar_servicio_repuesto(item_id: str, datos: dict):
     datos_actualizacion = {k: v for k, v in datos.items() if k in campos_permitidos}
     datos_actualizacion = prepare_for_mongo(datos_actualizacion)
     
-    await db.servicios_repuestos.update_one({"id": item_id}, {"$set": datos_actualizacion})
+    await db.servicios_repuestos.update_one({"id": item_id}, {"$set": con_updated_at(datos_actualizacion)})
     
     item_actualizado = await db.servicios_repuestos.find_one({"id": item_id})
+    catalogo.CATALOGO.actualizar_item(item_actualizado)
     return ServicioRepuesto(**parse_from_mongo(item_actualizado))
 
 # Eliminar servicio/repuesto
@@ -773,7 +951,7 @@ async def eliminar_servicio_repuesto(item_id: str):
     # Verificar si está siendo usado en alguna orden activa
     ordenes_con_item = await db.ordenes_trabajo.find({
         "servicios_repuestos.id": item_id,
-        "estado": {"$nin": ["terminado", "entregado"]}
+        "estado": {"$nin": ["terminado", *flujo_ordenes.ESTADOS_FINALES]}
     }).to_list(1)
     
     if ordenes_con_item:
@@ -783,6 +961,8 @@ async def eliminar_servicio_repuesto(item_id: str):
         )
     
     await db.servicios_repuestos.delete_one({"id": item_id})
+    await registrar_eliminacion("servicios_repuestos", item_id)
+    catalogo.CATALOGO.quitar_item(item_id)
     return {"success": True, "item_eliminado": item["nombre"]}
 
 # Órdenes de Trabajo Routes
@@ -799,7 +979,12 @@ async def crear_orden_trabajo(orden: OrdenTrabajoCreate):
     
     orden_dict = prepare_for_mongo(orden.dict())
     orden_obj = OrdenTrabajo(**orden_dict)
-    await db.ordenes_trabajo.insert_one(prepare_for_mongo(orden_obj.dict()))
+    orden_obj.estado_desde = orden_obj.fecha_ingreso
+    orden_obj.estado_version = 1
+    orden_doc = con_updated_at(prepare_for_mongo(orden_obj.dict()))
+    await db.ordenes_trabajo.insert_one(orden_doc)
+    await flujo_ordenes.registrar_creacion(db, orden_doc)
+    await resumen_clientes.registrar_visita(db, orden_doc)
     return orden_obj
 
 @api_router.get("/ordenes", response_model=List[OrdenTrabajo])
@@ -807,15 +992,15 @@ async def obtener_ordenes_trabajo(estado: Optional[str] = None, filtro: Optional
     """
     Obtiene órdenes de trabajo con filtros opcionales
     - estado: filtrar por estado específico
-    - filtro: 'activas' para estados no entregados, 'entregadas' para entregadas, 'todas' para todas
+    - filtro: 'activas' para estados no finales (ni entregadas ni canceladas), 'entregadas' para entregadas, 'todas' para todas
     """
     query = {}
     
     if estado:
         query["estado"] = estado
     elif filtro == "activas":
-        # Estados activos (no entregadas)
-        query["estado"] = {"$ne": "entregado"}
+        # Estados activos (ni entregadas ni canceladas)
+        query["estado"] = {"$nin": flujo_ordenes.ESTADOS_FINALES}
     elif filtro == "entregadas":
         # Solo órdenes entregadas
         query["estado"] = "entregado"
@@ -824,6 +1009,21 @@ async def obtener_ordenes_trabajo(estado: Optional[str] = None, filtro: Optional
     ordenes = await db.ordenes_trabajo.find(query).sort("created_at", -1).to_list(1000)
     return [OrdenTrabajo(**parse_from_mongo(orden)) for orden in ordenes]
 
+@api_router.get("/ordenes/estados")
+async def obtener_estados_ordenes():
+    """Estados de una orden y a cuáles se puede pasar desde cada uno, para los formularios"""
+    return {
+        "success": True,
+        "estados": flujo_ordenes.ESTADOS,
+        "finales": flujo_ordenes.ESTADOS_FINALES,
+        "transiciones": flujo_ordenes.TRANSICIONES,
+    }
+
+@api_router.get("/ordenes/eventos")
+async def obtener_eventos_ordenes(despues_de: int = 0, limite: int = flujo_ordenes.MAX_EVENTOS_POR_LECTURA):
+    """Transiciones de todas las órdenes posteriores a la secuencia indicada, para proyecciones incrementales"""
+    return {"success": True, **await flujo_ordenes.eventos_desde(db, despues_de, limite)}
+
 @api_router.get("/ordenes/{orden_id}", response_model=OrdenTrabajo)
 async def obtener_orden_trabajo(orden_id: str):
     orden = await db.ordenes_trabajo.find_one({"id": orden_id})
@@ -841,12 +1041,50 @@ async def actualizar_orden_trabajo(orden_id: str, actualizacion: OrdenTrabajoUpd
     update_data = {k: v for k, v in actualizacion.dict().items() if v is not None}
     update_data = prepare_for_mongo(update_data)
     
-    await db.ordenes_trabajo.update_one({"id": orden_id}, {"$set": update_data})
+    # Un cambio de estado pasa por la máquina de estados y queda en eventos_orden
+    nuevo_estado = update_data.pop("estado", None)
+    if nuevo_estado and nuevo_estado != orden.get("estado"):
+        orden_actualizada = await cambiar_estado(orden, nuevo_estado, update_data)
+        return OrdenTrabajo(**parse_from_mongo(orden_actualizada))
+    
+    await db.ordenes_trabajo.update_one({"id": orden_id}, {"$set": con_updated_at(update_data)})
     
     # Obtener orden actualizada
     orden_actualizada = await db.ordenes_trabajo.find_one({"id": orden_id})
     return OrdenTrabajo(**parse_from_mongo(orden_actualizada))
 
+async def cambiar_estado(orden: dict, estado: str, cambios: Optional[dict] = None, nota: Optional[str] = None) -> dict:
+    try:
+        return await flujo_ordenes.transicionar(db, orden, estado, cambios, nota)
+    except flujo_ordenes.TransicionInvalida as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except flujo_ordenes.OrdenModificada as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@api_router.post("/ordenes/{orden_id}/estado", response_model=OrdenTrabajo)
+async def cambiar_estado_orden(orden_id: str, request: CambioEstadoOrden):
+    """Pasa la orden a un estado permitido desde el actual (con una nota opcional que queda en el evento)"""
+    orden = await db.ordenes_trabajo.find_one({"id": orden_id})
+    if not orden:
+        raise HTTPException(status_code=404, detail="Orden de trabajo no encontrada")
+    orden_actualizada = await cambiar_estado(orden, request.estado, nota=request.nota)
+    return OrdenTrabajo(**parse_from_mongo(orden_actualizada))
+
+@api_router.get("/ordenes/{orden_id}/eventos")
+async def obtener_eventos_orden(orden_id: str):
+    """Historial de estados de la orden con el tiempo que pasó en cada uno"""
+    if not await db.ordenes_trabajo.find_one({"id": orden_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Orden de trabajo no encontrada")
+    return {"success": True, "eventos": await flujo_ordenes.eventos_de_orden(db, orden_id)}
+
+@api_router.get("/reportes/ordenes/tiempos-por-estado")
+async def reporte_tiempos_por_estado(desde: Optional[datetime] = None, hasta: Optional[datetime] = None):
+    """Promedio, mínimo y máximo de horas que pasan las órdenes en cada estado, desde eventos_orden"""
+    for fecha in (desde, hasta):
+        if fecha and not fecha.tzinfo:
+            raise HTTPException(status_code=400, detail="Las fechas deben incluir zona horaria")
+    return {"success": True, "estados": await flujo_ordenes.tiempos_por_estado(db, desde, hasta)}
+
 # Dashboard Routes
 @api_router.get("/dashboard/estadisticas")
 async def obtener_estadisticas():
@@ -902,12 +1140,12 @@ async def actualizar_kilometraje_vehiculo(vehiculo_id: str, datos: HistorialKilo
     historial_obj = HistorialKilometraje(**historial_data)
     
     # Guardar historial en base de datos
-    await db.historial_kilometraje.insert_one(prepare_for_mongo(historial_obj.dict()))
+    await db.historial_kilometraje.insert_one(con_updated_at(prepare_for_mongo(historial_obj.dict())))
     
     # Actualizar kilometraje del vehículo
     await db.vehiculos.update_one(
         {"id": vehiculo_id}, 
-        {"$set": {"kilometraje": datos.kilometraje_nuevo}}
+        {"$set": con_updated_at({"kilometraje": datos.kilometraje_nuevo})}
     )
     
     return historial_obj
@@ -1000,16 +1238,50 @@ async def busqueda_generalizada(q: str):
 @api_router.post("/tasa-cambio", response_model=TasaCambio)
 async def crear_tasa_cambio(tasa: TasaCambioCreate):
     """Crear/actualizar tasa de cambio"""
-    # Desactivar tasa anterior
-    await db.tasas_cambio.update_many({"activa": True}, {"$set": {"activa": False}})
-    
-    # Crear nueva tasa activa
-    tasa_dict = prepare_for_mongo(tasa.dict())
+    # Crear nueva tasa activa (la tasa ya viene validada > 0 por el modelo)
+    tasa_dict = prepare_for_mongo(tasa.dict(exclude={"revalorizar"}))
     tasa_obj = TasaCambio(**tasa_dict)
-    await db.tasas_cambio.insert_one(prepare_for_mongo(tasa_obj.dict()))
+    await db.tasas_cambio.insert_one(con_updated_at(prepare_for_mongo(tasa_obj.dict())))
+    linea_tasas.LINEA_TASAS.agregar(tasa_obj.fecha_actualizacion, tasa_obj.tasa_bs_usd)
+    
+    # Desactivar la tasa anterior después de insertar la nueva: nunca queda el sistema sin tasa activa
+    await db.tasas_cambio.update_many(
+        {"activa": True, "id": {"$ne": tasa_obj.id}}, {"$set": con_updated_at({"activa": False})}
+    )
+    
+    # La revalorización arranca solo cuando la nueva tasa ya es la activa
+    if tasa.revalorizar:
+        try:
+            job = revalorizacion.iniciar_revalorizacion(db, tasa_obj.tasa_bs_usd, tasa_obj.id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        tasa_obj.revalorizacion_id = job.id
+        await db.tasas_cambio.update_one(
+            {"id": tasa_obj.id}, {"$set": con_updated_at({"revalorizacion_id": job.id})}
+        )
     
     return tasa_obj
 
+@api_router.post("/tasa-cambio/revalorizar")
+async def revalorizar_facturas():
+    """Recalcula con la tasa activa los montos en Bs de las facturas pendientes o con pago parcial"""
+    tasa = await db.tasas_cambio.find_one({"activa": True})
+    if not tasa:
+        raise HTTPException(status_code=400, detail="No hay tasa de cambio configurada")
+    try:
+        job = revalorizacion.iniciar_revalorizacion(db, tasa["tasa_bs_usd"], tasa.get("id"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "message": "Revalorización iniciada", "job": job.to_dict()}
+
+@api_router.get("/tasa-cambio/revalorizaciones/{job_id}")
+async def obtener_revalorizacion(job_id: str):
+    """Progreso de una revalorización y facturas omitidas por pagos concurrentes"""
+    job = revalorizacion.REVALORIZACION_JOBS.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Revalorización no encontrada")
+    return {"success": True, "job": job.to_dict()}
+
 @api_router.get("/tasa-cambio/actual", response_model=TasaCambio)
 async def obtener_tasa_actual():
     """Obtener tasa de cambio actual"""
@@ -1017,11 +1289,21 @@ async def obtener_tasa_actual():
     if not tasa:
         # Crear tasa por defecto si no existe
         tasa_default = TasaCambio(tasa_bs_usd=1.0, observaciones="Tasa por defecto")
-        await db.tasas_cambio.insert_one(prepare_for_mongo(tasa_default.dict()))
+        await db.tasas_cambio.insert_one(con_updated_at(prepare_for_mongo(tasa_default.dict())))
+        linea_tasas.LINEA_TASAS.agregar(tasa_default.fecha_actualizacion, tasa_default.tasa_bs_usd)
         return tasa_default
     
     return TasaCambio(**parse_from_mongo(tasa))
 
+@api_router.get("/tasa-cambio/en-fecha")
+async def obtener_tasa_en_fecha(fecha: datetime):
+    """Tasa que estaba vigente en el momento indicado, según el historial de tasas"""
+    await linea_tasas.LINEA_TASAS.asegurar(db)
+    tasa = linea_tasas.LINEA_TASAS.tasa_en(fecha)
+    if tasa is None:
+        raise HTTPException(status_code=404, detail="No hay una tasa de cambio vigente en esa fecha")
+    return {"fecha": fecha.isoformat(), "tasa_bs_usd": tasa}
+
 @api_router.get("/tasa-cambio/historial", response_model=List[TasaCambio])
 async def obtener_historial_tasas():
     """Obtener historial de tasas de cambio"""
@@ -1029,28 +1311,72 @@ async def obtener_historial_tasas():
     return [TasaCambio(**parse_from_mongo(tasa)) for tasa in tasas]
 
 # Sistema de Presupuestos
+SERIE_PRESUPUESTOS = "presupuestos"
+
+async def reservar_consecutivos(serie: str, coleccion, cantidad: int) -> int:
+    """
+    Reserva `cantidad` números consecutivos de la serie con un solo $inc atómico en `contadores`
+    y devuelve el último. El contador nunca queda por debajo de los documentos existentes (datos
+    importados o restaurados), así que dos llamadas concurrentes no pueden repetir número.
+    """
+    existentes = await coleccion.estimated_document_count()
+    contador = await db.contadores.find_one_and_update(
+        {"_id": serie},
+        [{"$set": {"valor": {"$add": [{"$max": [{"$ifNull": ["$valor", 0]}, existentes]}, cantidad]}}}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return contador["valor"]
+
+async def cotizar_lineas(lineas: List[LineaCotizacion]) -> dict:
+    """Precios de las líneas con la instantánea del catálogo en memoria (solo va a Mongo si aún no se cargó)"""
+    if not catalogo.CATALOGO.cargado:
+        await catalogo.CATALOGO.cargar(db)
+    return catalogo.CATALOGO.cotizar([(linea.catalogo_id, linea.cantidad) for linea in lineas])
+
+@api_router.post("/presupuestos/cotizar")
+async def cotizar_presupuesto(request: CotizarPresupuesto):
+    """Vista previa de precios, IVA y totales de un presupuesto a partir de ítems del catálogo"""
+    cotizacion = await cotizar_lineas(request.lineas)
+    return {"success": not cotizacion["errores"], **cotizacion}
+
 @api_router.post("/presupuestos", response_model=Presupuesto)
 async def crear_presupuesto(presupuesto: PresupuestoCreate):
-    """Crear nuevo presupuesto"""
-    # Generar número consecutivo
-    count = await db.presupuestos.count_documents({})
-    numero_presupuesto = f"P-2024-{str(count + 1).zfill(3)}"
+    """Crear nuevo presupuesto con los precios calculados en el servidor"""
+    cotizacion = await cotizar_lineas(presupuesto.lineas)
+    if cotizacion["errores"]:
+        raise HTTPException(status_code=400, detail="; ".join(e["motivo"] for e in cotizacion["errores"]))
+    
+    # Un ítem del catálogo con precio manual saltaría la cotización del servidor
+    con_catalogo = [item.descripcion for item in presupuesto.items if item.catalogo_id]
+    if con_catalogo:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Los ítems del catálogo van en 'lineas', no con precio manual: {', '.join(con_catalogo)}"
+        )
     
-    # Calcular totales
-    subtotal = sum(item.total_usd for item in presupuesto.items)
-    iva = subtotal * 0.16  # 16% IVA
-    total = subtotal + iva
+    # Los ítems manuales conservan su precio unitario, pero el total de la línea no se toma del cliente
+    manuales = [
+        ItemPresupuesto(**item.dict(exclude={"catalogo_id"}), total_usd=round(item.cantidad * item.precio_unitario_usd, 2)).dict()
+        for item in presupuesto.items
+    ]
+    items = [ItemPresupuesto(**item).dict() for item in cotizacion["items"]] + manuales
+    montos = catalogo.totales(items)
+    
+    numero_presupuesto = f"P-2024-{str(await reservar_consecutivos(SERIE_PRESUPUESTOS, db.presupuestos, 1)).zfill(3)}"
     
-    presupuesto_dict = prepare_for_mongo(presupuesto.dict())
+    presupuesto_dict = prepare_for_mongo(presupuesto.dict(exclude={"lineas", "items"}))
     presupuesto_obj = Presupuesto(
         **presupuesto_dict,
         numero_presupuesto=numero_presupuesto,
-        subtotal_usd=subtotal,
-        iva_usd=iva,
-        total_usd=total
+        items=items,
+        subtotal_usd=montos["subtotal_usd"],
+        iva_porcentaje=montos["iva_porcentaje"],
+        iva_usd=montos["iva_usd"],
+        total_usd=montos["total_usd"]
     )
     
-    await db.presupuestos.insert_one(prepare_for_mongo(presupuesto_obj.dict()))
+    await db.presupuestos.insert_one(con_updated_at(prepare_for_mongo(presupuesto_obj.dict())))
     return presupuesto_obj
 
 @api_router.get("/presupuestos", response_model=List[Presupuesto])
@@ -1072,7 +1398,7 @@ async def aprobar_presupuesto(presupuesto_id: str):
     """Aprobar presupuesto"""
     await db.presupuestos.update_one(
         {"id": presupuesto_id}, 
-        {"$set": {"estado": "aprobado", "fecha_aprobacion": datetime.now(timezone.utc).isoformat()}}
+        {"$set": con_updated_at({"estado": "aprobado", "fecha_aprobacion": datetime.now(timezone.utc).isoformat()})}
     )
     return {"message": "Presupuesto aprobado"}
 
@@ -1081,51 +1407,53 @@ async def rechazar_presupuesto(presupuesto_id: str):
     """Rechazar presupuesto"""
     await db.presupuestos.update_one(
         {"id": presupuesto_id}, 
-        {"$set": {"estado": "rechazado"}}
+        {"$set": con_updated_at({"estado": "rechazado"})}
     )
     return {"message": "Presupuesto rechazado"}
 
 # Sistema de Facturas
-@api_router.post("/facturas", response_model=Factura)
-async def crear_factura(factura: FacturaCreate):
-    """Crear factura desde presupuesto aprobado"""
-    # Verificar presupuesto
-    presupuesto = await db.presupuestos.find_one({"id": factura.presupuesto_id})
-    if not presupuesto:
-        raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
-    
-    if presupuesto.get("estado") != "aprobado":
-        raise HTTPException(status_code=400, detail="El presupuesto debe estar aprobado")
-    
-    # Obtener tasa de cambio actual
-    tasa_cambio = await db.tasas_cambio.find_one({"activa": True})
-    if not tasa_cambio:
-        raise HTTPException(status_code=400, detail="No hay tasa de cambio configurada")
-    
-    tasa = tasa_cambio["tasa_bs_usd"]
-    
-    # Obtener datos del vehículo
-    vehiculo = await db.vehiculos.find_one({"id": presupuesto["vehiculo_id"]})
-    if not vehiculo:
-        raise HTTPException(status_code=404, detail="Vehículo no encontrado")
-        
-    # Generar número de factura
-    count = await db.facturas.count_documents({})
-    numero_factura = f"FAC-2024-{str(count + 1).zfill(3)}"
-    
-    # Calcular conversión a bolívares
+SERIE_FACTURAS = "facturas"
+INDICE_FACTURA_PRESUPUESTO = "presupuesto_facturado_unico"
+INDICE_NUMERO_FACTURA = "numero_factura_unico"
+CODIGO_CLAVE_DUPLICADA = 11000
+
+async def crear_indices_facturas():
+    """Un presupuesto se factura una sola vez y cada número de factura es único (también entre procesos)"""
+    # Parcial: las facturas antiguas sin presupuesto no cuentan como duplicadas entre sí
+    await db.facturas.create_index(
+        "presupuesto_id", unique=True, name=INDICE_FACTURA_PRESUPUESTO,
+        partialFilterExpression={"presupuesto_id": {"$type": "string"}}
+    )
+    await db.facturas.create_index("numero_factura", unique=True, name=INDICE_NUMERO_FACTURA)
+
+async def numeros_ya_facturados(presupuesto_ids: List[str]) -> Dict[str, str]:
+    """Número de la factura existente de cada presupuesto ya facturado"""
+    facturas = await db.facturas.find(
+        {"presupuesto_id": {"$in": presupuesto_ids}}, {"_id": 0, "presupuesto_id": 1, "numero_factura": 1}
+    ).to_list(None)
+    return {f["presupuesto_id"]: f["numero_factura"] for f in facturas}
+
+async def reservar_numeros_factura(cantidad: int) -> List[str]:
+    """Reserva un bloque consecutivo de números de factura (ver reservar_consecutivos)"""
+    ultimo = await reservar_consecutivos(SERIE_FACTURAS, db.facturas, cantidad)
+    return [f"FAC-2024-{str(n).zfill(3)}" for n in range(ultimo - cantidad + 1, ultimo + 1)]
+
+def construir_factura(presupuesto: dict, vehiculo: dict, tasa: float, numero_factura: str,
+                      fecha_vencimiento: Optional[datetime] = None, observaciones: Optional[str] = None) -> Factura:
+    """Factura de un presupuesto aprobado con los montos en Bs a la tasa indicada"""
     subtotal_usd = presupuesto["subtotal_usd"]
     iva_usd = presupuesto["iva_usd"]
     total_usd = presupuesto["total_usd"]
     
+    # Calcular conversión a bolívares
     subtotal_bs = subtotal_usd * tasa
     iva_bs = iva_usd * tasa
     total_bs = total_usd * tasa
     
-    # Crear factura
-    factura_dict = prepare_for_mongo(factura.dict())
-    factura_obj = Factura(
-        **factura_dict,
+    return Factura(
+        presupuesto_id=presupuesto["id"],
+        fecha_vencimiento=fecha_vencimiento,
+        observaciones=observaciones,
         numero_factura=numero_factura,
         vehiculo_id=presupuesto["vehiculo_id"],
         cliente_id=presupuesto["cliente_id"],
@@ -1144,28 +1472,238 @@ async def crear_factura(factura: FacturaCreate):
         iva_bs=iva_bs,
         total_bs=total_bs,
         total_final_bs=total_bs,
-        saldo_pendiente_bs=total_bs
+        saldo_pendiente_bs=total_bs,
+        tasa_emision=tasa,
+        subtotal_bs_emision=subtotal_bs,
+        iva_bs_emision=iva_bs,
+        total_bs_emision=total_bs
     )
+
+@api_router.post("/facturas", response_model=Factura)
+async def crear_factura(factura: FacturaCreate):
+    """Crear factura desde presupuesto aprobado"""
+    # Verificar presupuesto
+    presupuesto = await db.presupuestos.find_one({"id": factura.presupuesto_id})
+    if not presupuesto:
+        raise HTTPException(status_code=404, detail="Presupuesto no encontrado")
+    
+    if presupuesto.get("estado") != "aprobado":
+        raise HTTPException(status_code=400, detail="El presupuesto debe estar aprobado")
+    
+    # Obtener tasa de cambio actual
+    tasa_cambio = await db.tasas_cambio.find_one({"activa": True})
+    if not tasa_cambio:
+        raise HTTPException(status_code=400, detail="No hay tasa de cambio configurada")
+    
+    # Obtener datos del vehículo
+    vehiculo = await db.vehiculos.find_one({"id": presupuesto["vehiculo_id"]})
+    if not vehiculo:
+        raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     
-    await db.facturas.insert_one(prepare_for_mongo(factura_obj.dict()))
+    facturados = await numeros_ya_facturados([factura.presupuesto_id])
+    if facturados:
+        raise HTTPException(status_code=400, detail=f"Ya facturado en {facturados[factura.presupuesto_id]}")
+    
+    numero_factura, = await reservar_numeros_factura(1)
+    factura_obj = construir_factura(
+        presupuesto, vehiculo, tasa_cambio["tasa_bs_usd"], numero_factura,
+        factura.fecha_vencimiento, factura.observaciones
+    )
+    
+    factura_doc = con_updated_at(prepare_for_mongo(factura_obj.dict()))
+    try:
+        await db.facturas.insert_one(factura_doc)
+    except DuplicateKeyError:
+        # Otra solicitud facturó el mismo presupuesto entre la verificación y la inserción
+        facturados = await numeros_ya_facturados([factura.presupuesto_id])
+        if facturados:
+            raise HTTPException(status_code=400, detail=f"Ya facturado en {facturados[factura.presupuesto_id]}")
+        raise HTTPException(status_code=409, detail="Número de factura repetido; vuelva a intentarlo")
+    await cuentas_por_cobrar.actualizar_cuenta(db, factura_doc)
+    await resumen_clientes.registrar_facturas(db, [factura_doc])
     return factura_obj
 
+@api_router.post("/facturas/lote")
+async def crear_facturas_lote(request: FacturacionLote):
+    """
+    Factura en bloque una lista de presupuestos aprobados (cierre de mes de flotas).
+    Presupuestos y vehículos se cargan con $in, los números se reservan en un solo bloque,
+    todas las facturas usan la misma tasa y se insertan con un único insert_many.
+    Devuelve el resultado de cada presupuesto; los que no se pueden facturar no frenan al resto.
+    """
+    presupuesto_ids = list(dict.fromkeys(request.presupuesto_ids))
+    if not presupuesto_ids:
+        raise HTTPException(status_code=400, detail="Debe indicar al menos un presupuesto")
+    
+    tasa_cambio = await db.tasas_cambio.find_one({"activa": True})
+    if not tasa_cambio:
+        raise HTTPException(status_code=400, detail="No hay tasa de cambio configurada")
+    tasa = tasa_cambio["tasa_bs_usd"]
+    
+    presupuestos, facturados = await asyncio.gather(
+        db.presupuestos.find({"id": {"$in": presupuesto_ids}}, {"_id": 0}).to_list(None),
+        numeros_ya_facturados(presupuesto_ids)
+    )
+    presupuestos = {p["id"]: p for p in presupuestos}
+    vehiculos = await db.vehiculos.find(
+        {"id": {"$in": list({p["vehiculo_id"] for p in presupuestos.values()})}},
+        {"_id": 0, "id": 1, "matricula": 1, "color": 1, "año": 1, "kilometraje": 1}
+    ).to_list(None)
+    vehiculos = {v["id"]: v for v in vehiculos}
+    
+    resultados = {}
+    facturables = []
+    for presupuesto_id in presupuesto_ids:
+        presupuesto = presupuestos.get(presupuesto_id)
+        if not presupuesto:
+            motivo = "Presupuesto no encontrado"
+        elif presupuesto.get("estado") != "aprobado":
+            motivo = "El presupuesto debe estar aprobado"
+        elif presupuesto_id in facturados:
+            motivo = f"Ya facturado en {facturados[presupuesto_id]}"
+        elif presupuesto["vehiculo_id"] not in vehiculos:
+            motivo = "Vehículo no encontrado"
+        else:
+            facturables.append(presupuesto)
+            continue
+        resultados[presupuesto_id] = {"presupuesto_id": presupuesto_id, "estado": "error", "motivo": motivo}
+    
+    documentos = []
+    if facturables:
+        numeros = await reservar_numeros_factura(len(facturables))
+        documentos = [
+            con_updated_at(prepare_for_mongo(construir_factura(
+                presupuesto, vehiculos[presupuesto["vehiculo_id"]], tasa, numero,
+                request.fecha_vencimiento, request.observaciones
+            ).dict()))
+            for presupuesto, numero in zip(facturables, numeros)
+        ]
+        fallidos = {}
+        try:
+            await db.facturas.insert_many(documentos, ordered=False)
+        except BulkWriteError as e:
+            # Con ordered=False las demás facturas se insertan igual; se informan solo las fallidas
+            errores = e.details.get("writeErrors", [])
+            fallidos = {err["index"]: err.get("errmsg", "Error de escritura") for err in errores}
+            # Una clave duplicada es casi siempre otra facturación simultánea del mismo presupuesto
+            duplicados = [documentos[err["index"]]["presupuesto_id"] for err in errores
+                          if err.get("code") == CODIGO_CLAVE_DUPLICADA]
+            if duplicados:
+                facturados = await numeros_ya_facturados(duplicados)
+                for err in errores:
+                    presupuesto_id = documentos[err["index"]]["presupuesto_id"]
+                    if err.get("code") == CODIGO_CLAVE_DUPLICADA and presupuesto_id in facturados:
+                        fallidos[err["index"]] = f"Ya facturado en {facturados[presupuesto_id]}"
+        
+        for indice, documento in enumerate(documentos):
+            if indice in fallidos:
+                resultados[documento["presupuesto_id"]] = {
+                    "presupuesto_id": documento["presupuesto_id"], "estado": "error", "motivo": fallidos[indice]
+                }
+            else:
+                resultados[documento["presupuesto_id"]] = {
+                    "presupuesto_id": documento["presupuesto_id"], "estado": "creada",
+                    "factura_id": documento["id"], "numero_factura": documento["numero_factura"],
+                    "total_bs": documento["total_bs"]
+                }
+        documentos = [d for i, d in enumerate(documentos) if i not in fallidos]
+        try:
+            await cuentas_por_cobrar.actualizar_cuentas(db, documentos)
+        except Exception as e:
+            logger.error(f"Error updating accounts receivable after bulk invoicing: {e}")
+        await resumen_clientes.registrar_facturas(db, documentos)
+    
+    return {
+        "success": True,
+        "tasa_cambio": tasa,
+        "creadas": len(documentos),
+        "errores": len(presupuesto_ids) - len(documentos),
+        "resultados": [resultados[presupuesto_id] for presupuesto_id in presupuesto_ids]
+    }
+
 @api_router.get("/facturas", response_model=List[Factura])
 async def obtener_facturas():
     """Obtener todas las facturas"""
     facturas = await db.facturas.find().sort("created_at", -1).to_list(1000)
     return [Factura(**parse_from_mongo(f)) for f in facturas]
 
+IGTF_PORCENTAJE = 0.03  # 3% sobre pagos en divisas
+TOLERANCIA_SALDO_BS = 0.01
+
+def pipeline_totales_factura() -> List[dict]:
+    """
+    Etapas que recalculan IGTF, total final, lo pagado, el saldo y el estado de pago de una
+    factura a partir de su lista de pagos. Lo pagado se valora en USD a la tasa de la factura,
+    igual que el total: así una revalorización de la tasa mueve ambos y el saldo sigue siendo
+    el saldo en USD.
+    """
+    return [
+        {"$set": {
+            "monto_pagado_bs": {"$multiply": [{"$sum": "$pagos.monto_usd"}, "$tasa_cambio"]},
+            "aplica_igtf": {"$in": ["dolares", "$pagos.tipo"]}
+        }},
+        {"$set": {"igtf_usd": {"$cond": ["$aplica_igtf", {"$multiply": ["$total_usd", IGTF_PORCENTAJE]}, 0.0]}}},
+        {"$set": {"igtf_bs": {"$multiply": ["$igtf_usd", "$tasa_cambio"]}}},
+        {"$set": {"total_final_bs": {"$add": ["$total_bs", "$igtf_bs"]}}},
+        {"$set": {
+            "saldo_pendiente_bs": {"$max": [0, {"$subtract": ["$total_final_bs", "$monto_pagado_bs"]}]},
+            "estado_pago": {"$switch": {
+                "branches": [
+                    # Menos de un céntimo de diferencia es redondeo de la conversión, no deuda
+                    {"case": {"$lte": [{"$subtract": ["$total_final_bs", "$monto_pagado_bs"]}, TOLERANCIA_SALDO_BS]}, "then": "pagado_total"},
+                    {"case": {"$gt": ["$monto_pagado_bs", 0]}, "then": "pagado_parcial"}
+                ],
+                "default": "pendiente"
+            }},
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }}
+    ]
+
+def pipeline_registrar_pago(nuevo_pago: dict) -> List[dict]:
+    """
+    Actualización por pipeline que agrega el pago y recalcula los totales en el servidor
+    a partir de la lista completa de pagos, dentro de la misma escritura atómica.
+    """
+    return [
+        # $literal: una referencia que empiece con "$" no debe leerse como ruta de campo
+        {"$set": {"pagos": {"$concatArrays": [{"$ifNull": ["$pagos", []]}, [{"$literal": nuevo_pago}]]}}},
+        *pipeline_totales_factura()
+    ]
+
+MIGRACION_MONTO_PAGADO = "monto_pagado_bs_en_usd_a_tasa_factura"
+
+async def recalcular_totales_facturas() -> int:
+    """
+    Recalcula lo pagado, el saldo y el estado de todas las facturas con pagos según
+    pipeline_totales_factura, y reconstruye las vistas que dependen del saldo.
+    """
+    resultado = await db.facturas.update_many({"pagos.0": {"$exists": True}}, pipeline_totales_factura())
+    await cuentas_por_cobrar.reconstruir(db)
+    await resumen_clientes.reconstruir(db)
+    return resultado.modified_count
+
 @api_router.post("/facturas/{factura_id}/pagos")
 async def registrar_pago(factura_id: str, pago: RegistrarPago):
-    """Registrar pago en factura"""
-    factura = await db.facturas.find_one({"id": factura_id})
-    if not factura:
-        raise HTTPException(status_code=404, detail="Factura no encontrada")
-    
-    # Obtener tasa actual
-    tasa_cambio_doc = await db.tasas_cambio.find_one({"activa": True})
-    tasa = tasa_cambio_doc["tasa_bs_usd"] if tasa_cambio_doc else factura["tasa_cambio"]
+    """Registrar pago en factura con una sola escritura atómica; devuelve la factura actualizada"""
+    fecha_pago = pago.fecha_pago or datetime.now(timezone.utc)
+    # Se guarda en UTC como el resto de las fechas, para que compararlas como texto siga siendo válido
+    fecha_pago = fecha_pago.replace(tzinfo=timezone.utc) if not fecha_pago.tzinfo else fecha_pago.astimezone(timezone.utc)
+    if fecha_pago > datetime.now(timezone.utc):
+        raise HTTPException(status_code=400, detail="La fecha del pago no puede ser futura")
+    
+    if await cierre_caja.dia_cerrado(db, fecha_pago):
+        raise HTTPException(status_code=400, detail="El día del pago ya tiene cierre de caja")
+    
+    # Un pago se convierte entre Bs y USD a la tasa vigente el día en que se hizo, aunque se registre después
+    await linea_tasas.LINEA_TASAS.asegurar(db)
+    tasa = linea_tasas.LINEA_TASAS.tasa_en(fecha_pago)
+    if tasa is None:
+        # Anterior a la primera tasa registrada: la única referencia es la de la factura
+        factura = await db.facturas.find_one({"id": factura_id}, {"tasa_cambio": 1})
+        if not factura:
+            raise HTTPException(status_code=404, detail="Factura no encontrada")
+        tasa = factura["tasa_cambio"]
     
     # Calcular monto en bolívares
     if pago.tipo == "dolares":
@@ -1181,114 +1719,235 @@ async def registrar_pago(factura_id: str, pago: RegistrarPago):
         metodo=pago.metodo,
         monto_usd=monto_usd,
         monto_bs=monto_bs,
-        referencia=pago.referencia
+        referencia=pago.referencia,
+        referencia_norm=conciliacion.normalizar_referencia(pago.referencia) if pago.referencia else None,
+        fecha_pago=fecha_pago,
+        tasa_cambio=tasa
     )
     
-    # Actualizar factura
-    total_pagado_bs = factura["monto_pagado_bs"] + monto_bs
-    saldo_pendiente = factura["total_final_bs"] - total_pagado_bs
-    
-    # Calcular IGTF si hay pagos en USD
-    aplica_igtf = any(p.get("tipo") == "dolares" for p in factura.get("pagos", [])) or pago.tipo == "dolares"
-    igtf_usd = 0.0
-    igtf_bs = 0.0
-    total_final_bs = factura["total_bs"]
-    
-    if aplica_igtf:
-        igtf_usd = factura["total_usd"] * 0.03  # 3% IGTF
-        igtf_bs = igtf_usd * factura["tasa_cambio"]
-        total_final_bs = factura["total_bs"] + igtf_bs
-        saldo_pendiente = total_final_bs - total_pagado_bs
-    
-    # Determinar estado de pago
-    if saldo_pendiente <= 0:
-        estado_pago = "pagado_total"
-    elif total_pagado_bs > 0:
-        estado_pago = "pagado_parcial"
-    else:
-        estado_pago = "pendiente"
-    
-    # Actualizar en base de datos
-    await db.facturas.update_one(
+    # Pagos simultáneos sobre la misma factura se serializan en el servidor: ninguno pisa los totales de otro
+    factura = await db.facturas.find_one_and_update(
         {"id": factura_id},
-        {
-            "$push": {"pagos": prepare_for_mongo(nuevo_pago.dict())},
-            "$set": {
-                "monto_pagado_bs": total_pagado_bs,
-                "saldo_pendiente_bs": max(0, saldo_pendiente),
-                "estado_pago": estado_pago,
-                "aplica_igtf": aplica_igtf,
-                "igtf_usd": igtf_usd,
-                "igtf_bs": igtf_bs,
-                "total_final_bs": total_final_bs
-            }
-        }
+        pipeline_registrar_pago(prepare_for_mongo(nuevo_pago.dict())),
+        return_document=ReturnDocument.AFTER
     )
+    if not factura:
+        raise HTTPException(status_code=404, detail="Factura no encontrada")
+    await cuentas_por_cobrar.actualizar_cuenta(db, factura)
+    await resumen_clientes.registrar_pago(db, factura, nuevo_pago.dict())
+    if pago.fecha_pago:
+        # Un pago con fecha pasada puede caer en un período de ingresos ya resumido
+        await analitica_ingresos.invalidar_fecha(db, fecha_pago)
     
-    return {"message": "Pago registrado correctamente", "saldo_pendiente": max(0, saldo_pendiente)}
+    return {
+        "message": "Pago registrado correctamente",
+        "saldo_pendiente": factura["saldo_pendiente_bs"],
+        "factura": Factura(**parse_from_mongo(factura))
+    }
+
+# Documentos PDF
+def respuesta_pdf(nombre: str, pdf: bytes) -> Response:
+    return Response(content=pdf, media_type="application/pdf", headers={"Content-Disposition": f'inline; filename="{nombre}"'})
+
+async def generar_pdf(tipo: str, documento_id: str) -> Response:
+    try:
+        resultado = await documentos_pdf.pdf_documento(db, tipo, documento_id)
+    except ImportError as e:
+        raise HTTPException(status_code=503, detail=f"Generación de PDF no disponible: {str(e)}")
+    if not resultado:
+        raise HTTPException(status_code=404, detail=f"{tipo.capitalize()} no encontrado")
+    return respuesta_pdf(*resultado)
+
+@api_router.get("/facturas/pdf-del-dia")
+async def pdf_facturas_del_dia(fecha: Optional[date] = None):
+    """Todas las facturas del día local del taller (por defecto hoy) en un solo PDF para imprimir"""
+    dia = fecha or cierre_caja.hoy()
+    try:
+        cantidad, pdf = await documentos_pdf.pdf_facturas_del_dia(db, dia)
+    except ImportError as e:
+        raise HTTPException(status_code=503, detail=f"Generación de PDF no disponible: {str(e)}")
+    if not cantidad:
+        raise HTTPException(status_code=404, detail=f"No hay facturas del {dia.isoformat()}")
+    return respuesta_pdf(f"facturas-{dia.isoformat()}.pdf", pdf)
+
+@api_router.get("/facturas/{factura_id}/pdf")
+async def pdf_factura(factura_id: str):
+    """PDF de la factura; se reutiliza mientras la factura no cambie de versión"""
+    return await generar_pdf("factura", factura_id)
+
+@api_router.get("/presupuestos/{presupuesto_id}/pdf")
+async def pdf_presupuesto(presupuesto_id: str):
+    """PDF del presupuesto"""
+    return await generar_pdf("presupuesto", presupuesto_id)
+
+# Cuentas por cobrar
+@api_router.get("/reportes/cuentas-por-cobrar")
+async def reporte_cuentas_por_cobrar(fecha_corte: Optional[datetime] = None):
+    """Antigüedad de saldos (0-30, 31-60, 61-90, 90+ días desde la facturación) por cliente; saldos actuales"""
+    reporte = await cuentas_por_cobrar.reporte_antiguedad(db, fecha_corte)
+    return {"success": True, **reporte}
+
+@api_router.post("/admin/cuentas-por-cobrar/reconstruir")
+async def reconstruir_cuentas_por_cobrar():
+    """Recalcula la vista de cuentas por cobrar desde todas las facturas"""
+    try:
+        inicio = time.monotonic()
+        clientes = await cuentas_por_cobrar.reconstruir(db)
+        return {
+            "success": True,
+            "clientes_con_saldo": clientes,
+            "duracion_segundos": round(time.monotonic() - inicio, 3)
+        }
+    except Exception as e:
+        logger.error(f"Error rebuilding accounts receivable: {e}")
+        raise HTTPException(status_code=500, detail=f"Error reconstruyendo cuentas por cobrar: {str(e)}")
+
+@api_router.post("/admin/resumen-clientes/reconstruir")
+async def reconstruir_resumen_clientes():
+    """Recalcula el resumen de todos los clientes desde facturas y órdenes de trabajo"""
+    try:
+        inicio = time.monotonic()
+        clientes = await resumen_clientes.reconstruir(db)
+        return {
+            "success": True,
+            "clientes_con_actividad": clientes,
+            "duracion_segundos": round(time.monotonic() - inicio, 3)
+        }
+    except Exception as e:
+        logger.error(f"Error rebuilding client summaries: {e}")
+        raise HTTPException(status_code=500, detail=f"Error reconstruyendo el resumen de clientes: {str(e)}")
+
+@api_router.post("/admin/facturas/recalcular-totales")
+async def recalcular_totales():
+    """Recalcula lo pagado, el saldo y el estado de pago de todas las facturas desde sus pagos"""
+    try:
+        inicio = time.monotonic()
+        facturas = await recalcular_totales_facturas()
+        return {
+            "success": True,
+            "facturas_actualizadas": facturas,
+            "duracion_segundos": round(time.monotonic() - inicio, 3)
+        }
+    except Exception as e:
+        logger.error(f"Error recalculating invoice totals: {e}")
+        raise HTTPException(status_code=500, detail=f"Error recalculando totales de facturas: {str(e)}")
+
+# Cierre de caja
+@api_router.get("/caja/resumen")
+async def resumen_caja(fecha: Optional[date] = None):
+    """Pagos del día por moneda y método; si el día ya se cerró devuelve la foto del cierre"""
+    return {"success": True, **await cierre_caja.resumen_o_cierre(db, fecha or cierre_caja.hoy())}
+
+@api_router.post("/caja/cierres")
+async def cerrar_caja(request: CierreCajaCreate):
+    """Cierra el día: compara lo declarado con los pagos registrados y guarda el cierre (inmutable)"""
+    declarado = {}
+    for monto in request.declarado:
+        clave = cierre_caja.clave_metodo(monto.tipo, monto.metodo)
+        declarado[clave] = round(declarado.get(clave, 0.0) + monto.monto, 2)
+    try:
+        cierre = await cierre_caja.cerrar_dia(
+            db, request.fecha or cierre_caja.hoy(), declarado, request.cajero, request.observaciones
+        )
+    except cierre_caja.CierreExistente as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "cierre": cierre}
+
+@api_router.get("/caja/cierres")
+async def listar_cierres_caja(desde: Optional[date] = None, hasta: Optional[date] = None):
+    """Cierres guardados del rango (por defecto los últimos 30 días); no se recalcula nada"""
+    hasta = hasta or cierre_caja.hoy()
+    desde = desde or hasta - timedelta(days=30)
+    return {"success": True, "cierres": await cierre_caja.listar_cierres(db, desde, hasta)}
+
+# Conciliación bancaria
+@api_router.post("/conciliacion/banco")
+async def conciliar_extracto_bancario(archivo: UploadFile = File(...), moneda: str = Form("bolivares")):
+    """Cruza un extracto bancario CSV (referencia, monto y opcionalmente fecha) con las referencias de los pagos"""
+    if moneda not in ("bolivares", "dolares"):
+        raise HTTPException(status_code=400, detail="Moneda inválida. Use: bolivares, dolares")
+    try:
+        inicio = time.monotonic()
+        resultado = await conciliacion.conciliar(db, archivo.file, moneda)
+        return {"success": True, **resultado, "duracion_segundos": round(time.monotonic() - inicio, 3)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error reconciling bank statement: {e}")
+        raise HTTPException(status_code=500, detail=f"Error conciliando el extracto: {str(e)}")
+
+# Analítica de ingresos
+@api_router.get("/reportes/ingresos")
+async def reporte_ingresos(granularidad: str = "mes", desde: Optional[date] = None, hasta: Optional[date] = None):
+    """Ingresos cobrados por día, semana o mes, por moneda y método de pago (por defecto el último año)"""
+    hasta = hasta or analitica_ingresos.dia_actual()
+    desde = desde or hasta - timedelta(days=365)
+    try:
+        inicio = time.monotonic()
+        reporte = await analitica_ingresos.ingresos(db, granularidad, desde, hasta)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, **reporte, "duracion_segundos": round(time.monotonic() - inicio, 3)}
+
+# Libro de ventas
+@api_router.get("/reportes/libro-ventas")
+async def exportar_libro_ventas(desde: date, hasta: date, formato: str = "csv"):
+    """Libro de ventas del rango (ambos días incluidos) en CSV o XLSX, generado en streaming"""
+    if formato not in libro_ventas.FORMATOS:
+        raise HTTPException(status_code=400, detail=f"Formato inválido. Use: {', '.join(libro_ventas.FORMATOS)}")
+    if hasta < desde:
+        raise HTTPException(status_code=400, detail="La fecha 'hasta' debe ser igual o posterior a 'desde'")
+
+    nombre = libro_ventas.nombre_archivo(desde, hasta, formato)
+    if formato == "csv":
+        return StreamingResponse(
+            libro_ventas.exportar_csv(db, desde, hasta),
+            media_type=libro_ventas.FORMATOS[formato],
+            headers={"Content-Disposition": f'attachment; filename="{nombre}"'}
+        )
+    try:
+        ruta = await libro_ventas.exportar_xlsx(db, desde, hasta)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FileResponse(
+        ruta, media_type=libro_ventas.FORMATOS[formato], filename=nombre,
+        background=BackgroundTask(os.remove, ruta)
+    )
 
 # AI Processing for Voice Dictation - Orders
 @api_router.post("/ai/procesar-dictado-orden")
-async def procesar_dictado_orden_con_ia(request: dict):
+async def procesar_dictado_orden_con_ia(request: dict, http_request: Request):
     """Procesa dictado de voz con IA para extraer información de órdenes de trabajo"""
     try:
-        from emergentintegrations.llm.chat import LlmChat
-        
         texto = request.get('texto', '')
+        deadline = resolver_deadline(http_request, request.get('deadline_ms'))
         
         if not texto.strip():
             return {"success": False, "error": "No se proporcionó texto para procesar"}
         
-        # System message específico para órdenes de trabajo
-        system_message = """Eres un asistente de IA especializado en extraer información de órdenes de trabajo para un taller mecánico venezolano.
-
-INSTRUCCIONES:
-- Extrae TODA la información disponible del texto dictado sobre fallas, diagnósticos y acciones realizadas
-- Organiza la información en formato JSON
-- Usa MAYÚSCULAS para descripciones técnicas importantes
-- Identifica claramente fallas detectadas, diagnósticos del mecánico y acciones tomadas
-- Solo extrae información que esté claramente mencionada
-- Responde SOLO con el JSON, sin explicaciones adicionales"""
-
-        # Initialize Emergent LLM
-        llm = LlmChat(
-            api_key="sk-emergent-5071d2a131d5544Ed5",
+        plantilla = get_prompt("dictado_orden")
+        
+        # Initialize AI chat (proveedor según AI_PROVIDER)
+        llm = AIChat(
+            task="dictado_orden",
             session_id=f"orden-dictado-{hash(texto[:50])}",
-            system_message=system_message
+            system_message=plantilla.system_message
         )
         
-        # Prompt específico para órdenes de trabajo
-        prompt = f"""
-TEXTO DICTADO: "{texto}"
-
-FORMATO DE RESPUESTA REQUERIDO:
-{{
-  "fallas_detectadas": "DESCRIPCIÓN DETALLADA DE LAS FALLAS ENCONTRADAS",
-  "diagnostico_mecanico": "DIAGNÓSTICO PROFESIONAL DEL MECÁNICO",
-  "reparaciones_realizadas": "TRABAJOS Y REPARACIONES EJECUTADAS",
-  "repuestos_utilizados": "LISTA DE REPUESTOS UTILIZADOS CON CANTIDADES",
-  "observaciones": "NOTAS ADICIONALES Y RECOMENDACIONES"
-}}
-
-Analiza el dictado y extrae la información relevante para cada campo."""
+        # Prefijo estático cacheable y el dictado al final
+        prompt = plantilla.render(texto=texto)
         
         # Send message and get response
-        from emergentintegrations.llm.chat import UserMessage
-        user_message = UserMessage(text=prompt)
-        response = await llm.send_message(user_message)
+        response = await ejecutar_cancelable(
+            http_request, llm.send_message(prompt, deadline=deadline, hedge=request.get('hedge'))
+        )
         
         ai_response = response.strip()
         
         try:
-            # Clean JSON response (remove code blocks if present)
-            import json
-            json_text = ai_response.strip()
-            if json_text.startswith('```json'):
-                json_text = json_text.replace('```json', '').replace('```', '').strip()
-            elif json_text.startswith('```'):
-                json_text = json_text.replace('```', '').strip()
-            
-            datos_extraidos = json.loads(json_text)
+            datos_extraidos = parse_ai_json(ai_response)
             
             return {
                 "success": True,
@@ -1309,6 +1968,11 @@ Analiza el dictado y extrae la información relevante para cada campo."""
             "success": False,
             "error": "Librería emergentintegrations no instalada"
         }
+    except AIDeadlineExceeded:
+        return {
+            "success": False,
+            "error": "La IA no respondió dentro del tiempo límite"
+        }
     except Exception as e:
         print(f"Error procesando dictado de orden con IA: {e}")
         return {
@@ -1318,82 +1982,36 @@ Analiza el dictado y extrae la información relevante para cada campo."""
 
 # AI Processing for Voice Dictation
 @api_router.post("/ai/procesar-dictado")
-async def procesar_dictado_con_ia(request: dict):
+async def procesar_dictado_con_ia(request: dict, http_request: Request):
     """Procesa dictado de voz con IA para extraer información estructurada"""
     try:
-        from emergentintegrations.llm.chat import LlmChat
-        
         texto = request.get('texto', '')
+        deadline = resolver_deadline(http_request, request.get('deadline_ms'))
         
         if not texto.strip():
             return {"success": False, "error": "No se proporcionó texto para procesar"}
         
-        # System message para el asistente IA
-        system_message = """Eres un asistente de IA especializado en extraer información estructurada para el registro de vehículos y clientes en un taller mecánico venezolano.
-
-INSTRUCCIONES:
-- Extrae TODA la información disponible del texto dictado
-- Organiza la información en formato JSON
-- Usa MAYÚSCULAS para nombres, empresas, direcciones, matrículas, marcas, modelos, colores
-- Usa minúsculas para emails
-- Formatea teléfonos como 0000-000.00.00
-- Solo extrae información que esté claramente mencionada
-- Si mencionan cédula con V- o E-, es tipo_documento: "CI", prefijo_documento: "V" o "E"
-- Si mencionan RIF con J- o G-, es tipo_documento: "RIF", prefijo_documento: "J" o "G"
-- Responde SOLO con el JSON, sin explicaciones adicionales"""
-
-        # Initialize Emergent LLM
-        llm = LlmChat(
-            api_key="sk-emergent-5071d2a131d5544Ed5",
+        plantilla = get_prompt("dictado_vehiculo")
+        
+        # Initialize AI chat (proveedor según AI_PROVIDER)
+        llm = AIChat(
+            task="dictado_vehiculo",
             session_id=f"dictado-{hash(texto[:50])}",
-            system_message=system_message
+            system_message=plantilla.system_message
         )
         
-        # Prompt específico con el texto dictado
-        prompt = f"""
-TEXTO DICTADO: "{texto}"
-
-FORMATO DE RESPUESTA REQUERIDO:
-{{
-  "cliente": {{
-    "nombre": "NOMBRE COMPLETO",
-    "telefono": "0000-000.00.00",
-    "empresa": "NOMBRE EMPRESA",
-    "email": "email@ejemplo.com",
-    "direccion_fiscal": "DIRECCIÓN COMPLETA",
-    "tipo_documento": "CI" o "RIF",
-    "prefijo_documento": "V", "E", "J", o "G",
-    "numero_documento": "12345678"
-  }},
-  "vehiculo": {{
-    "matricula": "ABC123",
-    "marca": "TOYOTA",
-    "modelo": "COROLLA",
-    "año": 2020,
-    "color": "BLANCO",
-    "kilometraje": 50000,
-    "tipo_combustible": "GASOLINA"
-  }}
-}}
-"""
+        # Prefijo estático cacheable y el dictado al final
+        prompt = plantilla.render(texto=texto)
         
         # Send message and get response
-        from emergentintegrations.llm.chat import UserMessage
-        user_message = UserMessage(text=prompt)
-        response = await llm.send_message(user_message)
+        response = await ejecutar_cancelable(
+            http_request, llm.send_message(prompt, deadline=deadline, hedge=request.get('hedge'))
+        )
         
         ai_response = response.strip()
         
         try:
-            # Clean JSON response (remove code blocks if present)
-            import json
-            json_text = ai_response.strip()
-            if json_text.startswith('```json'):
-                json_text = json_text.replace('```json', '').replace('```', '').strip()
-            elif json_text.startswith('```'):
-                json_text = json_text.replace('```', '').strip()
-            
-            datos_extraidos = json.loads(json_text)
+            datos_extraidos = parse_ai_json(ai_response)
             
             return {
                 "success": True,
@@ -1414,6 +2032,11 @@ FORMATO DE RESPUESTA REQUERIDO:
             "success": False,
             "error": "Librería emergentintegrations no instalada"
         }
+    except AIDeadlineExceeded:
+        return {
+            "success": False,
+            "error": "La IA no respondió dentro del tiempo límite"
+        }
     except Exception as e:
         print(f"Error procesando dictado con IA: {e}")
         return {
@@ -1423,12 +2046,11 @@ FORMATO DE RESPUESTA REQUERIDO:
 
 # AI Processing for Image OCR (License Plates, Vehicle Documents)
 @api_router.post("/ai/procesar-imagen")
-async def procesar_imagen_con_ia(request: dict):
+async def procesar_imagen_con_ia(request: dict, http_request: Request):
     """Procesa imagen con IA para extraer información de matrículas, títulos de propiedad, etc."""
     try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
-        
         imagen_base64 = request.get('imagen_base64', '')
+        deadline = resolver_deadline(http_request, request.get('deadline_ms'))
         
         if not imagen_base64:
             return {"success": False, "error": "No se proporcionó imagen para procesar"}
@@ -1437,72 +2059,28 @@ async def procesar_imagen_con_ia(request: dict):
         if imagen_base64.startswith('data:'):
             imagen_base64 = imagen_base64.split(',')[1]
         
-        # System message para OCR/análisis de documentos vehiculares
-        system_message = """Eres un experto en OCR y análisis de documentos vehiculares venezolanos. Tu especialidad es extraer información de:
-
-1. MATRÍCULAS DE VEHÍCULOS: Identificar caracteres alfanuméricos en placas
-2. TÍTULOS DE PROPIEDAD: Datos del vehículo y propietario
-3. DOCUMENTOS VEHICULARES: Registro, inspección, etc.
-
-INSTRUCCIONES:
-- Analiza cuidadosamente la imagen
-- Extrae TODA la información visible y legible
-- Usa MAYÚSCULAS para nombres, direcciones, matrículas, marcas, modelos
-- Formatea números de documento correctamente
-- Si ves una matrícula, examínala carácter por carácter
-- Si es un título de propiedad, busca datos del vehículo Y propietario
-- Responde SOLO con JSON, sin explicaciones"""
-
+        plantilla = get_prompt("imagen")
+        
         # Initialize IA with image processing
-        llm = LlmChat(
-            api_key="sk-emergent-5071d2a131d5544Ed5",
+        llm = AIChat(
+            task="imagen",
             session_id=f"imagen-{hash(imagen_base64[:100])}",
-            system_message=system_message
+            system_message=plantilla.system_message
         )
         
-        # Create image content
-        image_content = ImageContent(imagen_base64)
-        
         # Prompt for image analysis
-        prompt = """Analiza esta imagen y extrae toda la información visible sobre vehículos y propietarios.
-
-FORMATO DE RESPUESTA JSON:
-{
-  "vehiculo": {
-    "matricula": "ABC123",
-    "marca": "TOYOTA", 
-    "modelo": "COROLLA",
-    "año": 2020,
-    "color": "BLANCO",
-    "serial_niv": "1HGBH41JXMN109186"
-  },
-  "cliente": {
-    "nombre": "JUAN CARLOS RODRIGUEZ",
-    "tipo_documento": "CI" o "RIF",
-    "prefijo_documento": "V", "E", "J", "G",
-    "numero_documento": "12345678"
-  },
-  "tipo_documento": "matricula", "titulo_propiedad", "registro", "otro"
-}
-
-Analiza cuidadosamente y extrae solo información que puedas leer claramente."""
+        prompt = plantilla.render()
         
         # Send message with image
-        user_message = UserMessage(text=prompt, file_contents=[image_content])
-        response = await llm.send_message(user_message)
+        response = await ejecutar_cancelable(
+            http_request,
+            llm.send_message(prompt, images=[imagen_base64], deadline=deadline, hedge=request.get('hedge'))
+        )
         
         ai_response = response.strip()
         
         try:
-            # Clean JSON response
-            import json
-            json_text = ai_response
-            if json_text.startswith('```json'):
-                json_text = json_text.replace('```json', '').replace('```', '').strip()
-            elif json_text.startswith('```'):
-                json_text = json_text.replace('```', '').strip()
-            
-            datos_extraidos = json.loads(json_text)
+            datos_extraidos = parse_ai_json(ai_response)
             
             return {
                 "success": True,
@@ -1523,6 +2101,11 @@ Analiza cuidadosamente y extrae solo información que puedas leer claramente."""
             "success": False,
             "error": "Librería emergentintegrations no instalada"
         }
+    except AIDeadlineExceeded:
+        return {
+            "success": False,
+            "error": "La IA no respondió dentro del tiempo límite"
+        }
     except Exception as e:
         print(f"Error procesando imagen con IA: {e}")
         return {
@@ -1531,198 +2114,312 @@ Analiza cuidadosamente y extrae solo información que puedas leer claramente."""
         }
 
 # Administración de Base de Datos
+async def estadisticas_coleccion(collection_name: str, mas_grandes: int = 0) -> Dict[str, Any]:
+    """
+    Conteo y tamaños desde los metadatos de la colección ($collStats), sin recorrer documentos.
+    Solo si mas_grandes > 0 se recorre la colección para listar los documentos más pesados.
+    """
+    coleccion = db[collection_name]
+    info: Dict[str, Any] = {"count": await coleccion.estimated_document_count()}
+    
+    storage = {}
+    try:
+        async for resultado in coleccion.aggregate([{"$collStats": {"storageStats": {}}}]):
+            storage = resultado.get("storageStats", {})
+    except OperationFailure as e:
+        # Colección aún no creada o servidor sin permisos para collStats
+        logger.warning(f"collStats no disponible para {collection_name}: {e}")
+    info.update({
+        "tamano_bytes": storage.get("size", 0),
+        "almacenamiento_bytes": storage.get("storageSize", 0),
+        "tamano_promedio_bytes": storage.get("avgObjSize", 0),
+        "indices_bytes": storage.get("totalIndexSize", 0),
+        "indices": storage.get("indexSizes", {}),
+    })
+    
+    if mas_grandes > 0:
+        documentos = []
+        async for doc in coleccion.aggregate([
+            {"$project": {"id": 1, "bytes": {"$bsonSize": "$$ROOT"}}},
+            {"$sort": {"bytes": -1}},
+            {"$limit": mas_grandes}
+        ], allowDiskUse=True):
+            completo = await coleccion.find_one({"_id": doc["_id"]})
+            # Peso de cada campo de primer nivel: deja ver qué campo infla el documento (p. ej. fotos en base64)
+            campos = sorted(
+                ((campo, len(bson.encode({campo: valor}))) for campo, valor in (completo or {}).items()),
+                key=lambda c: c[1], reverse=True
+            )
+            documentos.append({
+                "id": doc.get("id", str(doc["_id"])),
+                "bytes": doc["bytes"],
+                "campos_mas_pesados": [{"campo": c, "bytes": b} for c, b in campos[:3]]
+            })
+        info["documentos_mas_grandes"] = documentos
+    return info
+
 @api_router.get("/admin/collections")
-async def obtener_colecciones():
-    """Obtener lista de todas las colecciones disponibles con conteo de documentos"""
+async def obtener_colecciones(mas_grandes: int = 0):
+    """
+    Colecciones del sistema con conteo estimado, tamaño en disco, tamaño promedio e índices.
+    mas_grandes=N agrega los N documentos más pesados de cada colección (recorre la colección).
+    """
     try:
-        collections_info = []
+        inicio = time.monotonic()
         
         # Lista de todas las colecciones del sistema
         collection_names = [
             "vehiculos", "clientes", "ordenes_trabajo", "mecanicos", 
             "servicios_repuestos", "presupuestos", "facturas",
-            "historial_kilometraje", "tasas_cambio"
+            "historial_kilometraje", "tasas_cambio", "cierres_caja", "eventos_orden"
         ]
         
-        for collection_name in collection_names:
-            collection = db[collection_name]
-            count = await collection.count_documents({})
-            collections_info.append({
-                "name": collection_name,
-                "display_name": {
-                    "vehiculos": "Vehículos",
-                    "clientes": "Clientes", 
-                    "ordenes_trabajo": "Órdenes de Trabajo",
-                    "mecanicos": "Mecánicos",
-                    "servicios_repuestos": "Servicios y Repuestos",
-                    "presupuestos": "Presupuestos",
-                    "facturas": "Facturas",
-                    "historial_kilometraje": "Historial de Kilometraje",
-                    "tasas_cambio": "Tasas de Cambio"
-                }.get(collection_name, collection_name.title()),
-                "count": count
-            })
+        display_names = {
+            "vehiculos": "Vehículos",
+            "clientes": "Clientes", 
+            "ordenes_trabajo": "Órdenes de Trabajo",
+            "mecanicos": "Mecánicos",
+            "servicios_repuestos": "Servicios y Repuestos",
+            "presupuestos": "Presupuestos",
+            "facturas": "Facturas",
+            "historial_kilometraje": "Historial de Kilometraje",
+            "tasas_cambio": "Tasas de Cambio",
+            "cierres_caja": "Cierres de Caja",
+            "eventos_orden": "Eventos de Órdenes"
+        }
+        
+        # Estadísticas en paralelo acotado
+        estadisticas = await ejecutar_por_coleccion(
+            collection_names, lambda collection_name: estadisticas_coleccion(collection_name, mas_grandes)
+        )
         
-        return {"success": True, "collections": collections_info}
+        collections_info = [
+            {
+                "name": item["coleccion"],
+                "display_name": display_names.get(item["coleccion"], item["coleccion"].title()),
+                **item["resultado"],
+                "segundos": item["segundos"]
+            }
+            for item in estadisticas
+        ]
+        
+        return {
+            "success": True,
+            "collections": collections_info,
+            "totales": {
+                campo: sum(c[campo] for c in collections_info)
+                for campo in ("count", "tamano_bytes", "almacenamiento_bytes", "indices_bytes")
+            },
+            "duracion_segundos": round(time.monotonic() - inicio, 3)
+        }
     except Exception as e:
         logger.error(f"Error getting collections: {e}")
         raise HTTPException(status_code=500, detail=f"Error obteniendo colecciones: {str(e)}")
 
 @api_router.post("/admin/backup")
 async def crear_backup(request: BackupDatabase):
-    """Crear backup de las colecciones especificadas o todas si no se especifica"""
+    """Inicia un backup en segundo plano de las colecciones especificadas o todas si no se especifica"""
     try:
-        backup_data = {}
-        
         collections_to_backup = request.collections or [
             "vehiculos", "clientes", "ordenes_trabajo", "mecanicos", 
             "servicios_repuestos", "presupuestos", "facturas",
-            "historial_kilometraje", "tasas_cambio"
+            "historial_kilometraje", "tasas_cambio", "cierres_caja", "eventos_orden"
         ]
         
-        for collection_name in collections_to_backup:
-            collection = db[collection_name]
-            documents = await collection.find({}).to_list(length=None)
-            
-            # Convertir ObjectId a string para serialización JSON
-            for doc in documents:
-                if '_id' in doc:
-                    doc['_id'] = str(doc['_id'])
-            
-            backup_data[collection_name] = documents
-        
         # También hacer backup de configuraciones del sistema
-        config_collection = db["configuraciones"]
-        config_docs = await config_collection.find({}).to_list(length=None)
-        for doc in config_docs:
-            if '_id' in doc:
-                doc['_id'] = str(doc['_id'])
-        backup_data["configuraciones"] = config_docs
-        
-        # Metadata del backup
-        backup_metadata = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "collections": collections_to_backup,
-            "total_documents": sum(len(docs) for docs in backup_data.values())
-        }
+        colecciones = collections_to_backup + ["configuraciones"]
+        
+        job = backup_engine.iniciar_backup(
+            db, colecciones, formato=request.formato, compresion=request.compresion,
+            extra_manifest={"collections": collections_to_backup},
+            tipo=request.tipo, base_id=request.base_id
+        )
         
         return {
             "success": True,
-            "backup_metadata": backup_metadata,
-            "backup_data": backup_data
+            "message": "Backup iniciado",
+            "job": job.to_dict()
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error creating backup: {e}")
         raise HTTPException(status_code=500, detail=f"Error creando backup: {str(e)}")
 
+@api_router.get("/admin/backup/jobs/{job_id}")
+async def obtener_progreso_backup(job_id: str):
+    """Estado y progreso por colección de un backup en curso o terminado"""
+    job = backup_engine.BACKUP_JOBS.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Backup no encontrado")
+    return {"success": True, "job": job.to_dict()}
+
+@api_router.get("/admin/backups")
+async def listar_backups():
+    """Lista los backups disponibles en disco con su manifiesto"""
+    return {"success": True, "backups": backup_engine.listar_backups()}
+
+@api_router.get("/admin/backups/{backup_id}/descargar")
+async def descargar_backup(backup_id: str):
+    """Descarga el archivo de backup en streaming desde disco"""
+    path = backup_engine.ruta_backup(backup_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="Backup no encontrado")
+    return FileResponse(path, media_type="application/x-tar", filename=path.name)
+
+@api_router.post("/admin/backups/{backup_id}/restaurar")
+async def restaurar_backup_en_disco(backup_id: str, collections: Optional[List[str]] = None):
+    """Restaura un backup en disco; si es incremental reproduce el completo base y toda su cadena"""
+    try:
+        backup_engine.resolver_cadena(backup_id)
+        job = backup_engine.iniciar_restauracion(db, backup_id=backup_id, colecciones=collections)
+        return {"success": True, "message": "Restauración iniciada", "job": job.to_dict()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error restoring backup chain: {e}")
+        raise HTTPException(status_code=500, detail=f"Error restaurando backup: {str(e)}")
+
 @api_router.post("/admin/restore")
-async def restaurar_backup(request: RestoreDatabase):
-    """Restaurar datos desde un backup"""
+async def restaurar_backup(archivo: UploadFile = File(...), collections: Optional[str] = Form(None)):
+    """Restaurar datos desde un archivo de backup subido (.tar del motor de backups o .json antiguo)"""
     try:
-        collections_restored = []
-        
-        collections_to_restore = request.collections or list(request.backup_data.keys())
-        
-        for collection_name in collections_to_restore:
-            if collection_name not in request.backup_data:
-                continue
-                
-            collection = db[collection_name]
-            documents = request.backup_data[collection_name]
-            
-            if documents:
-                # Limpiar colección existente
-                await collection.delete_many({})
-                
-                # Preparar documentos para inserción
-                for doc in documents:
-                    # Remover _id si existe para evitar conflictos
-                    if '_id' in doc:
-                        del doc['_id']
-                
-                # Insertar documentos
-                await collection.insert_many(documents)
-                collections_restored.append(collection_name)
-        
+        # Guardar la subida en disco por bloques, sin cargarla en memoria
+        destino = backup_engine.ruta_subida(archivo.filename or "")
+        with open(destino, "wb") as f:
+            while True:
+                bloque = await archivo.read(1024 * 1024)
+                if not bloque:
+                    break
+                await asyncio.to_thread(f.write, bloque)
+        
+        # Colecciones específicas separadas por coma
+        colecciones = [c.strip() for c in collections.split(",") if c.strip()] if collections else None
+        
+        job = backup_engine.iniciar_restauracion(db, archivo=destino, colecciones=colecciones, borrar_archivo=True)
         return {
             "success": True,
-            "message": "Backup restaurado exitosamente",
-            "collections_restored": collections_restored,
-            "documents_restored": sum(len(request.backup_data.get(col, [])) for col in collections_restored)
+            "message": "Restauración iniciada",
+            "job": job.to_dict()
         }
     except Exception as e:
         logger.error(f"Error restoring backup: {e}")
         raise HTTPException(status_code=500, detail=f"Error restaurando backup: {str(e)}")
 
+MODOS_RESET = ("drop", "delete")
+
+async def vaciar_coleccion(collection_name: str) -> int:
+    """Borra todos los documentos de una colección y deja la lápida para los backups incrementales"""
+    result = await db[collection_name].delete_many({})
+    await registrar_eliminacion(collection_name)
+    return result.deleted_count
+
+async def reconstruir_coleccion(collection_name: str) -> int:
+    """Elimina y recrea la colección con sus índices (ver backup_engine) y deja la lápida para los backups"""
+    total = await backup_engine.reconstruir_coleccion(db, collection_name)
+    await registrar_eliminacion(collection_name)
+    return total
+
+def tarea_reset(modo: str):
+    if modo not in MODOS_RESET:
+        raise HTTPException(status_code=400, detail=f"Modo de reset inválido: {modo}. Use: {', '.join(MODOS_RESET)}")
+    return reconstruir_coleccion if modo == "drop" else vaciar_coleccion
+
+async def reconstruir_vistas_derivadas(colecciones: List[str]):
+    """Recalcula las vistas que dependen de facturas u órdenes tras vaciarlas (y cargar datos de ejemplo)"""
+    if "facturas" in colecciones:
+        await cuentas_por_cobrar.reconstruir(db)
+        await analitica_ingresos.invalidar_todo(db)
+    if "facturas" in colecciones or "ordenes_trabajo" in colecciones:
+        await resumen_clientes.reconstruir(db)
+
 @api_router.post("/admin/reset")
 async def resetear_sistema(request: ResetDatabase):
     """Resetear colecciones específicas del sistema"""
+    tarea = tarea_reset(request.modo)
     try:
-        collections_reset = []
-        
-        for collection_name in request.collections:
-            collection = db[collection_name]
-            result = await collection.delete_many({})
-            collections_reset.append({
-                "name": collection_name,
-                "documents_deleted": result.deleted_count
-            })
+        inicio = time.monotonic()
+        colecciones = list(request.collections)
+        if "ordenes_trabajo" in colecciones and flujo_ordenes.COLECCION not in colecciones:
+            # El registro de eventos no tiene sentido sin sus órdenes
+            colecciones.append(flujo_ordenes.COLECCION)
+        resultados = await ejecutar_por_coleccion(colecciones, tarea)
+        if "facturas" in request.collections:
+            await db.contadores.delete_one({"_id": SERIE_FACTURAS})
+        if "presupuestos" in request.collections:
+            await db.contadores.delete_one({"_id": SERIE_PRESUPUESTOS})
+        collections_reset = [
+            {"name": r["coleccion"], "documents_deleted": r["resultado"], "segundos": r["segundos"]}
+            for r in resultados
+        ]
         
         # Si se solicita crear datos de ejemplo
         sample_data_created = []
         if request.create_sample_data:
             sample_data_created = await crear_datos_ejemplo(request.collections)
         
+        # Después de los datos de ejemplo, para que las vistas también los incluyan
+        await reconstruir_vistas_derivadas(request.collections)
+        
         return {
             "success": True,
             "message": "Sistema reseteado exitosamente",
             "collections_reset": collections_reset,
-            "sample_data_created": sample_data_created
+            "sample_data_created": sample_data_created,
+            "modo": request.modo,
+            "duracion_segundos": round(time.monotonic() - inicio, 3)
         }
     except Exception as e:
         logger.error(f"Error resetting system: {e}")
         raise HTTPException(status_code=500, detail=f"Error reseteando sistema: {str(e)}")
 
 @api_router.post("/admin/reset-complete")
-async def resetear_sistema_completo(create_sample_data: bool = False):
+async def resetear_sistema_completo(create_sample_data: bool = False, modo: str = "drop"):
     """Resetear completamente el sistema incluyendo configuraciones"""
+    tarea = tarea_reset(modo)
     try:
         # Lista de todas las colecciones
         all_collections = [
             "vehiculos", "clientes", "ordenes_trabajo", "mecanicos",
             "servicios_repuestos", "presupuestos", "facturas", 
-            "historial_kilometraje", "tasas_cambio", "configuraciones"
+            "historial_kilometraje", "tasas_cambio", "cierres_caja", "eventos_orden", "configuraciones"
         ]
         
-        collections_reset = []
-        
-        for collection_name in all_collections:
-            collection = db[collection_name]
-            result = await collection.delete_many({})
-            collections_reset.append({
-                "name": collection_name,
-                "documents_deleted": result.deleted_count
-            })
+        inicio = time.monotonic()
+        resultados = await ejecutar_por_coleccion(all_collections, tarea)
+        await db.contadores.delete_many({"_id": {"$in": [SERIE_FACTURAS, SERIE_PRESUPUESTOS]}})
+        collections_reset = [
+            {"name": r["coleccion"], "documents_deleted": r["resultado"], "segundos": r["segundos"]}
+            for r in resultados
+        ]
         
         # Crear datos de ejemplo si se solicita
         sample_data_created = []
         if create_sample_data:
             sample_data_created = await crear_datos_ejemplo(all_collections[:-1])  # Excluir configuraciones
         
+        # Después de los datos de ejemplo, para que las vistas también los incluyan
+        await reconstruir_vistas_derivadas(all_collections)
+        
         return {
             "success": True,
             "message": "Sistema completamente reseteado",
             "collections_reset": collections_reset,
             "sample_data_created": sample_data_created,
-            "total_documents_deleted": sum(col["documents_deleted"] for col in collections_reset)
+            "total_documents_deleted": sum(col["documents_deleted"] for col in collections_reset),
+            "modo": modo,
+            "duracion_segundos": round(time.monotonic() - inicio, 3)
         }
     except Exception as e:
         logger.error(f"Error resetting complete system: {e}")
         raise HTTPException(status_code=500, detail=f"Error reseteando sistema completo: {str(e)}")
 
 async def crear_datos_ejemplo(collections: List[str]):
-    """Crear datos de ejemplo para las colecciones especificadas"""
-    created_data = []
+    """
+    Crear datos de ejemplo para las colecciones especificadas.
+    Primero se arman todos los documentos y después se insertan con un insert_many por colección.
+    """
+    documentos: Dict[str, List[dict]] = {}
     
     try:
         # Datos de ejemplo para Mecánicos
@@ -1752,12 +2449,7 @@ async def crear_datos_ejemplo(collections: List[str]):
                 }
             ]
             
-            mecanicos_collection = db["mecanicos"]
-            for mecanico in mecanicos_ejemplo:
-                mecanico_data = prepare_for_mongo(mecanico)
-                await mecanicos_collection.insert_one(mecanico_data)
-            
-            created_data.append({"collection": "mecanicos", "count": len(mecanicos_ejemplo)})
+            documentos["mecanicos"] = [con_updated_at(prepare_for_mongo(m)) for m in mecanicos_ejemplo]
         
         # Datos de ejemplo para Servicios y Repuestos
         if "servicios_repuestos" in collections:
@@ -1796,12 +2488,7 @@ async def crear_datos_ejemplo(collections: List[str]):
                 }
             ]
             
-            servicios_collection = db["servicios_repuestos"]
-            for servicio in servicios_ejemplo:
-                servicio_data = prepare_for_mongo(servicio)
-                await servicios_collection.insert_one(servicio_data)
-            
-            created_data.append({"collection": "servicios_repuestos", "count": len(servicios_ejemplo)})
+            documentos["servicios_repuestos"] = [con_updated_at(prepare_for_mongo(s)) for s in servicios_ejemplo]
         
         # Datos de ejemplo para Cliente y Vehículo
         if "clientes" in collections and "vehiculos" in collections:
@@ -1818,8 +2505,7 @@ async def crear_datos_ejemplo(collections: List[str]):
                 "email": "carlos.mendoza@ejemplo.com"
             }
             
-            cliente_data = prepare_for_mongo(convert_to_uppercase(cliente_ejemplo))
-            await db["clientes"].insert_one(cliente_data)
+            documentos["clientes"] = [con_updated_at(prepare_for_mongo(convert_to_uppercase(cliente_ejemplo)))]
             
             vehiculo_ejemplo = {
                 "id": str(uuid.uuid4()),
@@ -1836,13 +2522,7 @@ async def crear_datos_ejemplo(collections: List[str]):
                 "cliente_id": cliente_ejemplo["id"]
             }
             
-            vehiculo_data = prepare_for_mongo(convert_to_uppercase(vehiculo_ejemplo))
-            await db["vehiculos"].insert_one(vehiculo_data)
-            
-            created_data.extend([
-                {"collection": "clientes", "count": 1},
-                {"collection": "vehiculos", "count": 1}
-            ])
+            documentos["vehiculos"] = [con_updated_at(prepare_for_mongo(convert_to_uppercase(vehiculo_ejemplo)))]
         
         # Datos de ejemplo para Tasa de Cambio
         if "tasas_cambio" in collections:
@@ -1856,16 +2536,42 @@ async def crear_datos_ejemplo(collections: List[str]):
                 "created_at": datetime.now(timezone.utc)
             }
             
-            tasa_data = prepare_for_mongo(tasa_ejemplo)
-            await db["tasas_cambio"].insert_one(tasa_data)
-            
-            created_data.append({"collection": "tasas_cambio", "count": 1})
+            documentos["tasas_cambio"] = [con_updated_at(prepare_for_mongo(tasa_ejemplo))]
+        
+        # Una sola pasada: un insert_many por colección, todas en paralelo
+        async def insertar(collection_name: str) -> int:
+            await db[collection_name].insert_many(documentos[collection_name])
+            return len(documentos[collection_name])
         
-        return created_data
+        resultados = await ejecutar_por_coleccion(list(documentos), insertar)
+        return [{"collection": r["coleccion"], "count": r["resultado"]} for r in resultados]
     except Exception as e:
         logger.error(f"Error creating sample data: {e}")
         return []
 
+@api_router.post("/admin/datos-sinteticos")
+async def generar_datos_sinteticos(request: GenerarDatosSinteticos):
+    """Genera en segundo plano un dataset sintético determinista para pruebas de rendimiento"""
+    try:
+        await dataset_generator.verificar_destino(db, request.vaciar)
+        job = dataset_generator.iniciar_generacion(
+            db, request.clientes, semilla=request.semilla, fecha_fin=request.fecha_fin,
+            batch_size=request.batch_size, concurrencia=request.concurrencia, vaciar=request.vaciar,
+            vaciar_coleccion=reconstruir_coleccion,
+            series=[SERIE_FACTURAS, SERIE_PRESUPUESTOS, flujo_ordenes.SERIE_EVENTOS]
+        )
+        return {"success": True, "message": "Generación iniciada", "job": job.to_dict()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.get("/admin/datos-sinteticos/jobs/{job_id}")
+async def obtener_progreso_datos_sinteticos(job_id: str):
+    """Estado y documentos insertados por colección de una generación"""
+    job = dataset_generator.GENERACION_JOBS.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Generación no encontrada")
+    return {"success": True, "job": job.to_dict()}
+
 # Endpoint para subir logo del sistema
 @api_router.post("/admin/upload-logo")
 async def subir_logo(logo_base64: str):
@@ -1885,7 +2591,7 @@ async def subir_logo(logo_base64: str):
             # Actualizar configuración existente
             await config_collection.update_one(
                 {"tipo": "sistema"},
-                {"$set": {"logo": logo_base64, "updated_at": datetime.now(timezone.utc)}}
+                {"$set": con_updated_at({"logo": logo_base64})}
             )
         else:
             # Crear nueva configuración
@@ -1893,10 +2599,9 @@ async def subir_logo(logo_base64: str):
                 "id": str(uuid.uuid4()),
                 "tipo": "sistema",
                 "logo": logo_base64,
-                "created_at": datetime.now(timezone.utc),
-                "updated_at": datetime.now(timezone.utc)
+                "created_at": datetime.now(timezone.utc)
             }
-            await config_collection.insert_one(new_config)
+            await config_collection.insert_one(con_updated_at(new_config))
         
         return {
             "success": True,
@@ -1976,10 +2681,9 @@ async def guardar_configuracion_camara(request: dict):
             await config_collection.update_one(
                 {"tipo": "camara"},
                 {
-                    "$set": {
-                        "configuracion": request,
-                        "updated_at": datetime.now(timezone.utc)
-                    }
+                    "$set": con_updated_at({
+                        "configuracion": request
+                    })
                 }
             )
         else:
@@ -1988,10 +2692,9 @@ async def guardar_configuracion_camara(request: dict):
                 "id": str(uuid.uuid4()),
                 "tipo": "camara",
                 "configuracion": request,
-                "created_at": datetime.now(timezone.utc),
-                "updated_at": datetime.now(timezone.utc)
+                "created_at": datetime.now(timezone.utc)
             }
-            await config_collection.insert_one(new_config)
+            await config_collection.insert_one(con_updated_at(new_config))
         
         return {
             "success": True,
@@ -2093,6 +2796,97 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Colecciones con marca de agua updated_at para backups incrementales
+COLECCIONES_CON_WATERMARK = [
+    "vehiculos", "clientes", "ordenes_trabajo", "mecanicos",
+    "servicios_repuestos", "presupuestos", "facturas",
+    "historial_kilometraje", "tasas_cambio", "configuraciones", "eliminaciones", "cierres_caja",
+    "eventos_orden"
+]
+
+@app.on_event("startup")
+async def crear_indices():
+    """Crea los índices que necesitan las consultas del servidor"""
+    try:
+        for collection_name in COLECCIONES_CON_WATERMARK:
+            await db[collection_name].create_index("updated_at")
+        await db[revalorizacion.COLECCION_AUDITORIA].create_index("factura_id")
+        await cuentas_por_cobrar.crear_indices(db)
+        await libro_ventas.crear_indices(db)
+        await linea_tasas.crear_indices(db)
+        await analitica_ingresos.crear_indices(db)
+        await cierre_caja.crear_indices(db)
+        await conciliacion.crear_indices(db)
+        await resumen_clientes.crear_indices(db)
+        await flujo_ordenes.crear_indices(db)
+    except Exception as e:
+        logger.error(f"Error creando índices: {e}")
+    try:
+        await crear_indices_facturas()
+    except Exception as e:
+        logger.warning(f"No se pudieron crear los índices únicos de facturas (¿presupuestos o números repetidos?): {e}")
+    try:
+        await db.vehiculos.create_index("matricula", unique=True, name=INDICE_MATRICULA_UNICA)
+    except Exception as e:
+        logger.warning(f"No se pudo crear el índice único de matrícula (¿duplicados? use /api/admin/limpiar-duplicados): {e}")
+
+async def completar_referencias_norm() -> int:
+    return await conciliacion.completar_referencias_norm(db)
+
+async def completar_montos_emision() -> int:
+    return await libro_ventas.completar_montos_emision(db)
+
+# Migraciones de datos de una sola vez: nombre -> tarea que devuelve cuántos documentos tocó
+MIGRACIONES = {
+    # Facturas anteriores guardaban en monto_pagado_bs los Bs recibidos; se pasan al significado actual
+    MIGRACION_MONTO_PAGADO: recalcular_totales_facturas,
+    # Pagos anteriores a la conciliación no tienen la referencia normalizada
+    "pagos_referencia_norm": completar_referencias_norm,
+    # Facturas anteriores no guardaban los montos de emisión que declara el libro de ventas
+    "facturas_montos_emision": completar_montos_emision,
+}
+
+async def ejecutar_migracion(nombre: str, tarea):
+    try:
+        documentos = await tarea()
+        await db.migraciones.update_one(
+            {"_id": nombre},
+            {"$set": {"aplicada": datetime.now(timezone.utc).isoformat(), "documentos": documentos}},
+            upsert=True
+        )
+        logger.info(f"Migración {nombre}: {documentos} documentos actualizados")
+    except Exception as e:
+        logger.error(f"Error en la migración {nombre}: {e}")
+
+async def ejecutar_migraciones(pendientes: List[str]):
+    for nombre in pendientes:
+        await ejecutar_migracion(nombre, MIGRACIONES[nombre])
+
+@app.on_event("startup")
+async def aplicar_migraciones():
+    """Migraciones de datos de una sola vez; corren en segundo plano para no retrasar el arranque"""
+    try:
+        aplicadas = {m["_id"] async for m in db.migraciones.find({"_id": {"$in": list(MIGRACIONES)}}, {"_id": 1})}
+        pendientes = [nombre for nombre in MIGRACIONES if nombre not in aplicadas]
+        if pendientes:
+            asyncio.create_task(ejecutar_migraciones(pendientes))
+    except Exception as e:
+        logger.error(f"Error verificando migraciones: {e}")
+
+@app.on_event("startup")
+async def cargar_datos_en_memoria():
+    """Carga el historial de tasas y la instantánea del catálogo que se consultan sin ir a Mongo"""
+    try:
+        await linea_tasas.LINEA_TASAS.cargar(db)
+    except Exception as e:
+        logger.error(f"Error cargando el historial de tasas: {e}")
+    try:
+        await catalogo.iniciar(db)
+    except Exception as e:
+        logger.error(f"Error cargando el catálogo: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    documentos_pdf.cerrar_pool()
+    catalogo.detener()
     client.close()
\ No newline at end of file
@@ -45,6 +45,17 @@ import {
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+const ETIQUETAS_ESTADO_ORDEN = {
+  recibido: 'Recibido',
+  diagnosticando: 'Diagnosticando',
+  presupuestado: 'Presupuestado',
+  aprobado: 'Aprobado',
+  en_reparacion: 'En Reparación',
+  terminado: 'Terminado',
+  entregado: 'Entregado',
+  cancelado: 'Cancelado'
+};
+
 // CONFIGURACIÓN GLOBAL DE COLORES DEL SISTEMA
 const COLORES_SISTEMA = {
   badgeAzul: "bg-blue-600 text-white hover:bg-blue-700 border-blue-600",
@@ -402,7 +413,8 @@ const Dashboard = () => {
       'aprobado': { color: 'bg-green-100 text-green-800', icon: <CheckCircle className="w-3 h-3" /> },
       'en_reparacion': { color: 'bg-orange-100 text-orange-800', icon: <Wrench className="w-3 h-3" /> },
       'terminado': { color: 'bg-gray-100 text-gray-800', icon: <CheckCircle className="w-3 h-3" /> },
-      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> }
+      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> },
+      'cancelado': { color: 'bg-red-100 text-red-800', icon: <X className="w-3 h-3" /> }
     };
     
     const config = estadoConfig[estado] || estadoConfig['recibido'];
@@ -558,7 +570,8 @@ const OrdenesListado = () => {
       'aprobado': { color: 'bg-green-100 text-green-800', icon: <CheckCircle className="w-3 h-3" /> },
       'en_reparacion': { color: 'bg-orange-100 text-orange-800', icon: <Wrench className="w-3 h-3" /> },
       'terminado': { color: 'bg-gray-100 text-gray-800', icon: <CheckCircle className="w-3 h-3" /> },
-      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> }
+      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> },
+      'cancelado': { color: 'bg-red-100 text-red-800', icon: <X className="w-3 h-3" /> }
     };
     
     const config = estadoConfig[estado] || estadoConfig['recibido'];
@@ -729,7 +742,8 @@ const OrdenDetalle = () => {
       'aprobado': { color: 'bg-green-100 text-green-800', icon: <CheckCircle className="w-3 h-3" /> },
       'en_reparacion': { color: 'bg-orange-100 text-orange-800', icon: <Wrench className="w-3 h-3" /> },
       'terminado': { color: 'bg-gray-100 text-gray-800', icon: <CheckCircle className="w-3 h-3" /> },
-      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> }
+      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> },
+      'cancelado': { color: 'bg-red-100 text-red-800', icon: <X className="w-3 h-3" /> }
     };
     
     const config = estadoConfig[estado] || estadoConfig['recibido'];
@@ -985,6 +999,7 @@ const OrdenEditar = () => {
   const [observaciones, setObservaciones] = useState('');
   const [mecanicoAsignado, setMecanicoAsignado] = useState('');
   const [estado, setEstado] = useState('');
+  const [transiciones, setTransiciones] = useState({});
   const [reparacionesRealizadas, setReparacionesRealizadas] = useState('');
   const [repuestosUtilizados, setRepuestosUtilizados] = useState('');
   
@@ -1009,8 +1024,21 @@ const OrdenEditar = () => {
     cargarDatosOrden();
     cargarMecanicos();
     cargarServiciosDisponibles();
+    cargarTransiciones();
   }, [ordenId]);
 
+  const cargarTransiciones = async () => {
+    try {
+      const response = await axios.get(`${API}/ordenes/estados`);
+      setTransiciones(response.data.transiciones || {});
+    } catch (error) {
+      console.error('Error cargando estados de la orden:', error);
+    }
+  };
+
+  // El backend solo acepta pasar a un estado permitido desde el que tiene la orden guardada
+  const estadosDisponibles = orden ? [orden.estado, ...(transiciones[orden.estado] || [])] : [];
+
   const cargarDatosOrden = async () => {
     try {
       const ordenRes = await axios.get(`${API}/ordenes/${ordenId}`);
@@ -1273,7 +1301,7 @@ const OrdenEditar = () => {
       navigate(`/orden/${ordenId}`);
     } catch (error) {
       console.error('Error guardando cambios:', error);
-      toast.error('Error al guardar los cambios');
+      toast.error(error.response?.data?.detail || 'Error al guardar los cambios');
     } finally {
       setGuardando(false);
     }
@@ -1470,13 +1498,9 @@ const OrdenEditar = () => {
                       <SelectValue placeholder="Seleccionar estado" />
                     </SelectTrigger>
                     <SelectContent>
-                      <SelectItem value="recibido">Recibido</SelectItem>
-                      <SelectItem value="diagnosticando">Diagnosticando</SelectItem>
-                      <SelectItem value="presupuestado">Presupuestado</SelectItem>
-                      <SelectItem value="aprobado">Aprobado</SelectItem>
-                      <SelectItem value="en_reparacion">En Reparación</SelectItem>
-                      <SelectItem value="terminado">Terminado</SelectItem>
-                      <SelectItem value="entregado">Entregado</SelectItem>
+                      {estadosDisponibles.map((valor) => (
+                        <SelectItem key={valor} value={valor}>{ETIQUETAS_ESTADO_ORDEN[valor] || valor}</SelectItem>
+                      ))}
                     </SelectContent>
                   </Select>
                 </div>
@@ -4256,18 +4280,27 @@ const ConfiguracionTaller = () => {
       });
       
       if (response.data.success) {
-        setBackupData(response.data);
-        toast.success('Backup creado exitosamente');
+        // El backup se genera en segundo plano: consultar el progreso hasta que termine
+        let job = response.data.job;
+        while (job.estado === 'pendiente' || job.estado === 'en_progreso') {
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          const progreso = await axios.get(`${API}/admin/backup/jobs/${job.id}`);
+          job = progreso.data.job;
+        }
+        
+        if (job.estado !== 'completado') {
+          toast.error(`Error creando backup: ${job.error || 'desconocido'}`);
+          return;
+        }
+        
+        setBackupData(job);
+        toast.success(`Backup creado exitosamente: ${job.documentos_procesados} documentos`);
         
-        // Descargar backup como archivo JSON
-        const dataStr = JSON.stringify(response.data, null, 2);
-        const dataBlob = new Blob([dataStr], {type:'application/json'});
-        const url = URL.createObjectURL(dataBlob);
+        // Descargar el archivo de backup generado en el servidor
         const link = document.createElement('a');
-        link.href = url;
-        link.download = `backup-trieste-${new Date().toISOString().split('T')[0]}.json`;
+        link.href = `${API}/admin/backups/${job.id}/descargar`;
+        link.download = `${job.id}.tar`;
         link.click();
-        URL.revokeObjectURL(url);
       }
     } catch (error) {
       console.error('Error creando backup:', error);
@@ -4277,17 +4310,32 @@ const ConfiguracionTaller = () => {
 
   const restaurarBackup = async (backupFile) => {
     try {
-      const fileContent = await backupFile.text();
-      const backupData = JSON.parse(fileContent);
+      const formData = new FormData();
+      formData.append('archivo', backupFile);
+      if (coleccionesSeleccionadas.length > 0) {
+        formData.append('collections', coleccionesSeleccionadas.join(','));
+      }
       
       toast.info('Restaurando backup...');
-      const response = await axios.post(`${API}/admin/restore`, {
-        backup_data: backupData.backup_data,
-        collections: coleccionesSeleccionadas.length > 0 ? coleccionesSeleccionadas : null
+      const response = await axios.post(`${API}/admin/restore`, formData, {
+        headers: { 'Content-Type': 'multipart/form-data' }
       });
       
       if (response.data.success) {
-        toast.success(`Backup restaurado: ${response.data.documents_restored} documentos`);
+        // La restauración corre en segundo plano: consultar el progreso hasta que termine
+        let job = response.data.job;
+        while (job.estado === 'pendiente' || job.estado === 'en_progreso') {
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          const progreso = await axios.get(`${API}/admin/backup/jobs/${job.id}`);
+          job = progreso.data.job;
+        }
+        
+        if (job.estado !== 'completado') {
+          toast.error(`Error restaurando backup: ${job.error || 'desconocido'}`);
+          return;
+        }
+        
+        toast.success(`Backup restaurado: ${job.documentos_procesados} documentos`);
         cargarColecciones(); // Recargar estadísticas
       }
     } catch (error) {
@@ -5340,9 +5388,16 @@ const ConfiguracionTaller = () => {
                                 <p className="text-xs text-gray-500">{coleccion.name}</p>
                               </div>
                             </div>
-                            <Badge variant="secondary" className="text-xs">
-                              {coleccion.count} docs
-                            </Badge>
+                            <div className="flex flex-col items-end gap-1">
+                              <Badge variant="secondary" className="text-xs">
+                                {coleccion.count} docs
+                              </Badge>
+                              {coleccion.almacenamiento_bytes > 0 && (
+                                <span className="text-xs text-gray-500">
+                                  {(coleccion.almacenamiento_bytes / (1024 * 1024)).toFixed(1)} MB · prom. {(coleccion.tamano_promedio_bytes / 1024).toFixed(1)} KB
+                                </span>
+                              )}
+                            </div>
                           </div>
                         </div>
                       ))}
@@ -5414,7 +5469,7 @@ const ConfiguracionTaller = () => {
                       </Button>
                       <input
                         type="file"
-                        accept=".json"
+                        accept=".tar,.json"
                         onChange={(e) => {
                           const file = e.target.files[0];
                           if (file) {
@@ -5425,7 +5480,7 @@ const ConfiguracionTaller = () => {
                       />
                     </label>
                     <p className="text-xs text-gray-500">
-                      Seleccione un archivo .json de backup para restaurar
+                      Seleccione un archivo .tar (o .json antiguo) de backup para restaurar
                     </p>
                   </CardContent>
                 </Card>
@@ -6069,7 +6124,7 @@ const VehiculoDetalle = () => {
   const eliminarVehiculo = async () => {
     try {
       // Verificar si tiene órdenes activas
-      if (ordenesRecientes.some(o => !['terminado', 'entregado'].includes(o.estado))) {
+      if (ordenesRecientes.some(o => !['terminado', 'entregado', 'cancelado'].includes(o.estado))) {
         toast.error('No se puede eliminar: el vehículo tiene órdenes activas');
         return;
       }
@@ -6133,7 +6188,8 @@ const VehiculoDetalle = () => {
       'aprobado': { color: 'bg-green-100 text-green-800', icon: <CheckCircle className="w-3 h-3" /> },
       'en_reparacion': { color: 'bg-orange-100 text-orange-800', icon: <Wrench className="w-3 h-3" /> },
       'terminado': { color: 'bg-gray-100 text-gray-800', icon: <CheckCircle className="w-3 h-3" /> },
-      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> }
+      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> },
+      'cancelado': { color: 'bg-red-100 text-red-800', icon: <X className="w-3 h-3" /> }
     };
     
     const config = estadoConfig[estado] || estadoConfig['recibido'];
@@ -6881,7 +6937,8 @@ const VehiculoHistorial = () => {
       'aprobado': { color: 'bg-green-100 text-green-800', icon: <CheckCircle className="w-3 h-3" /> },
       'en_reparacion': { color: 'bg-orange-100 text-orange-800', icon: <Wrench className="w-3 h-3" /> },
       'terminado': { color: 'bg-gray-100 text-gray-800', icon: <CheckCircle className="w-3 h-3" /> },
-      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> }
+      'entregado': { color: 'bg-green-500 text-white', icon: <CheckCircle className="w-3 h-3" /> },
+      'cancelado': { color: 'bg-red-100 text-red-800', icon: <X className="w-3 h-3" /> }
     };
     
     const config = estadoConfig[estado] || estadoConfig['recibido'];
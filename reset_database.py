@@ -5,9 +5,15 @@ Limpia todas las colecciones y crea datos de prueba iniciales
 """
 import asyncio
 import os
+import sys
 from datetime import datetime, timezone
+from pathlib import Path
 from motor.motor_asyncio import AsyncIOMotorClient
 
+# Los módulos del servidor viven en backend/
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+from backup_engine import reconstruir_coleccion
+
 # Configuración de la base de datos
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 
@@ -17,12 +23,12 @@ async def reset_database():
     client = AsyncIOMotorClient(MONGO_URL)
     db = client.taller_mecanico
     
-    # Limpiar todas las colecciones
+    # Limpiar todas las colecciones: drop + recreación con sus mismos índices
     print("🗑️  Limpiando base de datos...")
     collections = await db.list_collection_names()
-    for collection_name in collections:
-        await db[collection_name].drop()
-        print(f"   - Eliminada colección: {collection_name}")
+    documentos = await asyncio.gather(*(reconstruir_coleccion(db, name) for name in collections))
+    for collection_name, total in zip(collections, documentos):
+        print(f"   - Recreada colección: {collection_name} ({total} documentos eliminados)")
     
     print("✅ Base de datos limpiada completamente")
     
@@ -47,7 +53,6 @@ async def create_sample_data(db):
         "activa": True,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.tasas_cambio.insert_one(tasa_cambio)
     
     # 2. Crear clientes de prueba
     print("👥 Creando clientes...")
@@ -92,7 +97,6 @@ async def create_sample_data(db):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
     ]
-    await db.clientes.insert_many(clientes)
     
     # 3. Crear vehículos de prueba
     print("🚗 Creando vehículos...")
@@ -146,7 +150,6 @@ async def create_sample_data(db):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
     ]
-    await db.vehiculos.insert_many(vehiculos)
     
     # 4. Crear mecánicos de prueba
     print("🔧 Creando mecánicos...")
@@ -185,7 +188,6 @@ async def create_sample_data(db):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
     ]
-    await db.mecanicos.insert_many(mecanicos)
     
     # 5. Crear servicios/repuestos de prueba
     print("🛠️  Creando servicios y repuestos...")
@@ -227,7 +229,6 @@ async def create_sample_data(db):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
     ]
-    await db.servicios_repuestos.insert_many(servicios)
     
     # 6. Crear órdenes de trabajo de prueba
     print("📋 Creando órdenes de trabajo...")
@@ -277,7 +278,16 @@ async def create_sample_data(db):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
     ]
-    await db.ordenes_trabajo.insert_many(ordenes)
+    
+    # Una sola pasada: un insert_many por colección, todas en paralelo
+    await asyncio.gather(
+        db.tasas_cambio.insert_many([tasa_cambio]),
+        db.clientes.insert_many(clientes),
+        db.vehiculos.insert_many(vehiculos),
+        db.mecanicos.insert_many(mecanicos),
+        db.servicios_repuestos.insert_many(servicios),
+        db.ordenes_trabajo.insert_many(ordenes),
+    )
     
     print("✅ Datos de prueba creados exitosamente")
     print("\n📊 RESUMEN DE DATOS CREADOS:")
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Test de concurrencia del registro de pagos.
+Dispara pagos en paralelo contra una misma factura y verifica que ninguno se pierda:
+cantidad de pagos, monto pagado, IGTF y saldo deben cuadrar con la suma de todos.
+"""
+
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_URL = os.environ.get("BASE_URL", "https://workshop-ai-1.preview.emergentagent.com")
+API_URL = f"{BASE_URL}/api"
+PAGOS_PARALELOS = int(os.environ.get("PAGOS_PARALELOS", "20"))
+MONTO_USD = 1.0
+
+
+def crear(endpoint, data, method="POST"):
+    response = requests.request(method, f"{API_URL}/{endpoint}", json=data, timeout=30)
+    if response.status_code != 200:
+        raise RuntimeError(f"{method} /api/{endpoint} -> {response.status_code}: {response.text}")
+    return response.json()
+
+
+def preparar_factura():
+    """Cliente, vehículo, presupuesto aprobado y factura nuevos para no mezclar con otros datos"""
+    sufijo = random.randint(10000, 99999)
+    cliente = crear("clientes", {
+        "nombre": f"CLIENTE CONCURRENCIA {sufijo}",
+        "tipo_documento": "CI",
+        "prefijo_documento": "V",
+        "numero_documento": str(sufijo),
+        "direccion_fiscal": "CARACAS",
+        "email": f"concurrencia{sufijo}@ejemplo.com"
+    })
+    vehiculo = crear("vehiculos", {
+        "matricula": f"PC{sufijo}",
+        "marca": "TOYOTA",
+        "modelo": "COROLLA",
+        "cliente_id": cliente["id"]
+    })
+    presupuesto = crear("presupuestos", {
+        "vehiculo_id": vehiculo["id"],
+        "cliente_id": cliente["id"],
+        "items": [{
+            "tipo": "servicio",
+            "descripcion": "SERVICIO DE PRUEBA",
+            "cantidad": 1,
+            "precio_unitario_usd": 100.0,
+            "total_usd": 100.0
+        }]
+    })
+    crear(f"presupuestos/{presupuesto['id']}/aprobar", None, method="PUT")
+    return crear("facturas", {"presupuesto_id": presupuesto["id"]})
+
+
+def registrar_pago(factura_id, indice):
+    return crear(f"facturas/{factura_id}/pagos", {
+        "factura_id": factura_id,
+        "tipo": "dolares",
+        "metodo": "zelle",
+        "monto_usd": MONTO_USD,
+        "referencia": f"CONC-{indice}"
+    })
+
+
+def test_pagos_concurrentes():
+    print("🧪 Testing Concurrent Payments")
+    print("=" * 50)
+
+    factura = preparar_factura()
+    print(f"✅ Factura creada: {factura['numero_factura']} (total {factura['total_bs']:.2f} Bs)")
+
+    print(f"\n⚡ Registrando {PAGOS_PARALELOS} pagos en paralelo...")
+    with ThreadPoolExecutor(max_workers=PAGOS_PARALELOS) as pool:
+        respuestas = list(pool.map(lambda i: registrar_pago(factura["id"], i), range(PAGOS_PARALELOS)))
+
+    facturas = requests.get(f"{API_URL}/facturas", timeout=30).json()
+    final = next(f for f in facturas if f["id"] == factura["id"])
+
+    # Lo pagado se valora en USD a la tasa de la factura
+    monto_esperado_bs = sum(p["monto_usd"] for p in final["pagos"]) * final["tasa_cambio"]
+    igtf_esperado_bs = final["total_usd"] * 0.03 * final["tasa_cambio"]
+    saldo_esperado = max(0, final["total_bs"] + igtf_esperado_bs - monto_esperado_bs)
+
+    errores = []
+    if len(final["pagos"]) != PAGOS_PARALELOS:
+        errores.append(f"pagos registrados: {len(final['pagos'])}, esperados {PAGOS_PARALELOS}")
+    if len({p["referencia"] for p in final["pagos"]}) != PAGOS_PARALELOS:
+        errores.append("referencias de pago repetidas o perdidas")
+    if abs(final["monto_pagado_bs"] - monto_esperado_bs) > 0.01:
+        errores.append(f"monto_pagado_bs {final['monto_pagado_bs']:.2f} != suma de pagos {monto_esperado_bs:.2f}")
+    if abs(final["igtf_bs"] - igtf_esperado_bs) > 0.01:
+        errores.append(f"igtf_bs {final['igtf_bs']:.2f} != {igtf_esperado_bs:.2f}")
+    if abs(final["saldo_pendiente_bs"] - saldo_esperado) > 0.01:
+        errores.append(f"saldo_pendiente_bs {final['saldo_pendiente_bs']:.2f} != {saldo_esperado:.2f}")
+    if final.get("version") != PAGOS_PARALELOS:
+        errores.append(f"version {final.get('version')} != {PAGOS_PARALELOS}")
+    if any("factura" not in r for r in respuestas):
+        errores.append("alguna respuesta no devolvió la factura actualizada")
+
+    print(f"   Pagos: {len(final['pagos'])}, pagado: {final['monto_pagado_bs']:.2f} Bs, "
+          f"saldo: {final['saldo_pendiente_bs']:.2f} Bs, estado: {final['estado_pago']}")
+    if errores:
+        for error in errores:
+            print(f"❌ {error}")
+        return False
+    print("✅ Ningún pago se perdió y los totales cuadran")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if test_pagos_concurrentes() else 1)
@@ -0,0 +1,54 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from conciliacion import normalizar_referencia, parse_monto  # noqa: E402
+
+
+@pytest.mark.parametrize("valor, esperado", [
+    ("1.500", 1500.0),
+    ("1.500.000", 1500000.0),
+    ("-2.350", -2350.0),
+    ("1.234,56", 1234.56),
+    ("1,234.56", 1234.56),
+    ("1500,5", 1500.5),
+    ("1.50", 1.5),
+    ("1.5000", 1.5),
+    (" 1 500,00 ", 1500.0),
+    ("", None),
+    (None, None),
+    ("abc", None),
+])
+def test_parse_monto_bolivares(valor, esperado):
+    assert parse_monto(valor, "bolivares") == esperado
+
+
+@pytest.mark.parametrize("valor, esperado", [
+    ("1.500", 1.5),
+    ("1.500.000", 1500000.0),
+    ("1,234.56", 1234.56),
+    ("25", 25.0),
+])
+def test_parse_monto_dolares(valor, esperado):
+    assert parse_monto(valor, "dolares") == esperado
+
+
+@pytest.mark.parametrize("referencia, esperado", [
+    ("000123", "123"),
+    ("123", "123"),
+    ("abc", "ABC"),
+    (" 00 12 3 ", "123"),
+    ("0000", "0"),
+    ("", ""),
+    (None, ""),
+    (12345, "12345"),
+])
+def test_normalizar_referencia(referencia, esperado):
+    assert normalizar_referencia(referencia) == esperado
+
+
+def test_referencias_equivalentes_coinciden():
+    assert normalizar_referencia("000abc") == normalizar_referencia("ABC")